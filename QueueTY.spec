@@ -17,7 +17,23 @@ a = Analysis(
         'write_new_inp_file.py',
         'console_utils.py',
         'main.py',
-        'termination.py'
+        'termination.py',
+        'ssh_connection.py',
+        'pipeline.py',
+        'results_cache.py',
+        'run_journal.py',
+        'transfer_manifest.py',
+        'harvest_results.py',
+        'file_transfer.py',
+        'transfer_concurrency.py',
+        'async_remote.py',
+        'remote_shell.py',
+        'head_node_agent.py',
+        'queuety_agent.py',
+        'parallel_embedding.py',
+        'rdkit_conformers.py',
+        'conformer_selection.py',
+        'sdf_records.py'
     ],
     pathex=['C:\\Users\\trist\\PycharmProjects\\QueueTY_v1\\venv\\src'],
     binaries=[],
@@ -45,7 +61,23 @@ a = Analysis(
         ('console_utils.py', '.'),
         ('constants.py', '.'),
         ('main.py', '.'),
-        ('termination.py', '.')
+        ('termination.py', '.'),
+        ('ssh_connection.py', '.'),
+        ('pipeline.py', '.'),
+        ('results_cache.py', '.'),
+        ('run_journal.py', '.'),
+        ('transfer_manifest.py', '.'),
+        ('harvest_results.py', '.'),
+        ('file_transfer.py', '.'),
+        ('transfer_concurrency.py', '.'),
+        ('async_remote.py', '.'),
+        ('remote_shell.py', '.'),
+        ('head_node_agent.py', '.'),
+        ('queuety_agent.py', '.'),
+        ('parallel_embedding.py', '.'),
+        ('rdkit_conformers.py', '.'),
+        ('conformer_selection.py', '.'),
+        ('sdf_records.py', '.')
     ],
     hiddenimports=[],
     hookspath=[],
@@ -0,0 +1,160 @@
+import asyncio
+import stat
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import transfer_concurrency
+
+# Operations in flight at once on one AsyncRemote: channels, SFTP requests and the threads that open them
+DEFAULT_LIMIT = 16
+
+# Polling interval while a remote command runs: starts short for quick commands, backs off for long ones
+POLL_START = 0.005
+POLL_MAX = 0.2
+
+RemoteResult = namedtuple("RemoteResult", ["command", "exit_status", "stdout", "stderr"])
+
+_background_loop = None
+_background_lock = threading.Lock()
+
+
+class AsyncRemote:
+    """
+    Asyncio front end for one SSH client.
+
+    run/put/get/listdir are coroutines and any number of them can be gathered at once; at most `limit`
+    are in flight, everything else waits on a semaphore instead of holding a thread. Only the blocking
+    paramiko calls (opening a channel, SFTP requests) go through a thread pool of `limit` threads. Running
+    commands are polled on the event loop, so a slow find does not tie up a thread while it runs.
+    """
+
+    def __init__(self, ssh, limit=DEFAULT_LIMIT, retries=3):
+        self.ssh = ssh
+        self.limit = max(1, int(limit))
+        self.retries = retries
+        self._executor = ThreadPoolExecutor(max_workers=self.limit)
+        self._semaphore = None
+        self._sftp = None
+        self._sftp_lock = threading.Lock()
+
+    async def _blocking(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _slot(self):
+        # Created lazily so it belongs to the loop the coroutines run on
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    def _start_command(self, command, stdin):
+        channel = self.ssh.get_transport().open_session()
+        channel.exec_command(command)
+        if stdin is not None:
+            channel.sendall(stdin if isinstance(stdin, bytes) else stdin.encode('utf-8'))
+        channel.shutdown_write()
+        return channel
+
+    async def run(self, command, stdin=None):
+        """
+        Run a command on the head node and return a RemoteResult with its exit status and decoded output.
+        A channel refused by sshd (MaxSessions) is retried with backoff.
+        """
+        async with self._slot():
+            for attempt in range(self.retries):
+                try:
+                    channel = await self._blocking(self._start_command, command, stdin)
+                    break
+                except Exception as e:
+                    if not transfer_concurrency.is_channel_open_failure(e) or attempt == self.retries - 1:
+                        raise
+                    await asyncio.sleep(transfer_concurrency.retry_delay(attempt))
+
+            stdout, stderr = [], []
+            delay = POLL_START
+            try:
+                while True:
+                    received = False
+                    while channel.recv_ready():
+                        stdout.append(channel.recv(65536))
+                        received = True
+                    while channel.recv_stderr_ready():
+                        stderr.append(channel.recv_stderr(65536))
+                        received = True
+                    if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                        break
+                    await asyncio.sleep(0 if received else delay)
+                    delay = POLL_START if received else min(delay * 2, POLL_MAX)
+                exit_status = channel.recv_exit_status()
+            finally:
+                channel.close()
+        return RemoteResult(command, exit_status, b"".join(stdout).decode(errors="replace"),
+                            b"".join(stderr).decode(errors="replace"))
+
+    def _open_sftp(self):
+        with self._sftp_lock:
+            if self._sftp is None:
+                self._sftp = self.ssh.open_sftp()
+            return self._sftp
+
+    async def _sftp_call(self, method_name, *args):
+        async with self._slot():
+            return await self._blocking(lambda: getattr(self._open_sftp(), method_name)(*args))
+
+    async def put(self, local_path, remote_path):
+        """Upload one file over the shared SFTP session."""
+        await self._sftp_call("put", local_path, remote_path)
+
+    async def get(self, remote_path, local_path):
+        """Download one file over the shared SFTP session."""
+        await self._sftp_call("get", remote_path, local_path)
+
+    async def listdir(self, remote_dir, folders_only=False):
+        """Return the sorted entry names of a remote directory, optionally only the folders."""
+        entries = await self._sftp_call("listdir_attr", remote_dir)
+        return sorted(entry.filename for entry in entries
+                      if not folders_only or stat.S_ISDIR(entry.st_mode or 0))
+
+    async def run_many(self, commands):
+        """
+        Run commands concurrently under the limit, returning their RemoteResults in order.
+        A command that could not be run is returned as its exception instead, so one refused channel does
+        not lose the results of the commands that did run.
+        """
+        return await asyncio.gather(*(self.run(command) for command in commands), return_exceptions=True)
+
+    def close(self):
+        with self._sftp_lock:
+            if self._sftp is not None:
+                self._sftp.close()
+                self._sftp = None
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def run_commands(ssh, commands, limit=DEFAULT_LIMIT):
+    """
+    Blocking helper for the stage scripts: run commands concurrently and return their RemoteResults, or the
+    exception of each command that could not be run.
+    """
+    async def run_all():
+        with AsyncRemote(ssh, limit) as remote:
+            return await remote.run_many(commands)
+    return asyncio.run(run_all())
+
+
+def submit(coroutine):
+    """
+    Schedule a coroutine on a background event loop and return a concurrent.futures.Future.
+    The GUI can check future.done() from its own event loop (e.g. with after()) without blocking.
+    """
+    global _background_loop
+    with _background_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _background_loop)
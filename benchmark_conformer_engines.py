@@ -0,0 +1,105 @@
+"""
+Compare the RDKit conformer search (rdkit_conformers.py) with VConf on the same molecules.
+
+Usage: python benchmark_conformer_engines.py <input.sdf> [first molecule] [last molecule]
+
+Both engines run with the active VConf settings (default or experimental) on the given range of the SDF,
+each into its own folder next to it. For every molecule the script prints the number of conformers each
+engine kept and how many of the VConf conformers have an RDKit conformer within COVERAGE_RMSD Å heavy atom
+RMSD, then the total wall time of both engines. Energies are not compared, as the force fields differ.
+"""
+import os
+import sys
+import time
+from rdkit import Chem, RDLogger
+from rdkit.Chem import rdMolAlign
+import constants
+import generate_conformers_vconf
+import rdkit_conformers
+
+# A VConf conformer counts as found by RDKit if an RDKit conformer lies within this heavy atom RMSD (Å)
+COVERAGE_RMSD = 1.0
+
+
+def read_confs_file(path):
+    """Return the conformers of a _confs.sdf file as one heavy atom molecule with a conformer each."""
+    mols = [mol for mol in Chem.SDMolSupplier(path) if mol is not None] if os.path.exists(path) else []
+    if not mols:
+        return None
+    combined = Chem.Mol(mols[0])
+    combined.RemoveAllConformers()
+    for mol in mols:
+        combined.AddConformer(mol.GetConformer(), assignId=True)
+    return combined
+
+
+def coverage(reference, probe):
+    """Number of reference conformers with a probe conformer within COVERAGE_RMSD."""
+    found = 0
+    for reference_conformer in reference.GetConformers():
+        for probe_conformer in probe.GetConformers():
+            if rdMolAlign.GetBestRMS(probe, reference, prbId=probe_conformer.GetId(),
+                                     refId=reference_conformer.GetId()) < COVERAGE_RMSD:
+                found += 1
+                break
+    return found
+
+
+def run_engine(name, settings, num_molecules, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    start_time = time.time()
+    if name == "VConf":
+        command = generate_conformers_vconf.build_vconf_command(settings, settings['SDF_FILENAME'], num_molecules,
+                                                                running_as_exe=False)
+        generate_conformers_vconf.run_vconf_command(command, output_dir)
+    else:
+        rdkit_conformers.run_conformer_search(settings, num_molecules, output_dir)
+    return time.time() - start_time
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return
+    RDLogger.DisableLog('rdApp.warning')
+    sdf_path = os.path.abspath(sys.argv[1])
+    names = [mol.GetProp('_Name') if mol is not None else None
+             for mol in Chem.SDMolSupplier(sdf_path, removeHs=False)]
+    first_molecule = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    last_molecule = int(sys.argv[3]) if len(sys.argv) > 3 else len(names)
+
+    base_settings = (constants.default_vconf_settings if constants.use_default_vconf_settings
+                     else constants.experimental_vconf_settings)
+    benchmark_dir = os.path.join(os.path.dirname(sdf_path), "conformer_engine_benchmark")
+    output_dirs, times = {}, {}
+    for engine in ("VConf", "RDKit"):
+        output_dirs[engine] = os.path.join(benchmark_dir, engine)
+        settings = dict(base_settings, SDF_FILENAME=sdf_path, FIRST_MOLECULE=first_molecule,
+                        LAST_MOLECULE=last_molecule,
+                        OUTPUT_LOG=os.path.join(output_dirs[engine], f"{engine}.log"),
+                        OUTPUT_SDF=os.path.join(output_dirs[engine], f"{engine}.sdf"))
+        print(f"Running {engine} on molecules {first_molecule}-{last_molecule}...")
+        times[engine] = run_engine(engine, settings, len(names), output_dirs[engine])
+
+    print(f"\n{'Molecule':<40}{'VConf':>8}{'RDKit':>8}{'Coverage':>12}")
+    found_total, reference_total = 0, 0
+    for name in names[first_molecule - 1:last_molecule]:
+        if name is None:
+            continue
+        vconf = read_confs_file(os.path.join(output_dirs["VConf"], f"{name}_confs.sdf"))
+        rdkit = read_confs_file(os.path.join(output_dirs["RDKit"], f"{name}_confs.sdf"))
+        vconf_count = vconf.GetNumConformers() if vconf is not None else 0
+        rdkit_count = rdkit.GetNumConformers() if rdkit is not None else 0
+        found = coverage(vconf, rdkit) if vconf is not None and rdkit is not None else 0
+        found_total += found
+        reference_total += vconf_count
+        print(f"{name:<40}{vconf_count:>8}{rdkit_count:>8}{f'{found}/{vconf_count}':>12}")
+
+    print(f"\nVConf: {times['VConf']:.1f} s, RDKit: {times['RDKit']:.1f} s")
+    if reference_total:
+        print(f"RDKit found {found_total}/{reference_total} VConf conformers "
+              f"({100 * found_total / reference_total:.1f} %) within {COVERAGE_RMSD} A.")
+
+
+if __name__ == "__main__":
+    main()
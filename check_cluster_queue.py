@@ -1,9 +1,13 @@
-import paramiko
+from ssh_connection import get_ssh_client
+import harvest_results
+import head_node_agent
+import run_journal
 import time
 import sys
 import os
 from datetime import datetime
 from collections import Counter
+import xml.etree.ElementTree as ET
 import importlib.util
 import configparser
 
@@ -35,6 +39,7 @@ check_cluster_queue_script = constants.check_cluster_queue_script
 gzip_timestamped_folder = constants.gzip_timestamped_folder
 delete_temp_dir_after_transferring_to_timestamped_folder = constants.delete_temp_dir_after_transferring_to_timestamped_folder
 list_folder_name = constants.list_folder_name
+harvest_finished_jobs = constants.harvest_finished_jobs
 constants.remote_directory = remote_directory  # Update remote_directory
 constants.remote_file_path = remote_file_path  # Update remote_file_path
 files_to_keep = constants.files_to_keep
@@ -43,13 +48,189 @@ files_to_keep = constants.files_to_keep
 constants.remote_temp_dir = os.path.join(constants.remote_directory, constants.temp_dir).replace("\\", "/")
 remote_temp_dir = constants.remote_temp_dir  # Use updated value
 
-def check_queue_status(ssh):
+# Bounds of the adaptive poll interval in seconds
+MIN_POLL_INTERVAL = 15
+MAX_POLL_INTERVAL = 300
+
+def check_queue_jobs(ssh):
     """
-    Check the status of the queue using qstat.
+    Return {job id: state} for the jobs listed by qstat.
     """
     stdin, stdout, stderr = ssh.exec_command("qstat")
     queue_status = stdout.read().decode().strip().split('\n')
-    return [line.split()[4] for line in queue_status[2:] if line.strip()]
+    return {line.split()[0]: line.split()[4] for line in queue_status[2:] if line.strip()}
+
+
+def check_queue_status(ssh):
+    """
+    Check the status of the queue using qstat.
+    """
+    return list(check_queue_jobs(ssh).values())
+
+
+def expand_task_range(task_text):
+    """
+    Expand an SGE task list such as "3", "4-10:2" or "1,5-7" into task ids.
+    """
+    task_ids = []
+    for part in task_text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        span, _, step = part.partition(":")
+        first, _, last = span.partition("-")
+        step = int(step) if step else 1
+        task_ids.extend(str(task_id) for task_id in range(int(first), int(last or first) + 1, step))
+    return task_ids
+
+
+def parse_qstat_xml(xml_text):
+    """
+    Parse qstat -xml output into {job key: state}.
+    Plain jobs are keyed by their job id and array tasks by <job id>.<task id>, the same way submission
+    records them in the run journal.
+    """
+    states = {}
+    for job in ET.fromstring(xml_text).iter("job_list"):
+        job_id = job.findtext("JB_job_number", "").strip()
+        if not job_id:
+            continue
+        state = job.findtext("state", "").strip() or job.get("state", "")
+        tasks = job.findtext("tasks")
+        if tasks:
+            for task_id in expand_task_range(tasks):
+                states[f"{job_id}.{task_id}"] = state
+        else:
+            states[job_id] = state
+    return states
+
+
+def check_queue_jobs_xml(ssh):
+    """
+    Return {job key: state} from qstat -xml, or None if the XML could not be read.
+    """
+    stdin, stdout, stderr = ssh.exec_command("qstat -xml")
+    output = stdout.read().decode()
+    if stdout.channel.recv_exit_status() != 0:
+        return None
+    try:
+        return parse_qstat_xml(output)
+    except ET.ParseError as e:
+        print(f"\nCould not parse qstat -xml output: {e}")
+        return None
+
+
+def tracked_job_states(queue_states, job_ids):
+    """
+    Return {conformer name: state} for the conformers whose recorded job is still in the queue.
+    queue_states comes from parse_qstat_xml and job_ids maps conformer names to their recorded job id.
+    A whole array job listed without tasks still counts for every task recorded under it.
+    """
+    states = {}
+    for name, job_id in job_ids.items():
+        if job_id in queue_states:
+            states[name] = queue_states[job_id]
+        elif job_id.split(".")[0] in queue_states:
+            states[name] = queue_states[job_id.split(".")[0]]
+    return states
+
+
+def is_running(state):
+    """Running, transferring or suspended jobs have left the waiting queue; qw, hqw and Eqw have not."""
+    return "q" not in state
+
+
+def job_state_transitions(previous_states, current_states):
+    """
+    Count state changes between two polls as {"old -> new": count}. Jobs that left the queue count as "done".
+    """
+    transitions = Counter()
+    for name, old_state in previous_states.items():
+        new_state = current_states.get(name, "done")
+        if new_state != old_state:
+            transitions[f"{old_state} -> {new_state}"] += 1
+    for name, new_state in current_states.items():
+        if name not in previous_states:
+            transitions[f"new -> {new_state}"] += 1
+    return transitions
+
+
+def next_poll_interval(previous_interval, current_states, total_jobs, changed):
+    """
+    Pick the time until the next poll.
+    Back off while every job is still waiting, scale with the share of jobs left once some run,
+    and halve the interval whenever jobs changed state so the end of the run is caught quickly.
+    """
+    if not current_states:
+        return MIN_POLL_INTERVAL
+    if not any(is_running(state) for state in current_states.values()):
+        interval = previous_interval * 2
+    else:
+        interval = MIN_POLL_INTERVAL + (MAX_POLL_INTERVAL - MIN_POLL_INTERVAL) * len(current_states) / max(total_jobs, 1)
+        if changed:
+            interval = min(interval, previous_interval / 2)
+    return int(max(MIN_POLL_INTERVAL, min(MAX_POLL_INTERVAL, interval)))
+
+
+def poll_queue(ssh, job_ids):
+    """
+    Return {job key: state} for the jobs this run is waiting on.
+    The head node agent reads qstat -xml (or plain qstat) there and sends the states back as JSON; without
+    the agent qstat is read from here.
+    With recorded job ids this is filtered to them, so jobs QueueTY did not submit never hold the run up.
+    Without any (or if qstat -xml is not available) every job in plain qstat is counted, as before.
+    """
+    try:
+        queue_states = head_node_agent.job_status(ssh)
+        return tracked_job_states(queue_states, job_ids) if job_ids else queue_states
+    except (head_node_agent.AgentUnavailable, RuntimeError) as e:
+        print(f"\nQueue states from the head node agent unavailable ({e}), reading qstat directly.")
+
+    if job_ids:
+        queue_states = check_queue_jobs_xml(ssh)
+        if queue_states is not None:
+            return tracked_job_states(queue_states, job_ids)
+        print("\nqstat -xml failed, falling back to plain qstat for the whole queue.")
+    return check_queue_jobs(ssh)
+
+
+def record_finished_jobs(journal, job_ids, current_states):
+    """
+    Mark conformers whose recorded job is no longer in the queue as finished in the run journal.
+    """
+    finished = [name for name in job_ids if name not in current_states]
+    if finished:
+        journal.mark(finished, run_journal.FINISHED)
+
+
+def unfinished_job_ids(journal):
+    """Return {conformer name: job id} for the submitted conformers not yet marked finished."""
+    finished = journal.done(run_journal.FINISHED)
+    return {name: job_id for name, job_id in journal.job_ids().items() if name not in finished}
+
+
+def harvest_finished_conformers(ssh, journal, skipped):
+    """
+    Fetch the results of conformers whose job finished, either by leaving the queue or by writing the
+    completion marker, and that have not been fetched yet. Conformers whose job left no .cosmo file are
+    added to skipped so they are not asked for again on every poll.
+    """
+    marked = harvest_results.marked_complete(ssh, remote_temp_dir) & set(journal.names())
+    if marked:
+        journal.mark(marked, run_journal.FINISHED)
+
+    fetched = journal.done(run_journal.COSMO_FETCHED)
+    ready = sorted(journal.done(run_journal.FINISHED) - fetched - skipped)
+    if not ready:
+        return
+    local_target_dir = os.path.join(constants.list_folder, "TMoleX_output")
+    harvested, missing = harvest_results.harvest_conformers(ssh, remote_temp_dir, local_target_dir, ready, journal,
+                                                            backend_name=constants.transfer_backend,
+                                                            connections=constants.transfer_connections,
+                                                            max_concurrency=constants.max_transfer_concurrency)
+    skipped.update(missing)
+    print(f"\nHarvested results of {len(harvested)} finished conformers "
+          f"({len(fetched) + len(harvested)} local so far, {len(missing)} finished without a .cosmo file).")
 
 
 def create_timestamped_directory(ssh, base_dir):
@@ -69,6 +250,12 @@ def gzip_directory(ssh, directory):
     Gzip the contents of a directory and replace the original directory with the gzipped archive.
     """
     print(f"Starting gzipping of directory: {directory}")
+    try:
+        archive = head_node_agent.pack(ssh, directory, f"{directory}.tar.gz", remove_source=True)
+        print(f"Finished gzipping of directory: {directory} ({archive['files']} files, {archive['bytes']} bytes)")
+        return
+    except (head_node_agent.AgentUnavailable, RuntimeError) as e:
+        print(f"Packing with the head node agent failed ({e}), using tar.")
     stdin, stdout, stderr = ssh.exec_command(f"tar -czf {directory}.tar.gz -C {directory} . && rm -rf {directory}")
     stdout.channel.recv_exit_status()  # Wait for the command to complete
     print(f"Finished gzipping of directory: {directory}")
@@ -84,8 +271,7 @@ def copy_processed_files(ssh, source_dir, target_dir):
     print(f"Finished copy from {source_dir} to {target_dir}")
 
     # Verify that the files were copied successfully
-    stdin, stdout, stderr = ssh.exec_command(f"ls -1 {target_dir}")
-    copied_files = stdout.read().decode().strip().split()
+    copied_files = head_node_agent.entry_names(ssh, target_dir)
     if not copied_files:
         raise RuntimeError(f"Copying files from {source_dir} to {target_dir} failed. No files were found in the target directory.")
     else:
@@ -118,24 +304,48 @@ def main():
         print("check_cluster_queue.py is disabled")
         return
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(server, port=port, username=username, password=password)
+    ssh = get_ssh_client(server, port, username, password)
 
     start_time = datetime.now()
 
-    # Initial print before entering the loop
-    job_states = check_queue_status(ssh)
-    elapsed_time = datetime.now() - start_time
-    elapsed_minutes = divmod(elapsed_time.total_seconds(), 60)[0]
-    state_counts = Counter(job_states)
-    state_summary = " | ".join(f"{state}: {count}" for state, count in state_counts.items())
-    print(
-        f"\rJob states at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | {int(elapsed_minutes)} minutes since submission | {state_summary}",
-        end='', flush=True)
+    journal = run_journal.open_journal(constants.list_folder)
+    job_ids = unfinished_job_ids(journal)
+    if job_ids:
+        print(f"Watching {len(job_ids)} submitted jobs recorded in the run journal.")
+    else:
+        print("No submitted jobs recorded in the run journal, watching every job in the queue.")
+
+    previous_states = {}
+    total_jobs = len(job_ids)
+    poll_interval = MIN_POLL_INTERVAL
+    first_poll = True
+    harvest_skipped = set()
 
     while True:
-        job_states = check_queue_status(ssh)
+        if job_ids:
+            # Pick up jobs submitted since the last poll (streaming submission). Once every job is finished,
+            # keep the last set so the loop does not fall back to watching the whole queue.
+            job_ids = unfinished_job_ids(journal) or job_ids
+            total_jobs = max(total_jobs, len(job_ids))
+        current_states = poll_queue(ssh, job_ids)
+        job_states = list(current_states.values())
+        if job_ids:
+            record_finished_jobs(journal, job_ids, current_states)
+            if harvest_finished_jobs:
+                harvest_finished_conformers(ssh, journal, harvest_skipped)
+        else:
+            total_jobs = max(total_jobs, len(current_states))
+
+        transitions = Counter() if first_poll else job_state_transitions(previous_states, current_states)
+        if transitions:
+            transition_summary = " | ".join(f"{change}: {count}" for change, count in transitions.items())
+            print(f"\nState changes at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | {transition_summary}")
+        errored = sorted(name for name, state in current_states.items() if "E" in state)
+        if errored and errored != sorted(name for name, state in previous_states.items() if "E" in state):
+            print(f"\n{len(errored)} jobs are in an error state and will not finish on their own: {', '.join(errored[:10])}")
+        previous_states = current_states
+        first_poll = False
+
         if not job_states:
             elapsed_time = datetime.now() - start_time
             elapsed_seconds = divmod(elapsed_time.total_seconds(), 1)[0]
@@ -171,13 +381,14 @@ def main():
             elapsed_minutes = divmod(elapsed_time.total_seconds(), 60)[0]
             state_counts = Counter(job_states)
             state_summary = " | ".join(f"{state}: {count}" for state, count in state_counts.items())
+            poll_interval = next_poll_interval(poll_interval, current_states, total_jobs, bool(transitions))
             print(
-                f"\rJob states at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | {int(elapsed_minutes)} minutes since submission | {state_summary}",
+                f"\rJob states at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | {int(elapsed_minutes)} minutes since submission | {state_summary} | next check in {poll_interval} s",
                 end='', flush=True)
-        time.sleep(120)
+        time.sleep(poll_interval)
 
+    journal.close()
     print()
-    ssh.close()
 
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-import paramiko
+from ssh_connection import get_ssh_client
 from constants import check_remote_directory_script, port
 import os
 import configparser
@@ -21,9 +21,7 @@ def list_directory(remote_directory, remote_file_path):
 
     # Connect to the SSH server
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(server, port=port, username=username, password=password)
+        ssh = get_ssh_client(server, port, username, password)
 
         # Ensure the path is correctly joined with a /
         full_path = os.path.join(remote_directory, remote_file_path).replace("\\", "/")
@@ -39,13 +37,13 @@ def list_directory(remote_directory, remote_file_path):
         if errors:
             print(f"Error occurred: {errors}")
 
-        # Close the SSH connection
-        ssh.close()
-
     except Exception as e:
         print(f"Error connecting to SSH server: {e}")
 
-# Run the function once
+def main():
+    list_directory(remote_directory, remote_file_path)
+
 
+if __name__ == "__main__":
+    main()
 
-list_directory(remote_directory, remote_file_path)
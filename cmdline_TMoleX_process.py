@@ -2,14 +2,22 @@ import os
 import shlex
 import io
 import time
-from time import sleep
+from datetime import datetime
 from rdkit import Chem
-import paramiko
-from scp import SCPClient
+from ssh_connection import get_ssh_client
+import file_transfer
+import harvest_results
+import head_node_agent
+import remote_shell
+import results_cache
+import run_journal
+import transfer_concurrency
+import transfer_manifest
+from submit_remote_jobs_to_cluster import TEMPLATES_DIR_NAME, create_shared_subscript
 import importlib.util
 import sys
 import hashlib
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import tarfile
 import re
 from collections import defaultdict
 import configparser
@@ -59,6 +67,66 @@ constants.remote_file_path = remote_file_path  # Update remote_file_path
 constants.remote_temp_dir = os.path.join(constants.remote_directory, constants.temp_dir).replace("\\", "/")
 remote_temp_dir = constants.remote_temp_dir  # Use updated value
 
+# Hidden folder in the remote temp directory for per-molecule runner scripts used when streaming
+STREAM_DIR_NAME = ".stream"
+
+# Loop run by the shared run_tx.sh over a manifest of "molecule define_script" lines
+RUNNER_SCRIPT_BODY = r"""
+manifest="$1"
+log_file="$2"
+remote_dir=__REMOTE_DIR__
+templates_dir="$remote_dir/__TEMPLATES_DIR__"
+
+echo "Starting run_tx.sh execution at $(date)" > "$log_file"
+# The manifest is read on fd 3 so tx, define and cosmoprep cannot swallow it through stdin
+while read -r mol_name define_script <&3; do
+    [ -z "$mol_name" ] && continue
+    if ! cd "$remote_dir/$mol_name"; then
+        echo "$mol_name: tx failed" >> "$log_file"
+        continue
+    fi
+
+    # Add $chelp grid=3 to the control file
+    if grep -q '$chelp' control; then
+        sed -i '/$chelp/a\    grid=3' control
+    else
+        echo '$chelp' >> control
+        echo '    grid=3' >> control
+    fi
+
+    echo "Processing molecule: $mol_name" >> "$log_file"
+    if tx >> "$log_file" 2>&1; then
+        echo "$mol_name: tx Pass" >> "$log_file"
+        if bash "$templates_dir/$define_script" > define.log 2>&1; then
+            echo "$mol_name: define Pass" >> "$log_file"
+        else
+            echo "$mol_name: define failed" >> "$log_file"
+        fi
+        if bash "$templates_dir/run_cosmoprep.sh" > cosmoprep.log 2>&1; then
+            echo "$mol_name: cosmoprep Pass" >> "$log_file"
+        else
+            echo "$mol_name: cosmoprep failed" >> "$log_file"
+        fi
+    else
+        echo "$mol_name: tx failed" >> "$log_file"
+    fi
+__COSMO_OUTPUT__done 3< "$manifest"
+echo "Completed run_tx.sh execution at $(date)" >> "$log_file"
+"""
+
+# Points the control file at <molecule>.cosmo instead of out.ccf
+COSMO_OUTPUT_LINE = '    sed -i "s|\\$cosmo_out file=out.ccf|\\$cosmo_out file=$mol_name.cosmo|" control\n'
+
+# Molecules whose shared templates were deployed by this process, keyed by charge
+_deployed_template_charges = set()
+
+# run_tx.log markers and the journal steps they record
+PREPARATION_STEPS = {
+    "tx Pass": run_journal.TX_PASS,
+    "define Pass": run_journal.DEFINE_PASS,
+    "cosmoprep Pass": run_journal.COSMOPREP_PASS
+}
+
 # Debugging statements (optional)
 print(f"Server: {server}")
 print(f"Username: {username}")
@@ -84,12 +152,9 @@ def assign_define_script(conformers, geometry_optimize_percentage, output_dir, s
         with open(define_script, 'r') as src:
             script_content = src.read()
 
-        # Transfer the script to the remote server
-        with SCPClient(ssh.get_transport()) as scp:
-            scp.putfo(io.StringIO(script_content), target_path)
-
-        # Set the transferred script as executable on the remote server
-        ssh.exec_command(f"chmod +x {shlex.quote(target_path)}")
+        # Transfer the script to the remote server as an executable
+        with file_transfer.open_transfer_backend(ssh, constants.transfer_backend) as backend:
+            backend.putfo(script_content, target_path, mode=0o755)
 
         # Log which script was assigned
         print(f"Assigned {'geometry_optimize_define.sh' if i < n_optimize else 'define.sh'} to {conformer_name} on the remote server.")
@@ -124,6 +189,7 @@ def write_molecule_file(mol, mol_name, output_dir):
 def sdf_to_files(sdf_file, output_dir):
     """
     Convert batch file .sdf to multiple smaller .sdf files with molecule names.
+    Returns {molecule name: (canonical SMILES, charge)} for the molecules written.
     """
     print(f"Converting SDF file: {sdf_file}")
     if not os.path.exists(sdf_file):
@@ -136,6 +202,7 @@ def sdf_to_files(sdf_file, output_dir):
     else:
         os.makedirs(output_dir)
 
+    identities = {}
     suppl = Chem.SDMolSupplier(sdf_file, removeHs=False)
     for mol in suppl:
         if mol is not None:
@@ -148,48 +215,45 @@ def sdf_to_files(sdf_file, output_dir):
                 mol_name = f'molecule_{suppl.index(mol)}'
             print(f"Processing molecule: {mol_name}")
             write_molecule_file(mol, mol_name, output_dir)
+            identities[mol_name] = molecule_identity(mol)
+    return identities
 
 
 def clear_remote_directory(ssh, remote_path):
     """
     Clear the temporary directory on the remote server.
+    The removal and the check run in one round trip on the persistent remote shell.
     """
-    ssh.exec_command(f"rm -rf {remote_path}/*")
+    removal, listing = remote_shell.run_many(ssh, [f"rm -rf {remote_path}/*", f"ls -A {remote_path}"])
     # Verify that the directory is empty
-    stdin, stdout, stderr = ssh.exec_command(f"ls -A {remote_path}")
-    if stdout.read().strip() == "":
+    if removal.exit_status == 0 and listing.stdout.strip() == "":
         print(f"Successfully cleared remote directory: {remote_path}")
     else:
-        print(f"Warning: Remote directory {remote_path} may not be completely cleared.")
+        print(f"Warning: Remote directory {remote_path} may not be completely cleared. {removal.stderr.strip()}")
 
 
 def create_remote_directory(ssh, remote_dir):
     """
     Create directories on the remote server.
     """
-    ssh.exec_command(f"mkdir -p {remote_dir}")
-    # Verify that the directory was created
-    stdin, stdout, stderr = ssh.exec_command(f"test -d {remote_dir} && echo 'exists'")
-    if stdout.read().decode().strip() == "exists":
-        print(f"Successfully created remote directory: {remote_dir}")
-    else:
-        print(f"Warning: Failed to create remote directory: {remote_dir}")
+    create_remote_directories(ssh, [remote_dir])
 
 
-def calculate_md5(file_path):
-    """Calculate the MD5 checksum of a local file."""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+def create_remote_directories(ssh, remote_dirs):
+    """
+    Create many directories on the remote server with one batch on the persistent remote shell.
+    """
+    failed = remote_shell.make_directories(ssh, remote_dirs)
+    for remote_dir in failed:
+        print(f"Warning: Failed to create remote directory: {remote_dir}")
+    if len(remote_dirs) - len(failed):
+        print(f"Successfully created {len(remote_dirs) - len(failed)} remote directories.")
 
 
 def verify_remote_file(ssh, remote_file, local_md5):
     """Check if the remote file's MD5 checksum matches the local file's checksum."""
-    stdin, stdout, stderr = ssh.exec_command(f"md5sum {remote_file}")
-    remote_md5 = stdout.read().decode().strip().split()[0]
-    return local_md5 == remote_md5
+    result = remote_shell.run(ssh, f"md5sum {remote_file}")
+    return result.exit_status == 0 and local_md5 == result.stdout.strip().split()[0]
 
 
 def transfer_files_to_remote(
@@ -198,136 +262,198 @@ def transfer_files_to_remote(
     ssh,
     geometry_optimize_percentage,  # Changed to geometry_optimize_percentage
     percent_enabled,
-    max_workers=5,
     retries=3,
-    delay=5
+    filenames=None,
+    journal=None
 ):
     """
     Transfer coord files to the remote server with the name 'x'. tx command will read these.
-    Transfers multiple files in parallel using ThreadPoolExecutor.
+    Transfers multiple files in parallel, as many at once as the coord upload concurrency controller allows.
+    Only the given filenames are transferred if provided, otherwise every file in local_dir.
+    All uploads are verified together against one md5 manifest and only mismatches are sent again.
+    Verified uploads are recorded in the run journal if one is given.
     """
 
     def transfer_file(filename):
         local_file_path = os.path.join(local_dir, filename).replace("\\", "/")
-        if os.path.isfile(local_file_path):
-            remote_molecule_dir = f"{remote_dir}/{filename}"
-
-            # Retry directory creation
-            for attempt in range(retries):
-                try:
-                    create_remote_directory(ssh, remote_molecule_dir)
-                    break  # Exit loop if successful
-                except Exception as e:
-                    print(
-                        f"Attempt {attempt + 1}: Could not create remote directory {remote_molecule_dir}. Exception: {e}")
-                    time.sleep(delay)
-                    if attempt == retries - 1:
-                        return  # Skip this file if all retries fail
-
-            remote_file_path = f"{remote_molecule_dir}/x"
-            print(f"Transferring file {local_file_path} to {remote_file_path}")
-
-            # Calculate local MD5 checksum
-            local_md5 = calculate_md5(local_file_path)
-
-            # Retry file transfer
-            for attempt in range(retries):
-                try:
-                    # Transfer file using SCPClient without the 'timeout' argument
-                    with SCPClient(ssh.get_transport()) as scp:
-                        scp.put(local_file_path, remote_path=remote_file_path)
-
-                    # Verify transfer completion
-                    if verify_remote_file(ssh, remote_file_path, local_md5):
-                        print(f"Successfully transferred and verified {local_file_path}")
-                        return  # Successful transfer, exit
-                    else:
-                        print(f"Warning: Verification failed for {local_file_path}. Transfer may be incomplete.")
-                except Exception as e:
-                    print(f"Attempt {attempt + 1}: Failed to transfer file {local_file_path}. Exception: {e}")
-                    time.sleep(delay)
-                    if attempt == retries - 1:
-                        print(f"Error: Could not transfer {local_file_path} after {retries} attempts.")
-                        return  # Skip this file if all retries fail
-
-    # Use ThreadPoolExecutor to transfer files in parallel
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_file = {executor.submit(transfer_file, filename): filename for filename in os.listdir(local_dir)}
-
-        # Monitor completion of the transfers
-        for future in as_completed(future_to_file):
-            filename = future_to_file[future]
-            try:
-                future.result()  # This will raise any exceptions that occurred during execution
-            except Exception as exc:
-                print(f"Error during transfer of {filename}: {exc}")
-
-
-def create_remote_script(molecule_names, remote_dir, template_path):
+        remote_file_path = f"{remote_dir}/{filename}/x"
+        print(f"Transferring file {local_file_path} to {remote_file_path}")
+        backend.put(local_file_path, remote_file_path)  # Verified later together with the other files
+        return os.path.getsize(local_file_path)
+
+    if filenames is None:
+        filenames = os.listdir(local_dir)
+    pending = [filename for filename in filenames if os.path.isfile(os.path.join(local_dir, filename))]
+    checksums = {f"{filename}/x": transfer_manifest.file_md5(os.path.join(local_dir, filename)) for filename in pending}
+    controller = transfer_concurrency.get_controller("coord uploads", maximum=constants.max_transfer_concurrency)
+    # The molecule folders are created in one batch up front instead of a channel per upload
+    create_remote_directories(ssh, [f"{remote_dir}/{filename}" for filename in pending])
+
+    # Worker threads share the transfer sessions, spread over transfer_connections connections
+    with file_transfer.open_transfer_backend(ssh, constants.transfer_backend,
+                                             connections=constants.transfer_connections) as backend:
+        for attempt in range(retries):
+            errors = transfer_concurrency.run_adaptive(controller, transfer_file, pending)
+            for filename, error in errors.items():
+                print(f"Error during transfer of {filename}: {error}")
+
+            # Verify the whole batch in one round trip
+            mismatched = transfer_manifest.verify_remote_files(
+                ssh, remote_dir, {f"{filename}/x": checksums[f"{filename}/x"] for filename in pending})
+            verified = [filename for filename in pending if f"{filename}/x" not in mismatched]
+            print(f"Verified {len(verified)}/{len(pending)} coord files against the upload manifest.")
+            if journal is not None and verified:
+                journal.mark(verified, run_journal.COORD_UPLOADED)
+
+            pending = [filename for filename in pending if f"{filename}/x" in mismatched]
+            if not pending:
+                return
+            print(f"Attempt {attempt + 1}: Verification failed for {len(pending)} coord files, sending only those again.")
+        print(f"Error: Could not transfer {len(pending)} coord files after {retries} attempts: {', '.join(pending)}")
+
+
+def create_remote_script(molecule_names, remote_dir, template_path, log_file=None):
     """
     Create a script to run "tx", "define", and "cosmoprep" in each directory based on a template.
     """
-    script_content = read_script(template_path)
-    log_file = f"{remote_dir}/run_tx.log"
+    if log_file is None:
+        log_file = f"{remote_dir}/run_tx.log"
+
+    # Collect the lines and join them once at the end
+    lines = [read_script(template_path).rstrip("\n")]
 
     # Initialize the log file
-    script_content += f"echo 'Starting run_tx.sh execution at $(date)' > {log_file}\n"
+    lines.append(f"echo 'Starting run_tx.sh execution at $(date)' > {log_file}")
 
     for mol_name in molecule_names:
         dirpath = f"{remote_dir}/{mol_name}"
-        script_content += f"cd {shlex.quote(dirpath)}\n"
+        lines.append(f"cd {shlex.quote(dirpath)}")
 
         # Add $chelp grid=3 to the control file
-        script_content += "if grep -q '$chelp' control; then\n"
-        script_content += "    sed -i '/$chelp/a\\    grid=3' control\n"
-        script_content += "else\n"
-        script_content += "    echo '$chelp' >> control\n"
-        script_content += "    echo '    grid=3' >> control\n"
-        script_content += "fi\n"
+        lines.append("if grep -q '$chelp' control; then")
+        lines.append("    sed -i '/$chelp/a\\    grid=3' control")
+        lines.append("else")
+        lines.append("    echo '$chelp' >> control")
+        lines.append("    echo '    grid=3' >> control")
+        lines.append("fi")
 
         # Log the start of processing for this molecule
-        script_content += f"echo 'Processing molecule: {mol_name}' >> {log_file}\n"
+        lines.append(f"echo 'Processing molecule: {mol_name}' >> {log_file}")
 
         # Execute tx command and log output
-        script_content += f"tx >> {log_file} 2>&1\n"
-        script_content += "if [ $? -eq 0 ]; then\n"
-        script_content += f"    echo '{mol_name}: tx Pass' >> {log_file}\n"
-
-        # Execute define script and log output
-        script_content += "    ./run_define.sh >> {log_file} 2>&1\n"
-        script_content += "    if [ $? -eq 0 ]; then\n"
-        script_content += f"        echo '{mol_name}: define Pass' >> {log_file}\n"
-        script_content += "    else\n"
-        script_content += f"        echo '{mol_name}: define failed' >> {log_file}\n"
-        script_content += "    fi\n"
-
-        # Execute cosmoprep script and log output
-        script_content += "    ./run_cosmoprep.sh >> {log_file} 2>&1\n"
-        script_content += "    if [ $? -eq 0 ]; then\n"
-        script_content += f"        echo '{mol_name}: cosmoprep Pass' >> {log_file}\n"
-        script_content += "    else\n"
-        script_content += f"        echo '{mol_name}: cosmoprep failed' >> {log_file}\n"
-        script_content += "    fi\n"
+        lines.append(f"tx >> {log_file} 2>&1")
+        lines.append("if [ $? -eq 0 ]; then")
+        lines.append(f"    echo '{mol_name}: tx Pass' >> {log_file}")
+
+        # Execute define script, keeping its output out of the log so it cannot be mistaken for a status line
+        lines.append("    ./run_define.sh > define.log 2>&1")
+        lines.append("    if [ $? -eq 0 ]; then")
+        lines.append(f"        echo '{mol_name}: define Pass' >> {log_file}")
+        lines.append("    else")
+        lines.append(f"        echo '{mol_name}: define failed' >> {log_file}")
+        lines.append("    fi")
+
+        # Execute cosmoprep script
+        lines.append("    ./run_cosmoprep.sh > cosmoprep.log 2>&1")
+        lines.append("    if [ $? -eq 0 ]; then")
+        lines.append(f"        echo '{mol_name}: cosmoprep Pass' >> {log_file}")
+        lines.append("    else")
+        lines.append(f"        echo '{mol_name}: cosmoprep failed' >> {log_file}")
+        lines.append("    fi")
 
         # Close the if for tx command
-        script_content += "else\n"
-        script_content += f"    echo '{mol_name}: tx failed' >> {log_file}\n"
-        script_content += "fi\n"
+        lines.append("else")
+        lines.append(f"    echo '{mol_name}: tx failed' >> {log_file}")
+        lines.append("fi")
 
         # Go back to the previous directory
-        script_content += "cd -\n"
+        lines.append("cd -")
 
         # Add control file modification if needed
         if generate_cosmo_format_files:
-            script_content += f"sed -i 's|$cosmo_out file=out.ccf|$cosmo_out file={mol_name}.cosmo|' {remote_dir}/{mol_name}/control\n"
+            lines.append(f"sed -i 's|$cosmo_out file=out.ccf|$cosmo_out file={mol_name}.cosmo|' {remote_dir}/{mol_name}/control")
             print(f"Edited control file for {mol_name} to output cosmo files.")
         else:
             print(f"Warning: {mol_name} will generate a .ccf format file. Subsequent scripts may not work correctly.\n")
 
     # Log the completion of the script
-    script_content += f"echo 'Completed run_tx.sh execution at $(date)' >> {log_file}\n"
+    lines.append(f"echo 'Completed run_tx.sh execution at $(date)' >> {log_file}")
+
+    return "\n".join(lines) + "\n"
 
-    return script_content
+
+def create_runner_script(remote_dir, template_path):
+    """
+    Create the shared run_tx.sh, which runs tx, define and cosmoprep for every molecule listed in a manifest.
+    Usage on the remote server: bash run_tx.sh <manifest> <log file>
+    """
+    body = RUNNER_SCRIPT_BODY.replace("__REMOTE_DIR__", shlex.quote(remote_dir))
+    body = body.replace("__TEMPLATES_DIR__", TEMPLATES_DIR_NAME)
+    if generate_cosmo_format_files:
+        body = body.replace("__COSMO_OUTPUT__", COSMO_OUTPUT_LINE)
+    else:
+        print("Warning: molecules will generate a .ccf format file. Subsequent scripts may not work correctly.\n")
+        body = body.replace("__COSMO_OUTPUT__", "")
+    return read_script(template_path).rstrip("\n") + "\n" + body
+
+
+def define_template_name(charge, is_optimized):
+    """Name of the shared define script for one charge class."""
+    return f"run_{'go_define' if is_optimized else 'define'}_{charge}.sh"
+
+
+def shared_template_files(charges, define_script, go_define_script, cosmoprep_script, subscript_template_content,
+                          include_common=True):
+    """
+    Return {path relative to the remote temp directory: (content, mode)} of the shared templates for the given
+    charge classes, plus the charge independent scripts if include_common is set.
+    """
+    templates = {}
+    for charge in charges:
+        for is_optimized, content in ((False, define_script), (True, go_define_script)):
+            templates[f"{TEMPLATES_DIR_NAME}/{define_template_name(charge, is_optimized)}"] = \
+                (content.replace("{charge}", charge), 0o755)
+    if include_common:
+        templates[f"{TEMPLATES_DIR_NAME}/run_cosmoprep.sh"] = (cosmoprep_script, 0o755)
+        templates[f"{TEMPLATES_DIR_NAME}/subscript"] = (create_shared_subscript(subscript_template_content), 0o755)
+        templates[f"{TEMPLATES_DIR_NAME}/run_tx.sh"] = \
+            (create_runner_script(remote_temp_dir, remote_script_template_path), 0o755)
+    return templates
+
+
+def deploy_shared_templates(ssh, molecule_names, define_script, go_define_script, cosmoprep_script,
+                            subscript_template_content, retries=3):
+    """
+    Upload the shared templates for every charge class among molecule_names that this run has not deployed yet.
+    Returns True once they are all on the remote server and verified.
+    """
+    charges = {extract_charge_from_name(mol_name) for mol_name in molecule_names} - _deployed_template_charges
+    include_common = not _deployed_template_charges
+    if not charges and not include_common:
+        return True
+
+    templates = shared_template_files(charges, define_script, go_define_script, cosmoprep_script,
+                                      subscript_template_content, include_common=include_common)
+    for attempt in range(retries):
+        stream_tar_upload(ssh, remote_temp_dir, templates)
+        mismatched = transfer_manifest.verify_remote_files(
+            ssh, remote_temp_dir, {path: transfer_manifest.content_md5(content) for path, (content, mode) in templates.items()})
+        if not mismatched:
+            _deployed_template_charges.update(charges)
+            print(f"Deployed shared templates for charge classes: {', '.join(sorted(charges)) or 'none new'}")
+            return True
+        print(f"Attempt {attempt + 1}: Verification failed for shared templates {', '.join(sorted(mismatched))}")
+        templates = {path: templates[path] for path in mismatched}
+    print(f"Error: Could not deploy the shared templates after {retries} attempts.")
+    return False
+
+
+def create_runner_manifest(molecule_names, optimize_flags):
+    """
+    Create the manifest run_tx.sh loops over: one "molecule define_script" line per molecule.
+    """
+    return "".join(f"{mol_name} {define_template_name(extract_charge_from_name(mol_name), optimize_flags.get(mol_name, False))}\n"
+                   for mol_name in molecule_names)
 
 
 def create_define_script(define_script_path):
@@ -375,149 +501,450 @@ def create_subscript(mol_name, subscript_template_content):
     """
     Create a subscript file for the server based on a template content.
     """
-    return subscript_template_content.replace("{mol_name}", mol_name)
+    return harvest_results.add_completion_marker(subscript_template_content.replace("{mol_name}", mol_name))
 
 
 
-def transfer_script_files(
+def molecule_script_files(mol_name, is_optimized, define_script, go_define_script, cosmoprep_script,
+                          subscript_template_content):
+    """
+    Return {file name: content} of the run_define.sh, run_cosmoprep.sh and subscript for one molecule.
+    """
+    # Choose the content for run_define.sh based on optimization criteria
+    selected_define_content = go_define_script if is_optimized else define_script
+
+    # Replace {charge} in selected_define_content with the charge from mol_name
+    selected_define_content = selected_define_content.replace("{charge}", extract_charge_from_name(mol_name))
+
+    return {
+        "run_define.sh": selected_define_content,
+        "run_cosmoprep.sh": cosmoprep_script,
+        "subscript": create_subscript(mol_name, subscript_template_content)
+    }
+
+
+def add_tar_member(tar, name, content, mode=0o644):
+    """Add an in-memory file to a tar stream."""
+    data = content if isinstance(content, bytes) else content.encode('utf-8')
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+
+def stream_tar_upload(ssh, remote_dir, files):
+    """
+    Stream {relative path: (content, mode)} as one tar over a single channel into tar -x in remote_dir.
+    Returns True if the remote tar exited cleanly.
+    """
+    stdin, stdout, stderr = ssh.exec_command(f"mkdir -p {shlex.quote(remote_dir)} && "
+                                             f"tar -x -m -C {shlex.quote(remote_dir)} -f -")
+    with tarfile.open(fileobj=stdin, mode="w|") as tar:
+        for relative_path, (content, mode) in files.items():
+            add_tar_member(tar, relative_path, content, mode)
+    stdin.channel.shutdown_write()  # Send EOF so the remote tar finishes
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+        print(f"Warning: remote tar exited with status {exit_status}: {stderr.read().decode().strip()}")
+    return exit_status == 0
+
+
+def bulk_upload_molecules(
     molecule_names,
+    coord_files_dir,
     define_script,
     go_define_script,
     cosmoprep_script,
-    subscript_template_content,  # Now correctly expects content
+    subscript_template_content,
     remote_dir,
     ssh,
-    geometry_optimize_percentage,
-    percent_enabled,
-    max_workers=3,
+    optimize_flags,
     retries=3,
-    delay=5,
-    task_delay=0.1
+    include_scripts=True,
+    journal=None
 ):
-    # Function to extract molecule name and numeric suffix for grouping and sorting
-    def extract_molecule_base_and_suffix(molecule_name):
-        match = re.match(r"(.+?)_(\d+)$", molecule_name)
-        base_name = match.group(1) if match else molecule_name
-        suffix = int(match.group(2)) if match else float('inf')
-        return base_name, suffix
+    """
+    Upload every molecule's coord file and scripts as one tar stream, verify them with one manifest,
+    and re-send only the molecules with missing or mismatched files. With include_scripts off only the
+    coord files are sent, for runs that use the shared templates.
+    Returns the names of the molecules that could not be uploaded.
+    """
+    pending = list(molecule_names)
+    for attempt in range(retries):
+        files = {}
+        for mol_name in pending:
+            with open(os.path.join(coord_files_dir, mol_name), 'r') as coord_file:
+                files[f"{mol_name}/x"] = (coord_file.read(), 0o644)
+            if not include_scripts:
+                continue
+            script_files = molecule_script_files(mol_name, optimize_flags.get(mol_name, False), define_script,
+                                                 go_define_script, cosmoprep_script, subscript_template_content)
+            for file_name, content in script_files.items():
+                files[f"{mol_name}/{file_name}"] = (content, 0o755)
+
+        print(f"Streaming {len(files)} files for {len(pending)} molecules to {remote_dir} as one tar...")
+        start_time = time.time()
+        stream_tar_upload(ssh, remote_dir, files)
+        mismatched = transfer_manifest.verify_remote_files(
+            ssh, remote_dir, {path: transfer_manifest.content_md5(content) for path, (content, mode) in files.items()})
+        print(f"Uploaded and verified {len(files) - len(mismatched)}/{len(files)} files in {time.time() - start_time:.1f} s.")
+
+        failed = sorted({relative_path.split("/")[0] for relative_path in mismatched})
+        uploaded = [mol_name for mol_name in pending if mol_name not in failed]
+        if journal is not None and uploaded:
+            journal.mark(uploaded, run_journal.COORD_UPLOADED)
+            if include_scripts:
+                journal.mark(uploaded, run_journal.SCRIPTS_UPLOADED)
+        if not failed:
+            return []
+        print(f"Attempt {attempt + 1}: {len(failed)} molecules failed verification, re-sending only those.")
+        pending = failed
+    print(f"Error: Could not upload {len(pending)} molecules after {retries} attempts.")
+    return pending
+
+
+def extract_molecule_base_and_suffix(molecule_name):
+    """
+    Split a conformer name like "Water_3" into its molecule base name and numeric suffix.
+    """
+    match = re.match(r"(.+?)_(\d+)$", molecule_name)
+    base_name = match.group(1) if match else molecule_name
+    suffix = int(match.group(2)) if match else float('inf')
+    return base_name, suffix
+
 
+def assign_geometry_optimization(molecule_names, geometry_optimize_percentage, percent_enabled):
+    """
+    Return {conformer name: True if it gets go_define.sh}, optimizing the lowest-numbered
+    (lowest energy) percentage of each molecule's conformers.
+    """
     # Group molecule names by their base name and sort each group by suffix
     molecule_groups = defaultdict(list)
     for mol_name in molecule_names:
         base_name, suffix = extract_molecule_base_and_suffix(mol_name)
         molecule_groups[base_name].append((mol_name, suffix))
 
-    # Sort each molecule group by the numeric suffix
-    for base_name in molecule_groups:
-        molecule_groups[base_name].sort(key=lambda x: x[1])
-
-    def transfer_individual_script(mol_name, is_optimized):
-        # Choose the content for run_define.sh based on optimization criteria
-        selected_define_content = go_define_script if is_optimized else define_script
-
-        # Extract charge from mol_name
-        charge_value = extract_charge_from_name(mol_name)
-        # Replace {charge} in selected_define_content
-        selected_define_content = selected_define_content.replace("{charge}", charge_value)
-
-        # Remote paths for each script
-        remote_molecule_dir = f"{remote_dir}/{mol_name}"
-        remote_define_path = f"{remote_molecule_dir}/run_define.sh"
-        remote_cosmoprep_path = f"{remote_molecule_dir}/run_cosmoprep.sh"
-        remote_subscript_path = f"{remote_molecule_dir}/subscript"
-        subscript_content = create_subscript(mol_name, subscript_template_content)
-
-        # Ensure remote molecule directory exists
-        create_remote_directory(ssh, remote_molecule_dir)
-
-        # Function to transfer a single file with retries
-        def transfer_single_script(local_content, remote_path):
-            local_md5 = hashlib.md5(local_content.encode('utf-8')).hexdigest()
-            for attempt in range(retries):
-                try:
-                    with SCPClient(ssh.get_transport()) as scp:
-                        scp.putfo(io.StringIO(local_content), remote_path)
-                    if verify_remote_file(ssh, remote_path, local_md5):
-                        ssh.exec_command(f"chmod +x {shlex.quote(remote_path)}")
-                        return
-                    else:
-                        print(f"Warning: Verification failed for {remote_path}")
-                except Exception as e:
-                    print(f"Attempt {attempt + 1}: Failed to transfer {remote_path}. Exception: {e}")
-                    sleep(delay)
-            print(f"Error: Could not transfer {remote_path} after {retries} attempts.")
-
-        # Transfer each script
-        transfer_single_script(selected_define_content, remote_define_path)
-        transfer_single_script(cosmoprep_script, remote_cosmoprep_path)
-        transfer_single_script(subscript_content, remote_subscript_path)
+    optimize_flags = {}
+    for base_name, group in molecule_groups.items():
+        group.sort(key=lambda x: x[1])
+
+        # Determine the number to optimize for this group
+        if percent_enabled and geometry_optimize_percentage:
+            n_optimize = int(len(group) * geometry_optimize_percentage / 100)
+        else:
+            n_optimize = 0
+
+        for i, (mol_name, _) in enumerate(group):
+            optimize_flags[mol_name] = i < n_optimize
+    return optimize_flags
+
+
+def molecule_identity(mol):
+    """
+    Return the canonical SMILES (without explicit hydrogens) and formal charge of a conformer.
+    """
+    return Chem.MolToSmiles(Chem.RemoveHs(mol)), Chem.GetFormalCharge(mol)
+
+
+def current_templates_hash():
+    """
+    Hash the define/go_define/cosmoprep/subscript templates as they will be uploaded.
+    """
+    return results_cache.templates_hash(
+        [define_script_path, go_define_script_path, cosmoprep_script_path, subscript_template_path],
+        {"generate_cosmo_format_files": generate_cosmo_format_files}
+    )
+
+
+def run_fingerprint(geometry_optimize_percentage):
+    """
+    Identify a run by its conformer batch, templates, optimization setting and remote directory.
+    """
+    return results_cache.sha256_text("|".join([
+        results_cache.sha256_file(vconf_batch_sdf_path),
+        current_templates_hash(),
+        f"{geometry_optimize_percentage}:{percent_enabled}",
+        remote_temp_dir
+    ]))
+
+
+def forget_missing_remote_folders(ssh, journal):
+    """
+    Reset journal entries whose molecule folder is gone from the remote temp directory, so they are redone.
+    """
+    remote_folders = set(head_node_agent.entry_names(ssh, remote_temp_dir, folders_only=True))
+    missing = [name for name in journal.names() if name not in remote_folders]
+    if missing:
+        print(f"Run journal: {len(missing)} molecule folders are missing on the remote server and will be redone.")
+        journal.forget_remote_progress(missing)
+
+
+def skip_cached_conformers(molecule_names, identities, optimize_flags, merge_keys=False):
+    """
+    Record the cache key of every conformer and return only the ones without cached results.
+    """
+    settings = constants.default_vconf_settings if constants.use_default_vconf_settings else constants.experimental_vconf_settings
+    settings_hash = results_cache.vconf_settings_hash(settings)
+    template_hash = current_templates_hash()
+
+    cache = results_cache.open_cache(constants.compound_list_directory)
+    keys = {}
+    misses = []
+    try:
+        for mol_name in molecule_names:
+            canonical_smiles, charge = identities[mol_name]
+            _, conformer_index = extract_molecule_base_and_suffix(mol_name)
+            key = results_cache.conformer_key(canonical_smiles, charge, conformer_index, settings_hash,
+                                              template_hash, optimize_flags.get(mol_name, False))
+            keys[mol_name] = key
+            if not cache.contains(key):
+                misses.append(mol_name)
+    finally:
+        cache.close()
+
+    results_cache.save_run_keys(list_folder, keys, merge=merge_keys)
+    print(f"Results cache: {len(molecule_names) - len(misses)} conformers already computed, {len(misses)} left to submit.")
+    return misses
+
+
+def transfer_script_files(
+    molecule_names,
+    define_script,
+    go_define_script,
+    cosmoprep_script,
+    subscript_template_content,  # Now correctly expects content
+    remote_dir,
+    ssh,
+    geometry_optimize_percentage,
+    percent_enabled,
+    retries=3,
+    optimize_flags=None,
+    journal=None
+):
+    # Decide which conformers get the geometry optimizing define script, unless decided upstream
+    if optimize_flags is None:
+        optimize_flags = assign_geometry_optimization(molecule_names, geometry_optimize_percentage, percent_enabled)
+
+    def transfer_individual_script(mol_name):
+        is_optimized = optimize_flags.get(mol_name, False)
+        script_files = molecule_script_files(mol_name, is_optimized, define_script, go_define_script,
+                                             cosmoprep_script, subscript_template_content)
+
+        # Transfer each script into the molecule folder created up front, verified later together with the other files
+        for file_name in ("run_define.sh", "run_cosmoprep.sh", "subscript"):
+            backend.putfo(script_files[file_name], f"{remote_dir}/{mol_name}/{file_name}", mode=0o755)
 
         # Log the transferred script type
         print(f"Transferred {'go_define.sh' if is_optimized else 'define.sh'} content as run_define.sh for {mol_name}")
+        return sum(len(content) for content in script_files.values())
 
-    # Use ThreadPoolExecutor to process each molecule's scripts concurrently
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {}
+    # Expected checksums of every script, verified in one batch after each round of transfers
+    checksums = {}
+    for mol_name in molecule_names:
+        script_files = molecule_script_files(mol_name, optimize_flags.get(mol_name, False), define_script,
+                                             go_define_script, cosmoprep_script, subscript_template_content)
+        for file_name, content in script_files.items():
+            checksums[f"{mol_name}/{file_name}"] = transfer_manifest.content_md5(content)
+
+    pending = list(molecule_names)
+    controller = transfer_concurrency.get_controller("script uploads", maximum=constants.max_transfer_concurrency)
+    create_remote_directories(ssh, [f"{remote_dir}/{mol_name}" for mol_name in pending])
+    # Worker threads share the transfer sessions, spread over transfer_connections connections
+    with file_transfer.open_transfer_backend(ssh, constants.transfer_backend,
+                                             connections=constants.transfer_connections) as backend:
+        for attempt in range(retries):
+            errors = transfer_concurrency.run_adaptive(controller, transfer_individual_script, pending)
+            for mol_name, error in errors.items():
+                print(f"Error during script transfer for {mol_name}: {error}")
+
+            pending_set = set(pending)
+            mismatched = transfer_manifest.verify_remote_files(
+                ssh, remote_dir, {path: md5 for path, md5 in checksums.items() if path.split("/")[0] in pending_set})
+            failed = {path.split("/")[0] for path in mismatched}
+            verified = [mol_name for mol_name in pending if mol_name not in failed]
+            print(f"Verified scripts of {len(verified)}/{len(pending)} molecules against the upload manifest.")
+            if journal is not None and verified:
+                journal.mark(verified, run_journal.SCRIPTS_UPLOADED)
+
+            pending = [mol_name for mol_name in pending if mol_name in failed]
+            if not pending:
+                return
+            print(f"Attempt {attempt + 1}: Script verification failed for {len(pending)} molecules, sending only those again.")
+        print(f"Error: Could not transfer scripts for {len(pending)} molecules after {retries} attempts.")
+
+
+def get_geometry_optimize_percentage():
+    """
+    Return the percentage of conformers per molecule that get the geometry optimizing define script.
+    """
+    geometry_optimize_percentage = 0  # Default if conditions are not met
+    if percent_enabled and constants.geometry_optimize_lowest_energy_structures:
+        geometry_optimize_percentage = int(constants.geometry_optimize_lowest_energy_structures)
+    return geometry_optimize_percentage
 
-        # Iterate through each molecule group and apply optimization
-        for base_name, group in molecule_groups.items():
-            # Determine the number to optimize for this group
-            if percent_enabled and geometry_optimize_percentage:
-                n_optimize = int(len(group) * geometry_optimize_percentage / 100)
-            else:
-                n_optimize = 0
 
-            # Schedule transfers for each molecule in the group
-            for i, (mol_name, _) in enumerate(group):
-                is_optimized = i < n_optimize
-                futures[executor.submit(transfer_individual_script, mol_name, is_optimized)] = mol_name
+def run_remote_script(ssh, molecule_names, remote_script_path, remote_log_path, journal=None,
+                      optimize_flags=None, manifest_path=None):
+    """
+    Build, transfer and execute the tx/define/cosmoprep script for the given molecules, then report the log.
+    With shared templates, only a manifest is uploaded to manifest_path and the shared run_tx.sh loops over it.
+    Returns the names of the molecules that failed a step.
+    """
+    if journal is not None:
+        # These molecules are (re)run from tx onwards, so earlier passes no longer count
+        for step in PREPARATION_STEPS.values():
+            journal.mark(molecule_names, step, False)
+
+    if manifest_path is not None:
+        return run_shared_runner(ssh, molecule_names, manifest_path, remote_log_path, optimize_flags or {}, journal)
+
+    remote_script = create_remote_script(molecule_names, remote_temp_dir, remote_script_template_path,
+                                         log_file=remote_log_path)
+
+    with file_transfer.open_transfer_backend(ssh, constants.transfer_backend) as backend:
+        local_script_md5 = hashlib.md5(remote_script.encode('utf-8')).hexdigest()
+        backend.putfo(remote_script, remote_script_path, mode=0o755)
+        if verify_remote_file(ssh, remote_script_path, local_script_md5):
+            print(f"Successfully transferred and verified main script {remote_script_path}")
+        else:
+            print(f"Warning: Verification failed for main script {remote_script_path}.")
 
-        # Monitor completion of all futures
-        for future in as_completed(futures):
-            mol_name = futures[future]
-            try:
-                future.result()  # This will raise any exceptions from transfer_individual_script
-            except Exception as e:
-                print(f"Error during script transfer for {mol_name}: {e}")
-            # Add a slight delay to avoid opening too many connections at once
-            sleep(task_delay)
+    # Execute the main script on the remote server
+    print(f"Executing the main script on the remote server: {remote_script_path}")
+    stdin, stdout, stderr = ssh.exec_command(f"bash {remote_script_path}")
+    stdout.channel.recv_exit_status()  # Wait for the script to finish
 
+    return report_run_log(ssh, remote_log_path, journal)
 
-def main():
-    try:
-        print("Starting the cmdline_TMoleX_process script...")
 
-        # Verify if TMoleX file preparation is enabled
-        if not prepare_TMoleX_files_script:
-            print("cmdline_TMoleX_process.py is disabled")
-            return
+def run_shared_runner(ssh, molecule_names, manifest_path, remote_log_path, optimize_flags, journal=None):
+    """
+    Upload a manifest of the given molecules and run the shared run_tx.sh over it, then report the log.
+    Returns the names of the molecules that failed a step.
+    """
+    manifest = create_runner_manifest(molecule_names, optimize_flags)
+    remote_manifest_dir, manifest_name = manifest_path.rsplit("/", 1)
+    stream_tar_upload(ssh, remote_manifest_dir, {manifest_name: (manifest, 0o644)})
+    if transfer_manifest.verify_remote_files(ssh, remote_manifest_dir,
+                                             {manifest_name: transfer_manifest.content_md5(manifest)}):
+        print(f"Warning: Verification failed for runner manifest {manifest_path}.")
+    else:
+        print(f"Successfully transferred and verified runner manifest {manifest_path} ({len(molecule_names)} molecules)")
 
-        # Set geometry_optimize_percentage based on conditions
-        geometry_optimize_percentage = 0  # Default if conditions are not met
-        if percent_enabled and constants.geometry_optimize_lowest_energy_structures:
-            geometry_optimize_percentage = int(constants.geometry_optimize_lowest_energy_structures)
+    runner_path = f"{remote_temp_dir}/{TEMPLATES_DIR_NAME}/run_tx.sh"
+    print(f"Executing the shared runner on the remote server: {runner_path}")
+    stdin, stdout, stderr = ssh.exec_command(f"bash {runner_path} {shlex.quote(manifest_path)} {shlex.quote(remote_log_path)}")
+    stdout.channel.recv_exit_status()  # Wait for the runner to finish
 
-        # Debugging: print the geometry optimize percentage
-        print(f"Geometry Optimize Percentage: {geometry_optimize_percentage}")
+    return report_run_log(ssh, remote_log_path, journal)
 
-        # Set up SSH connection
-        print("Setting up SSH connection...")
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(server, port=port, username=username, password=password)
-        print("SSH connection established.")
 
-        # Clear remote directory
-        print(f"Clearing remote directory: {remote_temp_dir}")
-        clear_remote_directory(ssh, remote_temp_dir)
-        print("Remote directory cleared.")
+def report_run_log(ssh, remote_log_path, journal=None):
+    """
+    Fetch run_tx.log, record the passes in the run journal and print a summary.
+    Returns the names of the molecules that failed a step.
+    """
+    # Fetch and process the log content
+    print(f"Fetching logs from: {remote_log_path}")
+    stdin, stdout, stderr = ssh.exec_command(f"cat {remote_log_path}")
+    run_tx_log = stdout.read().decode('utf-8').strip().split("\n")
+
+    # Track pass/fail status
+    all_passed = True
+    failed_molecules = []
+
+    # Display the results for each molecule
+    for line in run_tx_log:
+        if journal is not None:
+            for marker, step in PREPARATION_STEPS.items():
+                if line.endswith(f": {marker}"):
+                    journal.mark(line.split(":")[0].strip(), step)
+        if "failed" in line:
+            print(line)  # Print only if there was a failure
+            all_passed = False
+            failed_molecules.append(line.split(":")[0].strip())
+        elif "Pass" in line:
+            if "define Pass" in line and "cosmoprep Pass" in line:
+                mol_name = line.split(":")[0].strip()
+                print(f"{mol_name}: Pass")
+
+    # Summary report
+    if all_passed:
+        print("\nAll molecules processed successfully.")
+    else:
+        print("\nSome molecules encountered errors:")
+        for mol_name in failed_molecules:
+            print(f" - {mol_name}")
 
-        # Convert SDF to individual molecule files
-        coord_files_dir = os.path.join(list_folder, "COORD_files").replace("\\", "/")
-        print(f"Converting SDF to files in: {coord_files_dir}")
-        sdf_to_files(vconf_batch_sdf_path, coord_files_dir)
-        print("SDF files converted successfully.")
+    return failed_molecules
 
+
+def prepare_molecules(ssh, molecule_names, coord_files_dir, geometry_optimize_percentage,
+                      remote_script_path=None, remote_log_path=None, optimize_flags=None, journal=None):
+    """
+    Upload coord files and scripts for the given molecules and run tx, define and cosmoprep on them.
+    With a run journal, only the steps it has not recorded yet are done.
+    """
+    # With shared templates the per-call runner input is a manifest next to where the script would have gone
+    shared_templates = constants.shared_remote_templates
+    if remote_script_path is None:
+        remote_script_path = f"{remote_temp_dir}/run_tx.sh"
+        manifest_path = f"{remote_temp_dir}/{TEMPLATES_DIR_NAME}/run_tx.manifest"
+    else:
+        manifest_path = f"{os.path.splitext(remote_script_path)[0]}.manifest"
+    if remote_log_path is None:
+        remote_log_path = f"{remote_temp_dir}/run_tx.log"
+
+    coord_names = molecule_names
+    script_names = molecule_names
+    if journal is not None:
+        coord_names = journal.pending(run_journal.COORD_UPLOADED, molecule_names)
+        script_names = journal.pending(run_journal.SCRIPTS_UPLOADED, molecule_names)
+        print(f"Run journal: {len(molecule_names) - len(coord_names)} coord files and "
+              f"{len(molecule_names) - len(script_names)} script sets already uploaded.")
+
+    # Create scripts from templates
+    print("Reading define and cosmoprep scripts...")
+    define_script_content = read_script(define_script_path)
+    go_define_script_content = read_script(go_define_script_path)
+    cosmoprep_script_content = read_script(cosmoprep_script_path)
+    subscript_template_content = read_script(subscript_template_path)  # Correct variable name
+    print("Scripts read successfully.")
+
+    if optimize_flags is None:
+        optimize_flags = assign_geometry_optimization(molecule_names, geometry_optimize_percentage, percent_enabled)
+
+    failed_uploads = []
+    if shared_templates:
+        # Every molecule uses the shared templates of its charge class, so only coord files go into its folder
+        if not deploy_shared_templates(ssh, molecule_names, define_script_content, go_define_script_content,
+                                       cosmoprep_script_content, subscript_template_content):
+            print("Error: Shared templates are missing on the remote server, skipping tx/define/cosmoprep.")
+            return list(molecule_names)
+        if journal is not None and script_names:
+            journal.mark(script_names, run_journal.SCRIPTS_UPLOADED)
+        script_names = []
+
+    if constants.bulk_tar_upload:
+        # One tar stream for the coord files and scripts instead of several round trips per file
+        upload_names = set(coord_names) | set(script_names)
+        upload_names = [mol_name for mol_name in molecule_names if mol_name in upload_names]
+        if upload_names:
+            failed_uploads = bulk_upload_molecules(
+                upload_names,
+                coord_files_dir,
+                define_script_content,
+                go_define_script_content,
+                cosmoprep_script_content,
+                subscript_template_content,
+                remote_temp_dir,
+                ssh,
+                optimize_flags,
+                include_scripts=not shared_templates,
+                journal=journal
+            )
+    else:
         # Transfer files to remote server
         print(f"Transferring files to remote directory: {remote_temp_dir}")
         transfer_files_to_remote(
@@ -525,95 +952,192 @@ def main():
             remote_temp_dir,
             ssh,
             geometry_optimize_percentage,  # Add geometry_optimize_percentage
-            percent_enabled  # Add percent_enabled
+            percent_enabled,  # Add percent_enabled
+            filenames=coord_names,
+            journal=journal
         )
         print("Coord files transferred successfully.")
 
-        # Create scripts from templates
-        print("Reading define and cosmoprep scripts...")
-        define_script_content = read_script(define_script_path)
-        go_define_script_content = read_script(go_define_script_path)
-        cosmoprep_script_content = read_script(cosmoprep_script_path)
-        subscript_template_content = read_script(subscript_template_path)  # Correct variable name
-        print("Scripts read successfully.")
+        # Batch transfer scripts to remote for each molecule
+        if script_names:
+            print(f"Transferring scripts (run_define.sh, run_cosmoprep.sh, subscript.sh) for each molecule...")
+            transfer_script_files(
+                script_names,
+                define_script_content,
+                go_define_script_content,
+                cosmoprep_script_content,
+                subscript_template_content,  # Use the content, not the path
+                remote_temp_dir,
+                ssh,
+                geometry_optimize_percentage,  # Pass the correct variable
+                percent_enabled,
+                optimize_flags=optimize_flags,
+                journal=journal
+            )
+            print("Scripts transferred successfully.")
+
+    if journal is not None:
+        # Only run tx/define/cosmoprep where every upload landed and the preparation has not passed yet
+        uploaded = journal.done(run_journal.COORD_UPLOADED, molecule_names) & \
+            journal.done(run_journal.SCRIPTS_UPLOADED, molecule_names)
+        prepared = set(molecule_names)
+        for step in PREPARATION_STEPS.values():
+            prepared &= journal.done(step, molecule_names)
+        failed_uploads = [mol_name for mol_name in molecule_names if mol_name not in uploaded]
+        for mol_name in failed_uploads:
+            print(f"{mol_name}: upload failed, it will be retried on the next run")
+        molecule_names = [mol_name for mol_name in molecule_names if mol_name in uploaded and mol_name not in prepared]
+        if not molecule_names:
+            print("Run journal: tx, define and cosmoprep already passed for every uploaded molecule.")
+            return failed_uploads
+    elif failed_uploads:
+        molecule_names = [mol_name for mol_name in molecule_names if mol_name not in failed_uploads]
+
+    # Create, transfer and run the main remote script
+    print("Creating and transferring main remote script...")
+    return failed_uploads + run_remote_script(ssh, molecule_names, remote_script_path, remote_log_path,
+                                              journal=journal, optimize_flags=optimize_flags,
+                                              manifest_path=manifest_path if shared_templates else None)
+
+
+def start_streaming_session(ssh):
+    """
+    Clear the remote temp directory and the local COORD_files folder before molecules start streaming in.
+    """
+    print(f"Clearing remote directory: {remote_temp_dir}")
+    clear_remote_directory(ssh, remote_temp_dir)
+    _deployed_template_charges.clear()
+    create_remote_directory(ssh, f"{remote_temp_dir}/{STREAM_DIR_NAME}")
+    if constants.use_results_cache:
+        results_cache.save_run_keys(list_folder, {})  # Keys are merged in molecule by molecule
+
+    # A streamed run always starts from scratch, since VConf is regenerating the conformers
+    journal = run_journal.open_journal(list_folder)
+    try:
+        journal.start_run(f"stream {datetime.now().isoformat(timespec='seconds')}")
+    finally:
+        journal.close()
+
+    coord_files_dir = os.path.join(list_folder, "COORD_files").replace("\\", "/")
+    if os.path.exists(coord_files_dir):
+        for file in os.listdir(coord_files_dir):
+            file_path = os.path.join(coord_files_dir, file)
+            if os.path.isfile(file_path):
+                os.unlink(file_path)
+    else:
+        os.makedirs(coord_files_dir)
+    return coord_files_dir
 
-        # List molecule names and calculate the number for optimization
-        molecule_names = [filename for filename in os.listdir(coord_files_dir) if
-                          os.path.isfile(os.path.join(coord_files_dir, filename))]
-        print(f"Found {len(molecule_names)} molecules to process.")
 
-        # Batch transfer scripts to remote for each molecule
-        print(f"Transferring scripts (run_define.sh, run_cosmoprep.sh, subscript.sh) for each molecule...")
-        transfer_script_files(
-            molecule_names,
-            define_script_content,
-            go_define_script_content,
-            cosmoprep_script_content,
-            subscript_template_content,  # Use the content, not the path
-            remote_temp_dir,
+def prepare_streamed_molecule(ssh, base_name, conformers, coord_files_dir):
+    """
+    Write coord files for one molecule's labelled conformers and prepare them on the remote server.
+    Returns the conformer names that are ready to be submitted.
+    """
+    conformer_names = []
+    identities = {}
+    for mol in conformers:
+        mol_name = mol.GetProp('_Name')
+        write_molecule_file(mol, mol_name, coord_files_dir)
+        conformer_names.append(mol_name)
+        identities[mol_name] = molecule_identity(mol)
+
+    geometry_optimize_percentage = get_geometry_optimize_percentage()
+    optimize_flags = assign_geometry_optimization(conformer_names, geometry_optimize_percentage, percent_enabled)
+    if constants.use_results_cache:
+        conformer_names = skip_cached_conformers(conformer_names, identities, optimize_flags, merge_keys=True)
+        if not conformer_names:
+            return []
+
+    # Per-molecule runner scripts live in a hidden folder so they are not mistaken for molecule folders
+    stream_dir = f"{remote_temp_dir}/{STREAM_DIR_NAME}"
+    journal = run_journal.open_journal(list_folder)
+    try:
+        journal.add_conformers(conformer_names)
+        failed_molecules = prepare_molecules(
             ssh,
-            geometry_optimize_percentage,  # Pass the correct variable
-            percent_enabled
+            conformer_names,
+            coord_files_dir,
+            geometry_optimize_percentage,
+            remote_script_path=f"{stream_dir}/run_tx_{base_name}.sh",
+            remote_log_path=f"{stream_dir}/run_tx_{base_name}.log",
+            optimize_flags=optimize_flags,
+            journal=journal
         )
-        print("Scripts transferred successfully.")
+    finally:
+        journal.close()
+    return [mol_name for mol_name in conformer_names if mol_name not in failed_molecules]
 
-        # Create and transfer the main remote script
-        print("Creating and transferring main remote script...")
-        remote_script = create_remote_script(molecule_names, remote_temp_dir, remote_script_template_path)
-        remote_script_path = f"{remote_temp_dir}/run_tx.sh"
 
-        with SCPClient(ssh.get_transport()) as scp:
-            local_script_md5 = hashlib.md5(remote_script.encode('utf-8')).hexdigest()
-            scp.putfo(io.StringIO(remote_script), remote_script_path)
-            if verify_remote_file(ssh, remote_script_path, local_script_md5):
-                print(f"Successfully transferred and verified main script {remote_script_path}")
-            else:
-                print(f"Warning: Verification failed for main script {remote_script_path}.")
+def main():
+    try:
+        print("Starting the cmdline_TMoleX_process script...")
 
-        # Ensure the main script has executable permissions
-        print(f"Setting executable permissions for {remote_script_path}...")
-        ssh.exec_command(f"chmod +x {remote_script_path}")
+        # Verify if TMoleX file preparation is enabled
+        if not prepare_TMoleX_files_script:
+            print("cmdline_TMoleX_process.py is disabled")
+            return
 
-        # Execute the main script on the remote server
-        print(f"Executing the main script on the remote server: {remote_script_path}")
-        stdin, stdout, stderr = ssh.exec_command(f"bash {remote_script_path}")
-        stdout.channel.recv_exit_status()  # Wait for the script to finish
+        # Molecules were already prepared one by one while VConf was running
+        if constants.stream_conformers_to_cluster and constants.generate_conformers_using_vconf_script:
+            print("Molecules were prepared on the remote server as VConf finished them (stream_conformers_to_cluster).")
+            return
 
-        # Fetch and process run_tx.log content
-        remote_log_path = f"{remote_temp_dir}/run_tx.log"
-        print(f"Fetching logs from: {remote_log_path}")
-        stdin, stdout, stderr = ssh.exec_command(f"cat {remote_log_path}")
-        run_tx_log = stdout.read().decode('utf-8').strip().split("\n")
-
-        # Track pass/fail status
-        all_passed = True
-        failed_molecules = []
-
-        # Display the results for each molecule
-        for line in run_tx_log:
-            if "failed" in line:
-                print(line)  # Print only if there was a failure
-                all_passed = False
-                failed_molecules.append(line.split(":")[0].strip())
-            elif "Pass" in line:
-                if "define Pass" in line and "cosmoprep Pass" in line:
-                    mol_name = line.split(":")[0].strip()
-                    print(f"{mol_name}: Pass")
-
-        # Summary report
-        if all_passed:
-            print("\nAll molecules processed successfully.")
+        # Set geometry_optimize_percentage based on conditions
+        geometry_optimize_percentage = get_geometry_optimize_percentage()
+
+        # Debugging: print the geometry optimize percentage
+        print(f"Geometry Optimize Percentage: {geometry_optimize_percentage}")
+
+        # Reuse the shared SSH connection
+        print("Setting up SSH connection...")
+        ssh = get_ssh_client(server, port, username, password)
+        print("SSH connection established.")
+
+        # Resume an interrupted run of the same batch, or clear the remote directory and start over
+        journal = run_journal.open_journal(list_folder)
+        fingerprint = run_fingerprint(geometry_optimize_percentage)
+        if constants.resume_from_journal and journal.matches(fingerprint):
+            print(f"Resuming the previous run from the run journal: {journal.summary()}")
+            forget_missing_remote_folders(ssh, journal)
         else:
-            print("\nSome molecules encountered errors:")
-            for mol_name in failed_molecules:
-                print(f" - {mol_name}")
+            print(f"Clearing remote directory: {remote_temp_dir}")
+            clear_remote_directory(ssh, remote_temp_dir)
+            print("Remote directory cleared.")
+            journal.start_run(fingerprint)
+
+        # Convert SDF to individual molecule files
+        coord_files_dir = os.path.join(list_folder, "COORD_files").replace("\\", "/")
+        print(f"Converting SDF to files in: {coord_files_dir}")
+        identities = sdf_to_files(vconf_batch_sdf_path, coord_files_dir)
+        print("SDF files converted successfully.")
 
-        ssh.close()
+        # List molecule names and calculate the number for optimization
+        molecule_names = [filename for filename in os.listdir(coord_files_dir) if
+                          os.path.isfile(os.path.join(coord_files_dir, filename))]
+        print(f"Found {len(molecule_names)} molecules to process.")
+        optimize_flags = assign_geometry_optimization(molecule_names, geometry_optimize_percentage, percent_enabled)
+
+        # Only send conformers without cached results to the cluster
+        if constants.use_results_cache:
+            molecule_names = skip_cached_conformers(molecule_names, identities, optimize_flags)
+            if not molecule_names:
+                print("Every conformer is already in the results cache. Nothing to prepare.")
+                journal.close()
+                return
+        elif os.path.exists(results_cache.run_keys_path(list_folder)):
+            os.remove(results_cache.run_keys_path(list_folder))  # Stale keys from an earlier cached run
+
+        try:
+            journal.add_conformers(molecule_names)
+            prepare_molecules(ssh, molecule_names, coord_files_dir, geometry_optimize_percentage,
+                              optimize_flags=optimize_flags, journal=journal)
+            print(f"Run journal: {journal.summary()}")
+        finally:
+            journal.close()
 
     except Exception as e:
         print(f"An error occurred: {e}")
-        if 'ssh' in locals():
-            ssh.close()
         print("Exiting script due to error.")
 
 
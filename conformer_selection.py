@@ -0,0 +1,93 @@
+import numpy as np
+
+# Conformer pairs aligned per NumPy call; bounds the temporary (pairs x 3 x 3) arrays of pairwise_rmsd
+RMSD_BLOCK_PAIRS = 250000
+
+# Only this many of the lowest energy conformers in the window are clustered, keeping the RMSD matrix small
+MAX_CLUSTERED_CONFORMERS = 2000
+
+# Iterations of the k-medoids assignment/update loop
+MAX_KMEDOIDS_ITERATIONS = 100
+
+
+def pairwise_rmsd(coordinates):
+    """
+    All-against-all RMSD (Å) of conformers after optimal superposition (Kabsch), as an (n, n) float32 array.
+    The pairs are aligned at once with batched NumPy SVDs, in row blocks of the upper triangle to bound
+    the memory in use. Atoms are matched by index, so the conformers must come from the same molecule file.
+    """
+    coordinates = coordinates - coordinates.mean(axis=1, keepdims=True)
+    count, atom_count, _ = coordinates.shape
+    squared_norms = np.einsum('nai,nai->n', coordinates, coordinates)
+    rmsd = np.zeros((count, count), dtype=np.float32)
+    block_size = max(1, RMSD_BLOCK_PAIRS // count)
+    for start in range(0, count, block_size):
+        end = min(start + block_size, count)
+        covariance = np.einsum('bai,naj->bnij', coordinates[start:end], coordinates[start:], optimize=True)
+        singular_values = np.linalg.svd(covariance, compute_uv=False)
+        # A reflection is not a valid superposition; flip the smallest singular value instead
+        singular_values[..., 2] *= np.sign(np.linalg.det(covariance))
+        squared_deviation = (squared_norms[start:end, None] + squared_norms[None, start:]
+                             - 2 * singular_values.sum(axis=-1)) / atom_count
+        rmsd[start:end, start:] = np.sqrt(np.clip(squared_deviation, 0, None))
+    rmsd = np.maximum(rmsd, rmsd.T)  # Mirror the upper triangle
+    np.fill_diagonal(rmsd, 0)
+    return rmsd
+
+
+def k_medoids(distances, k, first=0):
+    """
+    Cluster points with the given distance matrix into k groups and return each point's cluster label.
+    Medoids start from `first` and are spread by farthest point selection, then assignment and medoid
+    update alternate until nothing changes.
+    """
+    medoids = [first]
+    nearest = distances[first].copy()
+    while len(medoids) < k:
+        medoids.append(int(np.argmax(nearest)))
+        np.minimum(nearest, distances[medoids[-1]], out=nearest)
+    medoids = np.array(medoids)
+
+    for _ in range(MAX_KMEDOIDS_ITERATIONS):
+        labels = np.argmin(distances[:, medoids], axis=1)
+        updated = medoids.copy()
+        for cluster in range(k):
+            members = np.flatnonzero(labels == cluster)
+            if len(members):
+                updated[cluster] = members[np.argmin(distances[np.ix_(members, members)].sum(axis=1))]
+        if np.array_equal(updated, medoids):
+            break
+        medoids = updated
+    return np.argmin(distances[:, medoids], axis=1)
+
+
+def select_diverse_conformers(energies, k, energy_window, load_coordinates):
+    """
+    Pick up to k structurally distinct, low energy conformers of one molecule and return their indices,
+    lowest energy first. load_coordinates(indices) returns the heavy atom coordinates ((n atoms, 3), or None
+    if unreadable) of the given conformers, so only the conformers that get clustered have to be read.
+
+    Conformers more than energy_window kcal/mol above the lowest are dropped. The rest are clustered into
+    k groups by heavy atom RMSD (k-medoids) and the lowest energy member of every group is kept, so the
+    global minimum is always selected and near duplicates share one slot instead of crowding out distinct
+    shapes.
+    """
+    order = sorted(range(len(energies)), key=lambda index: energies[index])
+    if not order:
+        return []
+    lowest_energy = energies[order[0]]
+    candidates = [index for index in order if energies[index] - lowest_energy <= energy_window]
+    candidates = candidates[:MAX_CLUSTERED_CONFORMERS]
+    if len(candidates) <= k:
+        return candidates
+
+    coordinates = load_coordinates(candidates)
+    if any(block is None for block in coordinates) or len({np.shape(block) for block in coordinates}) != 1:
+        print("Conformers do not share the same readable atoms; keeping the lowest energy ones instead.")
+        return candidates[:k]
+
+    labels = k_medoids(pairwise_rmsd(np.array(coordinates, dtype=float)), k)
+    representatives = {}
+    for position, label in enumerate(labels):  # candidates are sorted by energy, so the first member is the lowest
+        representatives.setdefault(label, candidates[position])
+    return sorted(representatives.values(), key=lambda index: energies[index])
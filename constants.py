@@ -14,17 +14,30 @@ identifier_override = ""
 generate_conformers_using_vconf_script = False
 max_conformers = "1000000000"
 step_sampling = False
+diversity_selection = False
+selection_energy_window = "10"
 use_default_vconf_settings = True
 skip_vconf_exe = False
+stream_conformers_to_cluster = False
+embedding_processes = "0"
+embedding_timeout = "120"
+vconf_processes = "1"
+use_rdkit_conformer_search = False
 
 # Variables for Preparing TMoleX Files on the Remote Server
 prepare_TMoleX_files_script = False
 generate_cosmo_format_files = True
 geometry_optimize_lowest_energy_structures = "100"
 percent_enabled = True
+use_results_cache = True
+resume_from_journal = True
+bulk_tar_upload = True
+shared_remote_templates = True
 
 # Variable for Submitting the Prepared TMoleX files to the Cluster
 submit_TMoleX_files_to_cluster_script = False
+submit_as_array_job = False
+array_job_max_concurrent_tasks = "0"
 
 # Variables for Checking the Cluster's Queue and Copying Files to a Timestamped Folder
 check_cluster_queue_script = False
@@ -32,12 +45,15 @@ copy_files_to_timestamped_folder = True
 gzip_timestamped_folder = False
 delete_temp_dir_after_transferring_to_timestamped_folder = True
 clean_temp_directory = True
+harvest_finished_jobs = True
 
 # Variables for Pulling Data from the Cluster
 grab_files_from_cluster_script = False
 timestamp_folder = ""
 pull_from_timestamped_folder = True
 only_transfer_cosmo_file = True
+bulk_tar_download = True
+compress_tar_download = False
 
 # Variables for Write New INP File Script
 write_new_inp_file_script = False
@@ -63,6 +79,9 @@ template_name = ""
 # Less Commonly Edited
 temp_dir = "temp_dir"
 port = 22
+transfer_backend = "sftp"
+transfer_connections = 3
+max_transfer_concurrency = 16
 
 # One and Done
 compound_list_directory = "Path to Compound_List in PyCharm"
@@ -46,22 +46,38 @@ tooltips = {
     "generate_conformers_using_vconf_script": "Enable or disable the VCONF script.",
     "max_conformers": "Maximum number of conformers you want in the final batchfile. Set absurdly high to avoid unintentionally limiting conformer counts.",
     "step_sampling": "Step sampling takes the total number of conformers for a specific molecule and divides it by the max conformers value. Not reccomended since it biases towards higher energy (less important) conformers.",
+    "diversity_selection": "Pick max_conformers structurally distinct conformers per molecule (k-medoids clustering on heavy atom RMSD, lowest energy member of each cluster) instead of the first max_conformers or every k-th one. Takes precedence over step_sampling.",
+    "selection_energy_window": "Energy window (kcal/mol) for diversity_selection: conformers more than this above the lowest energy conformer of a molecule are never selected.",
     "use_default_vconf_settings": "Enable to use default VCONF settings (from the VCONF settings tab).",
     "skip_vconf_exe": "Skip running vconf.exe and only process '_conf' files. Use this to prevent overwriting existing VCONF search results.",
+    "stream_conformers_to_cluster": "Prepare and submit each molecule on the cluster as soon as VConf finishes its conformers, instead of waiting for the whole list. Needs prepare_TMoleX_files_script enabled; jobs are only submitted if submit_TMoleX_files_to_cluster_script is enabled too.",
+    "embedding_processes": "Number of processes that build the 3D structures from the TSV SMILES at the same time. 0 uses one per CPU core.",
+    "embedding_timeout": "Seconds a single molecule may take to embed before it is skipped, so one pathological structure cannot stall the whole list.",
+    "vconf_processes": "Number of VConf processes to run at once. 1 runs a single VConf over the whole list; 0 uses one per core, splitting the list into ranges balanced by rotatable bond count.",
+    "use_rdkit_conformer_search": "Search conformers with RDKit (ETKDG on all threads, MMFF94 or UFF minimization) instead of vconf.exe, e.g. on Linux. ENERGY_CUTOFF, ENERGY_TOLERANCE and DISTANCE_TOLERANCE of the VConf settings still apply.",
     "prepare_TMoleX_files_script": "Enable or disable the TMoleX file preparation script.",
     "generate_cosmo_format_files": "Generate COSMO format files. Highly recommended for COSMOthermX19.",
     "geometry_optimize_lowest_energy_structures": "Geometry Optimize this percent OR number of lowest energy structures. (See percent_enabled).",
     "percent_enabled": "Enable this to geometry optimize a PERCENT of the total conformers for each molecule, Disable this to optimize a NUMBER of lowest energy conformers.",
+    "use_results_cache": "Reuse finished .cosmo/energy/control results from the local results cache (compound_list_directory/results_cache). Conformers already computed with the same structure, charge, VConf settings and templates are not sent to the cluster again.",
+    "resume_from_journal": "Keep a per-conformer run journal (run_journal.sqlite in the list folder) and resume an interrupted run of the same conformer batch instead of clearing the remote directory. Only the uploads, preparation steps, submissions and downloads that did not finish are redone. Disable to always start over.",
+    "bulk_tar_upload": "Upload every coord file and script as one tar stream over a single SSH channel and verify them with one md5 manifest, instead of separate mkdir, scp, md5sum and chmod calls per file. Disable to fall back to the file-by-file upload.",
+    "shared_remote_templates": "Upload define/go_define/cosmoprep once per charge class and one shared subscript and run_tx.sh into a hidden .templates folder, instead of copying run_define.sh, run_cosmoprep.sh and subscript into every conformer folder. run_tx.sh loops over a small manifest of molecules. Disable to use per-conformer script copies.",
     "submit_TMoleX_files_to_cluster_script": "Enable this to submit your files to be calculated on the remote cluster nodes.",
+    "submit_as_array_job": "Submit all molecules as one SGE array job (qsub -t 1-N) instead of one qsub per molecule. Each task picks its molecule folder from an index file using SGE_TASK_ID. Much faster to submit and much lighter on the scheduler.",
+    "array_job_max_concurrent_tasks": "Maximum number of array tasks allowed to run at the same time (qsub -tc). 0 means no limit.",
     "check_cluster_queue_script": "Enable or disable the cluster queue check script. Leave all settings disabled to only monitor the queue. All settings below will run only after the queue is finished.",
     "copy_files_to_timestamped_folder": "Copy files to a timestamped folder.",
     "clean_temp_directory": "Deletes specified unwanted files after computing. Edit allowed files by adding to the files_to_keep variable in dictionary.py.",
+    "harvest_finished_jobs": "Download each conformer's .cosmo and energy files as soon as its job finishes, while the rest of the queue is still running.",
     "gzip_timestamped_folder": "Gzip the timestamped folder to save space.",
     "delete_temp_dir_after_transferring_to_timestamped_folder": "Delete the temporary directory after transferring files. Be careful with large numbers of files as this may destroy your only backup.",
     "grab_files_from_cluster_script": "Enable or disable the file grabbing script for the remote server.",
     "timestamp_folder": "Specify the name of the timestamped folder. If left empty and pull_from_timestamped_folder is checked, the most recent timestamped folder will be used.",
     "pull_from_timestamped_folder": "Pull files from the timestamped folder.",
     "only_transfer_cosmo_file": "Only pulls the cosmo files from the remote server to save space on your local computer. Also reduces transferring time.",
+    "bulk_tar_download": "Download every result file through one remote tar stream instead of one SCP transfer per file.",
+    "compress_tar_download": "Gzip the bulk_tar_download stream. Helps on slow connections, costs CPU on the head node.",
     "write_new_inp_file_script": "Enable or disable the INP file writing script. INP files are readable with COSMOThermX19 and make importing conformer sets a breeze.",
     "extract_cosmo_files_to_cosmo_folder": "Extract COSMO files to the COSMO folder.",
     "write_inp_file": "Write the INP file.",
@@ -110,26 +126,42 @@ sub_variables = {
     "generate_conformers_using_vconf_script": {
         "max_conformers",
         "step_sampling",
+        "diversity_selection",
+        "selection_energy_window",
         "use_default_vconf_settings",
-        "skip_vconf_exe"
+        "skip_vconf_exe",
+        "stream_conformers_to_cluster",
+        "embedding_processes",
+        "embedding_timeout",
+        "vconf_processes",
+        "use_rdkit_conformer_search"
     },
     "prepare_TMoleX_files_script": {
         "generate_cosmo_format_files",
         "geometry_optimize_lowest_energy_structures",
-        "percent_enabled"
+        "percent_enabled",
+        "use_results_cache",
+        "resume_from_journal",
+        "bulk_tar_upload",
+        "shared_remote_templates"
     },
     "submit_TMoleX_files_to_cluster_script": {
+        "submit_as_array_job",
+        "array_job_max_concurrent_tasks"
     },
     "check_cluster_queue_script": {
         "copy_files_to_timestamped_folder",
         "gzip_timestamped_folder",
         "delete_temp_dir_after_transferring_to_timestamped_folder",
-        "clean_temp_directory"
+        "clean_temp_directory",
+        "harvest_finished_jobs"
     },
     "grab_files_from_cluster_script": {
         "timestamp_folder",
         "pull_from_timestamped_folder",
-        "only_transfer_cosmo_file"
+        "only_transfer_cosmo_file",
+        "bulk_tar_download",
+        "compress_tar_download"
     },
     "write_new_inp_file_script": {
         "extract_cosmo_files_to_cosmo_folder",
@@ -188,21 +220,22 @@ sections = {
         "identifier_override"
     ],
     "Variables for VCONF Script": [
-        "generate_conformers_using_vconf_script", "max_conformers", "step_sampling",
-        "use_default_vconf_settings", "skip_vconf_exe"
+        "generate_conformers_using_vconf_script", "max_conformers", "step_sampling", "diversity_selection",
+        "selection_energy_window", "use_default_vconf_settings", "skip_vconf_exe", "stream_conformers_to_cluster", "embedding_processes",
+        "embedding_timeout", "vconf_processes", "use_rdkit_conformer_search"
     ],
     "Variables for Preparing TMoleX Files on the Remote Server": [
-        "prepare_TMoleX_files_script", "generate_cosmo_format_files", "geometry_optimize_lowest_energy_structures", "percent_enabled"
+        "prepare_TMoleX_files_script", "generate_cosmo_format_files", "geometry_optimize_lowest_energy_structures", "percent_enabled", "use_results_cache", "resume_from_journal", "bulk_tar_upload", "shared_remote_templates"
     ],
     "Variable for Submitting the Prepared TMoleX files to the Cluster": [
-        "submit_TMoleX_files_to_cluster_script"
+        "submit_TMoleX_files_to_cluster_script", "submit_as_array_job", "array_job_max_concurrent_tasks"
     ],
     "Variables for Checking the Cluster's Queue and Copying Files to a Timestamped Folder": [
         "check_cluster_queue_script", "copy_files_to_timestamped_folder", "gzip_timestamped_folder",
-        "delete_temp_dir_after_transferring_to_timestamped_folder", "clean_temp_directory"
+        "delete_temp_dir_after_transferring_to_timestamped_folder", "clean_temp_directory", "harvest_finished_jobs"
     ],
     "Variables for Pulling Data from the Cluster": [
-        "grab_files_from_cluster_script", "timestamp_folder", "pull_from_timestamped_folder", "only_transfer_cosmo_file"
+        "grab_files_from_cluster_script", "timestamp_folder", "pull_from_timestamped_folder", "only_transfer_cosmo_file", "bulk_tar_download", "compress_tar_download"
     ],
     "Variables for Write New INP File Script": [
         "write_new_inp_file_script", "extract_cosmo_files_to_cosmo_folder", "write_inp_file"
@@ -218,7 +251,8 @@ sections = {
         "list_folder_name", "template_name"
     ],
     "Less Commonly Edited": [
-        "temp_dir", "server", "port", "username", "password"
+        "temp_dir", "server", "port", "transfer_backend", "transfer_connections",
+        "max_transfer_concurrency", "username", "password"
     ],
     "One and Done": [
         "compound_list_directory", "vconf_path", "remote_directory", "path_to_python_scripts", "path_to_python_exe"
@@ -0,0 +1,341 @@
+import io
+import itertools
+import os
+import posixpath
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from scp import SCPClient
+from ssh_connection import get_client_pool
+import transfer_concurrency
+
+# Files kept open at once by SFTPBackend, so their reads and writes are in flight together
+PIPELINE_DEPTH = 32
+
+# Bytes copied at a time between local and remote files (paramiko's SFTP request size)
+COPY_CHUNK_SIZE = 32768
+
+
+class TransferBackend:
+    """
+    Interface for moving files between this machine and the head node.
+
+    put/putfo/get move one file. put_many/get_many move a batch and return the pairs that failed, and
+    stat_many returns {remote path: (size, mtime)} for the files that exist. Batches of single-file
+    transfers run as many at once as their transfer_concurrency controller allows.
+    """
+
+    name = "base"
+
+    def __init__(self, ssh):
+        self.ssh = ssh
+
+    def put(self, local_path, remote_path):
+        raise NotImplementedError
+
+    def putfo(self, content, remote_path, mode=None):
+        """Upload in-memory text or bytes, optionally setting the file mode (e.g. 0o755)."""
+        raise NotImplementedError
+
+    def get(self, remote_path, local_path):
+        raise NotImplementedError
+
+    def stat_many(self, remote_paths):
+        """Return {remote path: (size, mtime)} from one remote stat call."""
+        if not remote_paths:
+            return {}
+        stdin, stdout, stderr = self.ssh.exec_command("xargs -0 stat -c '%s %Y %n' -- 2>/dev/null")
+        stdin.write("\0".join(remote_paths).encode('utf-8'))
+        stdin.channel.shutdown_write()
+        output = stdout.read().decode()
+        stdout.channel.recv_exit_status()
+
+        attributes = {}
+        for line in output.splitlines():
+            parts = line.split(" ", 2)
+            if len(parts) == 3:
+                attributes[parts[2]] = (int(parts[0]), int(parts[1]))
+        return attributes
+
+    def put_many(self, pairs, controller=None, end_batch=True):
+        """
+        Upload [(local path, remote path)], returning the pairs that failed. end_batch=False leaves the
+        controller's window open for other batches running on it at the same time.
+        """
+        controller = controller or transfer_concurrency.get_controller(f"{self.name} uploads")
+        return self._run_many(self.put, pairs, controller, end_batch)
+
+    def get_many(self, pairs, controller=None, end_batch=True):
+        """Download [(remote path, local path)], returning the pairs that failed. end_batch as for put_many."""
+        controller = controller or transfer_concurrency.get_controller(f"{self.name} downloads")
+        return self._run_many(self.get, pairs, controller, end_batch)
+
+    def _run_many(self, transfer, pairs, controller, end_batch=True):
+        errors = transfer_concurrency.run_adaptive(controller, lambda pair: transfer(*pair), list(pairs),
+                                                   end_batch=end_batch)
+        for pair, error in errors.items():
+            print(f"Failed to transfer {pair[0]}: {error}")
+        return [pair for pair in pairs if pair in errors]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SCPBackend(TransferBackend):
+    """
+    The original transfer path: every file opens its own exec channel and scp process on the head node.
+    """
+
+    name = "scp"
+
+    def put(self, local_path, remote_path):
+        with SCPClient(self.ssh.get_transport()) as scp_client:
+            scp_client.put(local_path, remote_path=remote_path)
+
+    def putfo(self, content, remote_path, mode=None):
+        data = content if isinstance(content, bytes) else content.encode('utf-8')
+        with SCPClient(self.ssh.get_transport()) as scp_client:
+            scp_client.putfo(io.BytesIO(data), remote_path, mode=f"{mode:04o}" if mode else "0644")
+
+    def get(self, remote_path, local_path):
+        with SCPClient(self.ssh.get_transport()) as scp_client:
+            scp_client.get(remote_path, local_path=local_path)
+
+
+class SFTPBackend(TransferBackend):
+    """
+    Transfers over one SFTP session kept open for the backend's lifetime.
+
+    Batches run in groups of open files, as many as the transfer_concurrency controller has free slots
+    for (at most PIPELINE_DEPTH): downloads prefetch every open file so their read requests are in flight
+    together, uploads write pipelined and only wait for the acknowledgements when the files are closed.
+    Each file reports its time and size back to the controller, so the group size follows its limit.
+    File contents are streamed in COPY_CHUNK_SIZE pieces, the way putfo/getfo do, instead of being held in
+    memory whole. File sizes come from one directory listing per folder instead of a stat per file.
+    """
+
+    name = "sftp"
+
+    def __init__(self, ssh):
+        super().__init__(ssh)
+        self.sftp = ssh.open_sftp()
+
+    def put(self, local_path, remote_path):
+        self.sftp.put(local_path, remote_path)
+
+    def putfo(self, content, remote_path, mode=None):
+        data = content if isinstance(content, bytes) else content.encode('utf-8')
+        with self.sftp.open(remote_path, "wb") as remote_file:
+            remote_file.set_pipelined(True)
+            remote_file.write(data)
+        if mode:
+            self.sftp.chmod(remote_path, mode)
+
+    def get(self, remote_path, local_path):
+        if os.path.isdir(local_path):
+            local_path = os.path.join(local_path, posixpath.basename(remote_path))
+        self.sftp.get(remote_path, local_path)
+
+    def stat_many(self, remote_paths):
+        wanted = {}
+        for remote_path in remote_paths:
+            wanted.setdefault(posixpath.dirname(remote_path), set()).add(posixpath.basename(remote_path))
+
+        attributes = {}
+        for remote_dir, names in wanted.items():
+            try:
+                entries = self.sftp.listdir_attr(remote_dir)
+            except IOError:
+                continue
+            for entry in entries:
+                if entry.filename in names:
+                    attributes[posixpath.join(remote_dir, entry.filename)] = (entry.st_size, entry.st_mtime)
+        return attributes
+
+    def _acquire_group(self, controller, count):
+        """
+        Take controller slots for up to count files: wait for the first, then take only those that are free,
+        so threads striping over one controller never wait for slots while holding others.
+        """
+        tokens = [controller.acquire()]
+        while len(tokens) < count:
+            token = controller.acquire(blocking=False)
+            if token is None:
+                break
+            tokens.append(token)
+        return tokens
+
+    def get_many(self, pairs, controller=None, end_batch=True):
+        controller = controller or transfer_concurrency.get_controller(f"{self.name} downloads")
+        sizes = self.stat_many([remote_path for remote_path, _ in pairs])
+        failed = [pair for pair in pairs if pair[0] not in sizes]
+        for remote_path, _ in failed:
+            print(f"Failed to transfer {remote_path}: not found on the remote server")
+        pending = [pair for pair in pairs if pair[0] in sizes]
+
+        while pending:
+            tokens = self._acquire_group(controller, min(PIPELINE_DEPTH, len(pending)))
+            group, pending = pending[:len(tokens)], pending[len(tokens):]
+            started = time.monotonic()
+            opened = []
+            for (remote_path, local_path), token in zip(group, tokens):
+                try:
+                    remote_file = self.sftp.open(remote_path, "rb")
+                    remote_file.prefetch(sizes[remote_path][0])
+                    opened.append((remote_path, local_path, remote_file, token))
+                except Exception as e:
+                    controller.release(token, time.monotonic() - started)
+                    print(f"Failed to transfer {remote_path}: {e}")
+                    failed.append((remote_path, local_path))
+
+            for remote_path, local_path, remote_file, token in opened:
+                size = 0
+                try:
+                    target_path = local_path
+                    if os.path.isdir(local_path):
+                        target_path = os.path.join(local_path, posixpath.basename(remote_path))
+                    with remote_file, open(target_path, "wb") as local_file:
+                        shutil.copyfileobj(remote_file, local_file, COPY_CHUNK_SIZE)
+                    size = sizes[remote_path][0]
+                except Exception as e:
+                    print(f"Failed to transfer {remote_path}: {e}")
+                    failed.append((remote_path, local_path))
+                controller.release(token, time.monotonic() - started, size)
+        if end_batch:
+            controller.end_batch()
+        return failed
+
+    def put_many(self, pairs, controller=None, end_batch=True):
+        controller = controller or transfer_concurrency.get_controller(f"{self.name} uploads")
+        failed = []
+        pending = list(pairs)
+        while pending:
+            tokens = self._acquire_group(controller, min(PIPELINE_DEPTH, len(pending)))
+            group, pending = pending[:len(tokens)], pending[len(tokens):]
+            started = time.monotonic()
+            opened = []
+            for (local_path, remote_path), token in zip(group, tokens):
+                remote_file = None
+                try:
+                    remote_file = self.sftp.open(remote_path, "wb")
+                    remote_file.set_pipelined(True)
+                    with open(local_path, "rb") as local_file:
+                        shutil.copyfileobj(local_file, remote_file, COPY_CHUNK_SIZE)
+                    opened.append((local_path, remote_path, remote_file, token))
+                except Exception as e:
+                    if remote_file is not None:
+                        try:
+                            remote_file.close()
+                        except Exception:
+                            pass
+                    controller.release(token, time.monotonic() - started)
+                    print(f"Failed to transfer {local_path}: {e}")
+                    failed.append((local_path, remote_path))
+
+            # Closing waits for the acknowledgements of the pipelined writes of the whole group
+            for local_path, remote_path, remote_file, token in opened:
+                size = 0
+                try:
+                    remote_file.close()
+                    size = os.path.getsize(local_path)
+                except Exception as e:
+                    print(f"Failed to transfer {local_path}: {e}")
+                    failed.append((local_path, remote_path))
+                controller.release(token, time.monotonic() - started, size)
+        if end_batch:
+            controller.end_batch()
+        return failed
+
+    def close(self):
+        self.sftp.close()
+
+
+class StripedBackend(TransferBackend):
+    """
+    Spread transfers over several backends, each on its own SSH connection.
+
+    Batches are striped round robin, one thread per connection. Single-file calls go to the connections
+    in turn, so worker threads calling put/get are spread over them as well.
+    """
+
+    def __init__(self, backends):
+        super().__init__(backends[0].ssh)
+        self.backends = backends
+        self.name = f"{backends[0].name} x{len(backends)}"
+        self._turn = itertools.count()
+
+    def _next_backend(self):
+        return self.backends[next(self._turn) % len(self.backends)]
+
+    def put(self, local_path, remote_path):
+        self._next_backend().put(local_path, remote_path)
+
+    def putfo(self, content, remote_path, mode=None):
+        self._next_backend().putfo(content, remote_path, mode=mode)
+
+    def get(self, remote_path, local_path):
+        self._next_backend().get(remote_path, local_path)
+
+    def stat_many(self, remote_paths):
+        return self.backends[0].stat_many(remote_paths)
+
+    def _stripe(self, method_name, pairs, controller, end_batch):
+        # The stripes share one controller, so its limit counts the transfers on all connections together.
+        # None of them ends the batch, which would clear the window while the others are still transferring.
+        stripes = [pairs[i::len(self.backends)] for i in range(len(self.backends))]
+        with ThreadPoolExecutor(max_workers=len(self.backends)) as executor:
+            results = executor.map(lambda args: getattr(args[0], method_name)(args[1], controller, end_batch=False),
+                                   zip(self.backends, stripes))
+            failed = [pair for stripe_failed in results for pair in stripe_failed]
+        if end_batch:
+            controller.end_batch()
+            print(f"{controller.name}: {len(pairs)} transfers done at concurrency {controller.limit}")
+        return failed
+
+    def put_many(self, pairs, controller=None, end_batch=True):
+        controller = controller or transfer_concurrency.get_controller(f"{self.backends[0].name} uploads")
+        return self._stripe("put_many", pairs, controller, end_batch)
+
+    def get_many(self, pairs, controller=None, end_batch=True):
+        controller = controller or transfer_concurrency.get_controller(f"{self.backends[0].name} downloads")
+        return self._stripe("get_many", pairs, controller, end_batch)
+
+    def close(self):
+        for backend in self.backends:
+            backend.close()
+
+
+BACKENDS = {SFTPBackend.name: SFTPBackend, SCPBackend.name: SCPBackend}
+
+
+def open_transfer_backend(ssh, backend_name="sftp", connections=1):
+    """
+    Open the named transfer backend, striped over `connections` independent SSH connections when more
+    than one is asked for.
+    """
+    backends = [open_single_backend(client, backend_name) for client in get_client_pool(ssh, connections)]
+    return backends[0] if len(backends) == 1 else StripedBackend(backends)
+
+
+def open_single_backend(ssh, backend_name="sftp"):
+    """
+    Open the named transfer backend on one SSH client. Falls back to SCP if the name is unknown or the
+    head node does not offer the SFTP subsystem.
+    """
+    backend_class = BACKENDS.get(str(backend_name).lower())
+    if backend_class is None:
+        print(f"Unknown transfer_backend '{backend_name}', using scp.")
+        return SCPBackend(ssh)
+    try:
+        return backend_class(ssh)
+    except Exception as e:
+        if backend_class is SCPBackend:
+            raise
+        print(f"Could not open an SFTP session ({e}), falling back to scp.")
+        return SCPBackend(ssh)
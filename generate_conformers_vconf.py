@@ -1,9 +1,11 @@
 import psutil
+import io
 import os
 import subprocess
 import pandas as pd
+import shutil
 from rdkit import Chem
-from rdkit.Chem import AllChem
+from rdkit.Chem import rdMolDescriptors
 import sys
 from constants import use_default_vconf_settings, default_vconf_settings, experimental_vconf_settings, path_to_VCONF_outputs_folder, list_file_path, vconf_path, max_conformers, step_sampling, generate_conformers_using_vconf_script, compound_list_directory, list_folder_name, skip_vconf_exe
 import constants
@@ -14,9 +16,26 @@ import threading
 import signal
 from rdkit import RDLogger
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+from ssh_connection import get_ssh_client
+import parallel_embedding
+import conformer_selection
+import sdf_records
+import rdkit_conformers
+import run_journal
 
 # Define a global observer for graceful shutdown
 observer = None
+
+# Sharded VConf runs cut the molecule range into this many shards per process, handed out heaviest first
+SHARDS_PER_PROCESS = 4
+
+# Seconds between progress reports of a sharded VConf run
+SHARD_PROGRESS_INTERVAL = 30
+
+# Seconds before the stream start a _confs.sdf may be dated and still count as written by this run,
+# covering file systems that store modification times at coarse (up to 2 s) resolution
+STALE_OUTPUT_SLACK = 2
 max_conformers = int(constants.max_conformers.strip('"'))
 
 
@@ -28,8 +47,6 @@ def terminate_vconf_processes():
             process.terminate()
             process.wait()  # Wait for the process to be fully terminated
 
-terminate_vconf_processes()  # Call this function at the start of the script
-
 def debug_constants():
     print("Debugging constants:")
     print(f"list_file_path: {constants.list_file_path}")
@@ -128,42 +145,42 @@ def clean_molecule_name(name):
 def read_tsv_and_generate_sdf(sdf_path):
     """
     Read TSV files in the compound directory and generate an SDF file from the SMILES strings contained within.
+    Molecules are embedded on embedding_processes processes (0 = one per core) and written out in TSV order
+    as they finish. A molecule still embedding after embedding_timeout seconds is skipped.
     """
     tsv_files = [f for f in os.listdir(constants.list_folder) if f.endswith('.tsv')]
     if not tsv_files:
         print("No TSV files found in the compound directory.")
         return []
 
-    molecule_names = []
-    writer = Chem.SDWriter(sdf_path)
-
+    smiles_list, names = [], []
     for tsv_file in tsv_files:
         tsv_path = os.path.join(constants.list_folder, tsv_file)
         print(f"Reading TSV file: {tsv_path}")
         df = pd.read_csv(tsv_path, sep='\t', header=None)
+        smiles_list.extend(df.iloc[:, 0].tolist())  # First column is SMILES
+        names.extend(df.iloc[:, 1].tolist())  # Second column is the molecule name
 
-        for index, row in df.iterrows():
-            mol = Chem.MolFromSmiles(row.iloc[0])  # First column is SMILES
-            if mol:
-                mol = Chem.AddHs(mol)  # Add hydrogens
-                AllChem.EmbedMolecule(mol, randomSeed=42)
-                AllChem.UFFOptimizeMolecule(mol)  # Optimize the geometry to ensure it's properly 3D
-
-                # Detect charge
-                charge = Chem.GetFormalCharge(mol)
-                charge_suffix = f"_pos{charge}" if charge > 0 else f"_neg{abs(charge)}" if charge < 0 else ""
-
-                # Clean and set the molecule name
-                cleaned_name = clean_molecule_name(row.iloc[1])  # Second column is the molecule name
-                mol.SetProp("_Name", cleaned_name + charge_suffix)
-
-                writer.write(mol)
-                molecule_names.append(cleaned_name + charge_suffix)
-            else:
-                print(f"Error processing SMILES: {row.iloc[0]}")
-
-    writer.close()
-    print(f"SDF file {sdf_path} generated successfully.")
+    molecule_names = []
+    start_time = time.time()
+    with parallel_embedding.StreamingSDFWriter(sdf_path) as writer:
+        for index, mol_block, detail in parallel_embedding.embed_in_parallel(
+                smiles_list, processes=constants.embedding_processes, timeout=int(constants.embedding_timeout)):
+            if mol_block is None:
+                print(f"Error processing SMILES: {smiles_list[index]} ({detail})")
+                continue
+
+            # Detect charge
+            charge = detail
+            charge_suffix = f"_pos{charge}" if charge > 0 else f"_neg{abs(charge)}" if charge < 0 else ""
+
+            # Clean and set the molecule name
+            cleaned_name = clean_molecule_name(names[index])
+            writer.write(mol_block, name=cleaned_name + charge_suffix)
+            molecule_names.append(cleaned_name + charge_suffix)
+
+    print(f"SDF file {sdf_path} generated successfully ({len(molecule_names)}/{len(smiles_list)} molecules "
+          f"in {time.time() - start_time:.1f} s).")
     print(f"List of molecule names: {molecule_names}")
     return molecule_names  # Return the list of molecule names
 
@@ -201,12 +218,13 @@ def monitor_vconf_outputs(molecule_names):
                     sdf_file_path = os.path.join(output_dir, new_file)
                     molecule_name = new_file.split('_confs.sdf')[0]
                     if molecule_name in molecule_names:
-                        with open(sdf_file_path, 'r') as sdf_file:
-                            for line in sdf_file:
-                                if line.startswith('> <Energy>'):
-                                    lowest_energy = float(sdf_file.readline().strip())
-                                    break
-                        num_conformers = sum(1 for mol in Chem.SDMolSupplier(sdf_file_path) if mol is not None)
+                        # The first record is the lowest energy one, in VConf's and in RDKit's layout of the header
+                        ends = sdf_records.record_ends(sdf_file_path)
+                        first_record = next(sdf_records.iter_records(sdf_file_path, ends, [0]), None) if ends else None
+                        lowest_energy = sdf_records.record_energy(first_record[1]) if first_record else None
+                        if lowest_energy is None:
+                            lowest_energy = "unknown"
+                        num_conformers = len(ends)
                         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                         print(f"[{timestamp}] New file: {new_file} - Number of {molecule_name} conformers: {num_conformers}, Lowest energy: {lowest_energy}")
 
@@ -330,6 +348,182 @@ def run_vconf_command(command, output_dir):
     except Exception as e:
         print(f"Exception occurred while running VConf: {e}")
 
+def rotatable_bond_counts(sdf_path):
+    """Return the rotatable bond count of every molecule in the input SDF, in file order."""
+    return [rdMolDescriptors.CalcNumRotatableBonds(mol) if mol is not None else 0
+            for mol in Chem.SDMolSupplier(sdf_path, removeHs=False)]
+
+
+def balanced_shards(weights, first_molecule, shard_count):
+    """
+    Split the molecules into up to shard_count contiguous ranges of similar total weight, as
+    (first molecule, last molecule) pairs numbered like VConf's -f/-l flags starting at first_molecule.
+    """
+    shard_count = max(1, min(shard_count, len(weights)))
+    target = sum(weights) / shard_count
+    shards = []
+    start, cumulative = 0, 0
+    for index, weight in enumerate(weights):
+        cumulative += weight
+        molecules_left = len(weights) - index - 1
+        shards_left = shard_count - len(shards) - 1
+        if shards_left and (cumulative >= target * (len(shards) + 1) or molecules_left == shards_left):
+            shards.append((first_molecule + start, first_molecule + index))
+            start = index + 1
+    shards.append((first_molecule + start, first_molecule + len(weights) - 1))
+    return shards
+
+
+def shard_settings(settings, shard_dir, first, last):
+    """Copy of the VConf settings for one shard, with paths relative to the shard folder it runs in."""
+    shard = dict(settings)
+    shard['SDF_FILENAME'] = os.path.relpath(settings['SDF_FILENAME'], shard_dir)
+    shard['OUTPUT_LOG'] = os.path.basename(settings['OUTPUT_LOG'])
+    shard['OUTPUT_SDF'] = os.path.basename(settings['OUTPUT_SDF'])
+    shard['FIRST_MOLECULE'] = first
+    shard['LAST_MOLECULE'] = last
+    return shard
+
+
+def run_vconf_shard(command, shard_dir):
+    """Run one shard's VConf in its own folder, with its console output in vconf_console.txt."""
+    creationflags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+    with open(os.path.join(shard_dir, "vconf_console.txt"), "w") as console:
+        return subprocess.call(command, shell=False, cwd=shard_dir, stdout=console, stderr=subprocess.STDOUT,
+                               creationflags=creationflags)
+
+
+def collect_vconf_shard(shard_dir, output_dir):
+    """Move a finished shard's _confs.sdf files into the outputs folder, where the later stages look for them."""
+    for file in os.listdir(shard_dir):
+        if file.endswith('_confs.sdf'):
+            os.replace(os.path.join(shard_dir, file), os.path.join(output_dir, file))
+
+
+def merge_vconf_shard_outputs(settings, shard_runs):
+    """Concatenate the shards' logs and combined SDFs into OUTPUT_LOG and OUTPUT_SDF, in molecule order."""
+    for key in ('OUTPUT_LOG', 'OUTPUT_SDF'):
+        with open(settings[key], "w") as merged:
+            for label, shard_dir in shard_runs:
+                shard_file = os.path.join(shard_dir, os.path.basename(settings[key]))
+                if not os.path.exists(shard_file):
+                    continue
+                if key == 'OUTPUT_LOG':
+                    merged.write(f"===== {label} =====\n")
+                with open(shard_file, "r") as part:
+                    shutil.copyfileobj(part, merged)
+
+
+def run_vconf_sharded(settings, num_molecules, output_dir, processes):
+    """
+    Run VConf as several processes at once, each over its own contiguous range of the input SDF (-f/-l).
+    Ranges are balanced by rotatable bond count and handed out heaviest first, several per process, so the
+    cores stay busy until the end. Each shard runs in VCONF_outputs/shards/shard_<n> with its own log and
+    output. As soon as a shard finishes its _confs.sdf files are moved into VCONF_outputs; at the end the
+    shard logs and combined SDFs are merged into OUTPUT_LOG and OUTPUT_SDF.
+    """
+    first_molecule = int(settings['FIRST_MOLECULE'])
+    last_molecule = num_molecules if settings['LAST_MOLECULE'] in ("None", None) else int(settings['LAST_MOLECULE'])
+    rotatable_bonds = rotatable_bond_counts(settings['SDF_FILENAME'])[first_molecule - 1:last_molecule]
+    # VConf's search cost grows with every rotatable bond; rigid molecules still cost something
+    weights = [1 + count for count in rotatable_bonds]
+    shards = balanced_shards(weights, first_molecule, processes * SHARDS_PER_PROCESS)
+
+    shards_root = os.path.join(output_dir, "shards")
+    shutil.rmtree(shards_root, ignore_errors=True)
+
+    def shard_weight(shard):
+        return sum(weights[shard[0] - first_molecule:shard[1] - first_molecule + 1])
+
+    running = {}
+    shard_runs = []
+    print(f"Running VConf as {len(shards)} shards on {processes} processes.")
+    with ThreadPoolExecutor(max_workers=processes) as executor:
+        for number, (first, last) in sorted(enumerate(shards, start=1), key=lambda item: -shard_weight(item[1])):
+            shard_dir = os.path.join(shards_root, f"shard_{number:03d}")
+            os.makedirs(shard_dir)
+            command = build_vconf_command(shard_settings(settings, shard_dir, first, last), settings['SDF_FILENAME'],
+                                          num_molecules, running_as_exe=False)
+            future = executor.submit(run_vconf_shard, command, shard_dir)
+            running[future] = (f"Shard {number}/{len(shards)} (molecules {first}-{last})", last - first + 1, shard_dir)
+            shard_runs.append((number, running[future][0], shard_dir))
+
+        finished, failed = 0, 0
+        while running:
+            done, _ = wait(running, timeout=SHARD_PROGRESS_INTERVAL)
+            for future in done:
+                label, size, shard_dir = running.pop(future)
+                try:
+                    returncode = future.result()
+                except Exception as e:
+                    returncode = e
+                collect_vconf_shard(shard_dir, output_dir)
+                finished += 1
+                if returncode != 0:
+                    failed += 1
+                status = "finished" if returncode == 0 else f"failed ({returncode}), see {shard_dir}"
+                print(f"{label} {status}. {finished}/{len(shards)} shards done.")
+            for future, (label, size, shard_dir) in running.items():
+                if future.running():
+                    written = sum(1 for file in os.listdir(shard_dir) if file.endswith('_confs.sdf'))
+                    print(f"{label}: {written}/{size} molecules written.")
+
+    merge_vconf_shard_outputs(settings, [(label, shard_dir) for _, label, shard_dir in sorted(shard_runs)])
+    if not failed:  # Keep the shard folders of a failed run for their console output
+        shutil.rmtree(shards_root, ignore_errors=True)
+    print("VConf processing completed.")
+
+
+def select_conformer_indices(sdf_file_path, ends, max_conformers, step_sampling):
+    """
+    Decide which records of a _confs.sdf file to keep before any of them is parsed: the first
+    max_conformers, every step-th one, or a diversity selection read from the records' energies and atom
+    blocks.
+    """
+    count = len(ends)
+    if constants.diversity_selection and count > 1:
+        # Conformers without an Energy property all count as 0, i.e. they are kept in file order
+        energies = [sdf_records.record_energy(record) or 0.0
+                    for _, record in sdf_records.iter_records(sdf_file_path, ends)]
+
+        def load_coordinates(indices):
+            coordinates = {index: sdf_records.heavy_atom_coordinates(record)
+                           for index, record in sdf_records.iter_records(sdf_file_path, ends, sorted(indices))}
+            return [coordinates[index] for index in indices]
+
+        selected = conformer_selection.select_diverse_conformers(
+            energies, max_conformers, float(constants.selection_energy_window), load_coordinates)
+        print(f"Diversity selection: kept {len(selected)} distinct conformers within "
+              f"{constants.selection_energy_window} kcal/mol")
+        return selected
+    # Step sampling logic
+    if step_sampling and count > max_conformers:
+        step = int(count // max_conformers)  # Force step to be an integer
+        print(f"Step sampling enabled: Selecting every {step}th conformer")
+        return list(range(0, count, step))[:max_conformers]
+    return list(range(min(count, max_conformers)))
+
+
+def label_conformer_file(sdf_file_path, name_counts, max_conformers, step_sampling):
+    """
+    Yield one molecule's sampled conformers from its _confs.sdf file, labelled <name>_<n>.
+    The file is scanned for its record boundaries and only the selected records are parsed, one at a time,
+    so memory does not grow with the number of conformers VConf wrote.
+    """
+    ends = sdf_records.record_ends(sdf_file_path)
+    print(f"Processing file: {os.path.basename(sdf_file_path)} with {len(ends)} conformers")
+    selected = select_conformer_indices(sdf_file_path, ends, max_conformers, step_sampling)
+
+    for _, record in sdf_records.iter_records(sdf_file_path, ends, selected):
+        mol = next(Chem.ForwardSDMolSupplier(io.BytesIO(record)), None)
+        if mol is None:
+            continue
+        name = mol.GetProp('_Name')
+        name_counts[name] = name_counts.get(name, 0) + 1
+        mol.SetProp('_Name', f"{name}_{name_counts[name]}")
+        yield Chem.AddHs(mol, addCoords=True)  # Ensure implicit hydrogens are included
+
+
 def combine_and_label_sdf_files(output_dir, batch_file_path, molecule_names, max_conformers, step_sampling):
     """
     Combine individual SDF files into a batch file and label them appropriately.
@@ -342,38 +536,128 @@ def combine_and_label_sdf_files(output_dir, batch_file_path, molecule_names, max
     for file in os.listdir(output_dir):
         if file.endswith('_confs.sdf'):
             sdf_file_path = os.path.join(output_dir, str(file))
-            suppl = Chem.SDMolSupplier(sdf_file_path)
-            mol_list = [mol for mol in suppl if mol is not None]
-            print(f"Processing file: {file} with {len(mol_list)} conformers")
-
-            # Step sampling logic
-            if step_sampling and len(mol_list) > max_conformers:
-                step = int(len(mol_list) // max_conformers)  # Force step to be an integer
-                print(f"Step sampling enabled: Selecting every {step}th conformer")
-                sampled_mol_list = [mol_list[i] for i in range(0, len(mol_list), step)][:max_conformers]
-            else:
-                sampled_mol_list = mol_list[:max_conformers]
-
-            for mol in sampled_mol_list:
-                name = mol.GetProp('_Name')
-                name_counts[name] += 1
-                new_name = f"{name}_{name_counts[name]}"
-                mol.SetProp('_Name', new_name)
-                mol = Chem.AddHs(mol, addCoords=True)  # Ensure implicit hydrogens are included
+            for mol in label_conformer_file(sdf_file_path, name_counts, max_conformers, step_sampling):
                 writer.write(mol)
+            writer.flush()  # Each molecule is on disk before the next file is read
 
     writer.close()
     print(f"Combined and labeled SDF file {batch_file_path} generated successfully.")
 
+
+class ConformerStream:
+    """
+    Hand each molecule's conformers to the cluster as soon as VConf has finished writing them.
+
+    VConf works through the input SDF in order, so a molecule's _confs.sdf is complete once a later
+    molecule's file appears or VConf exits. Completed molecules are labelled, uploaded, prepared and
+    (if enabled) submitted on a background worker while VConf moves on to the next molecule.
+    Files last modified before `since` (left over from an earlier run) are ignored; None streams every file.
+    """
+
+    def __init__(self, output_dir, molecule_names, max_conformers, step_sampling, poll_interval=5, since=None):
+        self.output_dir = output_dir
+        self.since = since
+        self.molecule_names = molecule_names
+        self.order = {name: index for index, name in enumerate(molecule_names)}
+        self.max_conformers = max_conformers
+        self.step_sampling = step_sampling
+        self.poll_interval = poll_interval
+        self.handed_off = set()
+        self.submitted_count = 0
+        self.vconf_finished = threading.Event()
+        self.worker = ThreadPoolExecutor(max_workers=1)  # One molecule at a time keeps remote steps ordered
+        self.futures = []
+
+        # Imported here so the cluster stages are only loaded when streaming is used
+        import cmdline_TMoleX_process as tmolex
+        import submit_remote_jobs_to_cluster as submitter
+        self.tmolex = tmolex
+        self.submitter = submitter
+        self.ssh = get_ssh_client(tmolex.server, tmolex.port, tmolex.username, tmolex.password)
+        self.coord_files_dir = tmolex.start_streaming_session(self.ssh)
+
+    def completed_molecules(self):
+        """Return the molecules whose _confs.sdf file is finished but not handed off yet."""
+        present = {}
+        for file in os.listdir(self.output_dir):
+            if file.endswith('_confs.sdf'):
+                molecule_name = clean_molecule_name(file.split('_confs.sdf')[0])
+                path = os.path.join(self.output_dir, file)
+                if molecule_name not in self.order:
+                    continue
+                try:
+                    if self.since is not None and os.path.getmtime(path) < self.since:
+                        continue  # Stale output of an earlier run; VConf has not rewritten it yet
+                except OSError:
+                    continue  # Removed or replaced between the listing and the check
+                present[molecule_name] = path
+
+        if not present:
+            return []
+        newest_index = max(self.order[name] for name in present)
+        completed = []
+        for name, path in sorted(present.items(), key=lambda item: self.order[item[0]]):
+            if name in self.handed_off:
+                continue
+            if self.vconf_finished.is_set() or self.order[name] < newest_index:
+                completed.append((name, path))
+        return completed
+
+    def hand_off(self, molecule_name, sdf_file_path):
+        """Label one molecule's conformers and prepare and submit them on the remote server."""
+        conformers = list(label_conformer_file(sdf_file_path, {}, self.max_conformers, self.step_sampling))
+        if not conformers:
+            print(f"No conformers found for {molecule_name}, nothing to stream.")
+            return
+        ready = self.tmolex.prepare_streamed_molecule(self.ssh, molecule_name, conformers, self.coord_files_dir)
+        if constants.submit_TMoleX_files_to_cluster_script and ready:
+            journal = run_journal.open_journal(self.tmolex.list_folder)
+            try:
+                self.submitter.submit_molecules(self.ssh, ready, self.tmolex.remote_temp_dir, journal=journal)
+            finally:
+                journal.close()
+            self.submitted_count += len(ready)
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{timestamp}] Streamed {molecule_name}: {len(conformers)} conformers prepared, {len(ready)} ready.")
+
+    def poll(self):
+        for molecule_name, sdf_file_path in self.completed_molecules():
+            self.handed_off.add(molecule_name)
+            self.futures.append(self.worker.submit(self.hand_off, molecule_name, sdf_file_path))
+
+    def run(self):
+        """Poll the outputs folder until VConf has finished and every molecule was handed off."""
+        while not self.vconf_finished.is_set():
+            self.poll()
+            self.vconf_finished.wait(self.poll_interval)
+        self.poll()  # Everything left over is complete now that VConf has exited
+
+    def finish(self):
+        """Wait for outstanding hand-offs and report any that failed."""
+        for future in self.futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error while streaming a molecule to the cluster: {e}")
+        self.worker.shutdown()
+        print(f"Streaming complete: {len(self.handed_off)} molecules handed off, {self.submitted_count} jobs submitted.")
+
+
 def main():
+    terminate_vconf_processes()  # Make sure no stale vconf runs are writing to the outputs folder
+
     # Set up signal handling to ensure the observer stops on script termination
-    signal.signal(signal.SIGINT, stop_observer)
-    signal.signal(signal.SIGTERM, stop_observer)
+    # (handlers can only be installed from the main thread, not when run as a pipeline stage)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, stop_observer)
+        signal.signal(signal.SIGTERM, stop_observer)
     RDLogger.DisableLog('rdApp.warning')
 
-    # Start monitoring the VCONF log file in a separate thread
-    monitor_thread = threading.Thread(target=monitor_log_file, daemon=True)
-    monitor_thread.start()
+    # Start monitoring the VCONF log file in a separate thread (sharded and RDKit runs report on their own)
+    vconf_processes = int(constants.vconf_processes) or os.cpu_count() or 1
+    if vconf_processes == 1 and not constants.use_rdkit_conformer_search:
+        monitor_thread = threading.Thread(target=monitor_log_file, daemon=True)
+        monitor_thread.start()
 
     # Rest of the main function for running the VConf conformer generation process
     if not generate_conformers_using_vconf_script:
@@ -407,11 +691,31 @@ def main():
 
     running_as_exe = getattr(sys, 'frozen', False)  # Detect if running as executable
 
-    if skip_vconf_exe:
-        print("VConf execution is skipped as per user request.")
-    else:
-        command = build_vconf_command(settings, settings['SDF_FILENAME'], num_molecules, running_as_exe)
-        run_vconf_command(command, output_dir)
+    # Hand finished molecules to the cluster while VConf works on the rest of the list
+    stream = None
+    if constants.stream_conformers_to_cluster and constants.prepare_TMoleX_files_script:
+        print("Streaming finished molecules to the cluster while VConf runs...")
+        # Only files written from now on count, unless VConf is skipped and the existing outputs are the results
+        since = None if skip_vconf_exe else time.time() - STALE_OUTPUT_SLACK
+        stream = ConformerStream(output_dir, molecule_names, max_conformers, step_sampling, since=since)
+        stream_thread = threading.Thread(target=stream.run, daemon=True)
+        stream_thread.start()
+
+    try:
+        if skip_vconf_exe:
+            print("VConf execution is skipped as per user request.")
+        elif constants.use_rdkit_conformer_search:
+            rdkit_conformers.run_conformer_search(settings, num_molecules, output_dir)
+        elif vconf_processes > 1:
+            run_vconf_sharded(settings, num_molecules, output_dir, vconf_processes)
+        else:
+            command = build_vconf_command(settings, settings['SDF_FILENAME'], num_molecules, running_as_exe)
+            run_vconf_command(command, output_dir)
+    finally:
+        if stream:
+            stream.vconf_finished.set()
+            stream_thread.join()
+            stream.finish()
 
     print(f"Combining and labeling SDF files into {settings['vconf_batch_sdf_path']}...")
     combine_and_label_sdf_files(output_dir, settings['vconf_batch_sdf_path'], molecule_names, max_conformers, step_sampling)
@@ -1,11 +1,21 @@
-import hashlib
+import fnmatch
+import json
 import os
-import paramiko
+import shlex
+import shutil
+import tarfile
+import threading
+from ssh_connection import get_ssh_client
+import file_transfer
+import head_node_agent
+import results_cache
+import run_journal
+import transfer_concurrency
+import transfer_manifest
 from scp import SCPClient
 from datetime import datetime
 import importlib.util
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import configparser
 
 # Initialize ConfigParser to read from the sensitive_config.ini file
@@ -53,6 +63,12 @@ default_vconf_settings = constants.default_vconf_settings
 use_default_vconf_settings = constants.use_default_vconf_settings
 experimental_vconf_settings = constants.experimental_vconf_settings
 only_transfer_cosmo_file_bool = constants.only_transfer_cosmo_file
+bulk_tar_download = constants.bulk_tar_download
+compress_tar_download = constants.compress_tar_download
+files_to_keep = constants.files_to_keep
+
+# Local cache of the member listings of archived timestamped folders, kept in the list folder
+ARCHIVE_INDEX_FILE_NAME = "archive_index.json"
 constants.remote_directory = remote_directory  # Update remote_directory
 constants.remote_file_path = remote_file_path  # Update remote_file_path
 
@@ -65,9 +81,13 @@ def verify_local_directory(local_dir, remote_dir, ssh):
     """
     Verify that the local directory has been successfully transferred by comparing file counts.
     """
-    # Get file count from the remote directory
-    stdin, stdout, stderr = ssh.exec_command(f"find {remote_dir} -type f | wc -l")
-    remote_file_count = int(stdout.read().strip())
+    # Get file count from the remote directory, with find where the head node agent cannot run
+    try:
+        remote_file_count = head_node_agent.tree_size(ssh, remote_dir)["files"]
+    except (head_node_agent.AgentUnavailable, RuntimeError) as e:
+        print(f"Counting remote files with find instead of the head node agent ({e}).")
+        stdin, stdout, stderr = ssh.exec_command(f"find {shlex.quote(remote_dir)} -type f | wc -l")
+        remote_file_count = int(stdout.read().strip())
 
     # Get file count from the local directory
     local_file_count = sum([len(files) for r, d, files in os.walk(local_dir)])
@@ -75,29 +95,6 @@ def verify_local_directory(local_dir, remote_dir, ssh):
     return remote_file_count == local_file_count
 
 
-def calculate_md5(file_path):
-    """Calculate the MD5 checksum of a local file."""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
-
-def verify_local_file(local_file, remote_file, ssh):
-    """
-    Verify that the specific local file has been successfully transferred by comparing MD5 checksums.
-    """
-    # Calculate local MD5 checksum
-    local_md5 = calculate_md5(local_file)
-
-    # Get the remote MD5 checksum
-    stdin, stdout, stderr = ssh.exec_command(f"md5sum {remote_file}")
-    remote_md5 = stdout.read().decode().strip().split()[0]
-
-    return local_md5 == remote_md5
-
-
 def only_transfer_cosmo_file(cosmo_file, local_folder_path, ssh):
     """Transfer a single .cosmo file."""
     try:
@@ -128,118 +125,321 @@ def only_transfer_cosmo_file(cosmo_file, local_folder_path, ssh):
         return False
 
 
-def scp_transfer_back(ssh, remote_dir, local_dir, max_workers=5):
+def result_file_patterns():
     """
-    Transfer files back from remote to local, optionally transferring only .cosmo files based on `only_transfer_cosmo_file_bool`.
+    Return the file name patterns downloaded per molecule folder: only .cosmo files with
+    only_transfer_cosmo_file, otherwise .cosmo files plus files_to_keep for bulk_tar_download and every
+    file for the per-file SCP transfer.
     """
-    local_target_dir = os.path.join(local_dir, "TMoleX_output")
+    if only_transfer_cosmo_file_bool:
+        return ["*.cosmo"]
+    return ["*.cosmo"] + sorted(files_to_keep) if bulk_tar_download else ["*"]
 
-    # Ensure the local target directory is cleared before starting the transfer
-    if os.path.exists(local_target_dir):
-        for root, dirs, files in os.walk(local_target_dir, topdown=False):
-            for file in files:
-                os.remove(os.path.join(root, file))
-            for dir in dirs:
-                os.rmdir(os.path.join(root, dir))
 
-    os.makedirs(local_target_dir, exist_ok=True)
+def remove_stale_entries(local_target_dir, folders):
+    """
+    Remove what TMoleX_output holds outside the given molecule folders, so it mirrors the remote directory
+    without wiping the folders that are still current.
+    """
+    removed = 0
+    for entry in os.listdir(local_target_dir):
+        if entry in folders:
+            continue
+        entry_path = os.path.join(local_target_dir, entry)
+        if os.path.isdir(entry_path):
+            shutil.rmtree(entry_path)
+        else:
+            os.remove(entry_path)
+        removed += 1
+    if removed:
+        print(f"Removed {removed} local entries that are no longer in the remote directory.")
 
-    # List folders in remote_dir
-    print("Listing top-level directories...")
-    stdin, stdout, stderr = ssh.exec_command(f"ls -1 {remote_dir}")
-    stdout.channel.recv_exit_status()  # Ensure the command completes
-    folders = stdout.read().decode().split()
 
-    if not folders:
-        print("No directories found in the specified remote directory.")
-        return False
+def feed_file_list(stdin, relative_paths):
+    """
+    Write a NUL separated file list to a remote command's stdin from a separate thread, so a long list
+    cannot stall against the command's output stream. Returns the thread.
+    """
+    def feed():
+        stdin.write("\0".join(relative_paths).encode('utf-8') + b"\0")
+        stdin.channel.shutdown_write()
 
-    # Prepare folders for local storage
-    for folder in folders:
-        if folder != "run_tx.sh":
-            local_folder_path = os.path.join(local_target_dir, folder)
-            os.makedirs(local_folder_path, exist_ok=True)
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    return feeder
 
-    # Collect transfer tasks
-    transfer_tasks = []
 
-    # Process folders in batches of 5
-    for folder in folders:
-        if folder == "run_tx.sh":
-            print(f"Skipping {folder}")
-            continue
+def unpack_tar_stream(stream, local_target_dir, total, compress=False):
+    """
+    Unpack the regular files of a tar stream into local_target_dir as the members arrive, printing a
+    running count. Members that would land outside local_target_dir are skipped.
+    Returns the number of files written.
+    """
+    local_root = os.path.realpath(local_target_dir)
+    written = 0
+    received_bytes = 0
+    with tarfile.open(fileobj=stream, mode="r|gz" if compress else "r|") as tar_stream:
+        for member in tar_stream:
+            if not member.isfile():
+                continue
+            local_path = os.path.realpath(os.path.join(local_root, member.name))
+            if not local_path.startswith(local_root + os.sep):
+                print(f"\nSkipping tar member outside TMoleX_output: {member.name}")
+                continue
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            with tar_stream.extractfile(member) as source, open(local_path, "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.utime(local_path, (member.mtime, member.mtime))
+            written += 1
+            received_bytes += member.size
+            print(f"\rDownloaded {written}/{total} files ({received_bytes / 1e6:.1f} MB) | {member.name}",
+                  end='', flush=True)
+    print()
+    return written
+
+
+def stream_tar_download(ssh, remote_dir, local_target_dir, relative_paths, compress=False):
+    """
+    Download files from remote_dir with one tar -c on the head node, streamed over a single channel and
+    unpacked into local_target_dir as the members arrive.
+    Returns the number of files written.
+    """
+    if not relative_paths:
+        return 0
+    stdin, stdout, stderr = ssh.exec_command(
+        f"cd {shlex.quote(remote_dir)} && tar -c {'-z ' if compress else ''}--null -T - -f -")
+    feeder = feed_file_list(stdin, relative_paths)
+    written = unpack_tar_stream(stdout, local_target_dir, len(relative_paths), compress=compress)
+    feeder.join()
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+        print(f"tar on the head node exited with status {exit_status}: {stderr.read().decode().strip()}")
+    return written
 
-        remote_folder_path = f"{remote_dir}/{folder}"
-        local_folder_path = os.path.join(local_target_dir, folder)
 
-        if only_transfer_cosmo_file_bool:
-            # Only transfer .cosmo files
-            stdin, stdout, stderr = ssh.exec_command(f"find {remote_folder_path} -maxdepth 1 -type f -name '*.cosmo'")
-        else:
-            # Transfer all files
-            stdin, stdout, stderr = ssh.exec_command(f"find {remote_folder_path} -maxdepth 1 -type f")
+def record_fetched_folders(journal, folders, local_target_dir):
+    """Mark the folders whose .cosmo file is on disk as fetched in the run journal."""
+    journal.mark([folder for folder in folders
+                  if os.path.isfile(os.path.join(local_target_dir, folder, f"{folder}.cosmo"))],
+                 run_journal.COSMO_FETCHED)
 
-        stdout.channel.recv_exit_status()
-        files_to_transfer = stdout.read().decode().strip().split("\n")
-        files_to_transfer = [f for f in files_to_transfer if f]  # Remove empty entries
 
-        if not files_to_transfer:
-            print(f"No files found in {remote_folder_path}.")
+def archive_member_index(ssh, archive_path, index_path):
+    """
+    Return [(member name, size)] for the regular files in a remote .tar.gz.
+    Listing a gzipped archive means reading all of it, so the listing is kept in index_path, keyed by the
+    archive's size and modification time, and only the first pull of an archive pays for it.
+    """
+    stdin, stdout, stderr = ssh.exec_command(f"stat -c '%s %Y' {shlex.quote(archive_path)}")
+    archive_stamp = stdout.read().decode().strip()
+
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as index_file:
+            index = json.load(index_file)
+    entry = index.get(archive_path)
+    if entry and entry["stamp"] == archive_stamp:
+        print(f"Using the cached member index of {archive_path}.")
+        return [tuple(member) for member in entry["members"]]
+
+    print(f"Indexing the members of {archive_path}...")
+    stdin, stdout, stderr = ssh.exec_command(f"tar -tvzf {shlex.quote(archive_path)}")
+    output = stdout.read().decode()
+    stdout.channel.recv_exit_status()
+    members = []
+    for line in output.splitlines():
+        parts = line.split(None, 5)
+        if line.startswith("-") and len(parts) == 6:
+            members.append((parts[5], int(parts[2])))
+
+    index[archive_path] = {"stamp": archive_stamp, "members": members}
+    with open(index_path, 'w') as index_file:
+        json.dump(index, index_file, indent=1)
+    return members
+
+
+def select_result_members(members):
+    """
+    Return {relative path: (member name, size)} for the archive members list_result_files would pick
+    from the unpacked folder.
+    """
+    patterns = result_file_patterns()
+    selected = {}
+    for member_name, size in members:
+        relative_path = member_name[2:] if member_name.startswith("./") else member_name
+        parts = relative_path.split("/")
+        if len(parts) != 2 or parts[0].startswith("."):
             continue
+        if any(fnmatch.fnmatch(parts[1], pattern) for pattern in patterns):
+            selected[relative_path] = (member_name, size)
+    return selected
 
-        for file_path in files_to_transfer:
-            transfer_tasks.append((file_path, local_folder_path))
 
-    # Execute file transfers
-    print(f"Starting file transfers with max workers: {max_workers}")
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(transfer_file, file_path, local_folder_path, ssh)
-                   for file_path, local_folder_path in transfer_tasks]
-        for future in as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                print(f"An error occurred during file transfer: {e}")
+def stream_archive_members(ssh, archive_path, local_target_dir, member_names, compress=False):
+    """
+    Stream only the given members of a remote .tar.gz back to local_target_dir, leaving the archive as it is.
+    The members are extracted into a scratch folder on the head node and sent back as one tar, including
+    when some of them could not be extracted.
+    --occurrence lets tar stop reading the archive as soon as every listed member has been found.
+    Returns the number of files written.
+    """
+    if not member_names:
+        return 0
+    # The members that could be extracted are sent back even if others failed (tar exits with 2), so a
+    # retry only has to ask for what is still missing. The worse of the two exit statuses is reported.
+    stdin, stdout, stderr = ssh.exec_command(
+        f"scratch=$(mktemp -d) && cd \"$scratch\" || exit 1; "
+        f"tar -xz -f {shlex.quote(archive_path)} --occurrence=1 --null -T -; extract_status=$?; "
+        f"tar -c {'-z ' if compress else ''}-f - .; pack_status=$?; cd / && rm -rf \"$scratch\"; "
+        f"if [ $pack_status -gt $extract_status ]; then exit $pack_status; else exit $extract_status; fi")
+    feeder = feed_file_list(stdin, member_names)
+    written = unpack_tar_stream(stdout, local_target_dir, len(member_names), compress=compress)
+    feeder.join()
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+        print(f"Reading {archive_path} on the head node exited with status {exit_status}: {stderr.read().decode().strip()}")
+    return written
+
+
+def archive_transfer_back(ssh, archive_path, local_target_dir, index_path, retries=3):
+    """
+    Download the result files of an archived timestamped folder without unpacking it on the head node.
+    The archive holds no checksums, so files are compared with the member sizes in the index: only missing
+    or differently sized files are read, and the downloads are checked the same way.
+    Returns the molecule folders found in the archive.
+    """
+    selected = select_result_members(archive_member_index(ssh, archive_path, index_path))
+    folders = sorted({relative_path.split("/")[0] for relative_path in selected})
+
+    def outdated(relative_paths):
+        outdated_paths = []
+        for relative_path in relative_paths:
+            local_path = os.path.join(local_target_dir, *relative_path.split("/"))
+            if not os.path.isfile(local_path) or os.path.getsize(local_path) != selected[relative_path][1]:
+                outdated_paths.append(relative_path)
+        return outdated_paths
+
+    pending = outdated(sorted(selected))
+    print(f"{len(pending)} of {len(selected)} files in {len(folders)} folders need to be read from the archive.")
+    for attempt in range(retries):
+        if not pending:
+            break
+        stream_archive_members(ssh, archive_path, local_target_dir, [selected[path][0] for path in pending],
+                               compress=compress_tar_download)
+        mismatched = outdated(pending)
+        print(f"Verified {len(pending) - len(mismatched)}/{len(pending)} files against the archive index.")
+        pending = mismatched
+        if pending:
+            print(f"Attempt {attempt + 1}: {len(pending)} files failed verification, reading only those again.")
+    else:
+        if pending:
+            print(f"Error: {len(pending)} files could not be verified after {retries} attempts.")
+    return folders
 
-    print("Completed file transfers.")
-    return True
 
-def transfer_file(file_path, local_folder_path, ssh):
-    """General function to transfer a file."""
-    try:
-        with SCPClient(ssh.get_transport()) as scp_client:
-            scp_client.get(file_path, local_path=local_folder_path)
-            print(f"Transferred {file_path} to {local_folder_path}")
-        return True
-    except Exception as e:
-        print(f"Failed to transfer {file_path}: {e}")
-        return False
+def sync_transfer_back(ssh, remote_dir, local_target_dir, retries=3):
+    """
+    Bring local_target_dir in line with remote_dir, rsync style. One remote command returns the size, mtime
+    and md5 of every result file. Only files that are missing locally or differ are downloaded, through one
+    tar stream with bulk_tar_download or the transfer backend otherwise, and checked against the same manifest.
+    Returns the molecule folders found in remote_dir.
+    """
+    print("Building the remote file manifest...")
+    manifest = transfer_manifest.remote_file_manifest(ssh, remote_dir, result_file_patterns())
+    folders = sorted({relative_path.split("/")[0] for relative_path in manifest})
+    if not folders:
+        return folders
+    remove_stale_entries(local_target_dir, set(folders))
+
+    pending = transfer_manifest.outdated_local_files(manifest, local_target_dir)
+    print(f"{len(pending)} of {len(manifest)} files in {len(folders)} folders are new or changed.")
+    for attempt in range(retries):
+        if not pending:
+            break
+        if bulk_tar_download:
+            stream_tar_download(ssh, remote_dir, local_target_dir, pending, compress=compress_tar_download)
+        else:
+            downloads = []
+            for relative_path in pending:
+                local_folder_path = os.path.join(local_target_dir, relative_path.split("/")[0])
+                os.makedirs(local_folder_path, exist_ok=True)
+                downloads.append((f"{remote_dir}/{relative_path}", local_folder_path))
+            controller = transfer_concurrency.get_controller("result downloads",
+                                                             maximum=constants.max_transfer_concurrency)
+            with file_transfer.open_transfer_backend(ssh, constants.transfer_backend,
+                                                     connections=constants.transfer_connections) as backend:
+                print(f"Starting {backend.name} file transfers, up to {controller.maximum} at once")
+                backend.get_many(downloads, controller)
+
+        mismatched = transfer_manifest.outdated_local_files(manifest, local_target_dir, pending, trust_mtime=False)
+        print(f"Verified {len(pending) - len(mismatched)}/{len(pending)} downloaded files against the remote manifest.")
+        pending = mismatched
+        if pending:
+            print(f"Attempt {attempt + 1}: {len(pending)} files failed verification, fetching only those again.")
+    else:
+        if pending:
+            print(f"Error: {len(pending)} files could not be verified after {retries} attempts.")
+    return folders
 
 
-def gzip_directory(ssh, directory):
+def scp_transfer_back(ssh, remote_dir, local_dir, journal=None, retries=3, archive_path=None):
     """
-    Gzip the contents of a directory and replace the original directory with the gzipped archive.
+    Sync the result files of remote_dir into TMoleX_output, optionally only the .cosmo files based on
+    `only_transfer_cosmo_file_bool`. Files that are already up to date locally, including the ones harvested
+    while the queue was running, are not downloaded again.
+    With archive_path set, the files are read straight out of that .tar.gz instead of remote_dir.
+    Fetched .cosmo files are recorded in the run journal if one is given.
     """
-    stdin, stdout, stderr = ssh.exec_command(f"tar -czf {directory}.tar.gz -C {directory} . && rm -rf {directory}")
-    stdout.channel.recv_exit_status()  # Wait for the command to complete
+    local_target_dir = os.path.join(local_dir, "TMoleX_output")
+    os.makedirs(local_target_dir, exist_ok=True)
+
+    if archive_path:
+        folders = archive_transfer_back(ssh, archive_path, local_target_dir,
+                                        os.path.join(local_dir, ARCHIVE_INDEX_FILE_NAME), retries=retries)
+        if folders:
+            remove_stale_entries(local_target_dir, set(folders))
+    else:
+        folders = sync_transfer_back(ssh, remote_dir, local_target_dir, retries=retries)
+
+    if not folders:
+        print("No result files found in the specified remote directory.")
+        return False
+    if journal is not None:
+        record_fetched_folders(journal, folders, local_target_dir)
+
+    print("Completed file transfers.")
+    return True
 
 
-def unzip_directory(ssh, tar_file):
+def store_results_in_cache(local_target_dir):
     """
-    Unzip a tar.gz file and restore its contents to the original directory.
+    Store the fetched results of every conformer of this run in the results cache.
     """
-    directory = tar_file.replace(".tar.gz", "")
-    stdin, stdout, stderr = ssh.exec_command(
-        f"mkdir -p {directory} && tar -xzf {tar_file} -C {directory} && rm -f {tar_file}")
-    stdout.channel.recv_exit_status()  # Wait for the command to complete
+    run_keys = results_cache.load_run_keys(list_folder)
+    if not run_keys:
+        print("No results cache keys recorded for this run. Nothing to cache.")
+        return
+
+    cache = results_cache.open_cache(constants.compound_list_directory)
+    stored = 0
+    try:
+        for mol_name, key in run_keys.items():
+            conformer_dir = os.path.join(local_target_dir, mol_name)
+            files = results_cache.collect_result_files(conformer_dir, mol_name)
+            if ".cosmo" not in files or cache.contains(key):
+                continue
+            cache.store(key, files)
+            stored += 1
+    finally:
+        cache.close()
+    print(f"Stored results of {stored} conformers in the results cache.")
 
 
 def get_most_recent_timestamped_folder(ssh, remote_directory):
     """
     Get the most recently created timestamped folder.
     """
-    stdin, stdout, stderr = ssh.exec_command(f"ls -1 {remote_directory}")
-    folders = stdout.read().decode().split()
+    folders = head_node_agent.entry_names(ssh, remote_directory)
     timestamped_folders = []
     for folder in folders:
         folder_name = folder.replace(".tar.gz", "")
@@ -267,11 +467,9 @@ def main():
     settings = default_vconf_settings if use_default_vconf_settings else experimental_vconf_settings
     list_folder = os.path.dirname(os.path.dirname(settings['SDF_FILENAME']))
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(server, port=port, username=username, password=password)
+    ssh = get_ssh_client(server, port, username, password)
 
-    gzipped = False
+    archive_path = None
     pull_timestamp_folder_from_remote_server = ""  # Initialize the variable
 
     if pull_from_timestamped_folder:
@@ -284,7 +482,6 @@ def main():
             timestamp_folder = get_most_recent_timestamped_folder(ssh, remote_directory)
             if not timestamp_folder:
                 print("No timestamped folders found.")
-                ssh.close()
                 return
             pull_timestamp_folder_from_remote_server = f"{remote_directory}/{timestamp_folder}"
             print(f"Using most recent timestamp folder: {pull_timestamp_folder_from_remote_server}")
@@ -294,26 +491,26 @@ def main():
         # Check if the timestamp folder is gzipped
         stdin, stdout, stderr = ssh.exec_command(f"ls {pull_timestamp_folder_from_remote_server}.tar.gz")
         if stdout.channel.recv_exit_status() == 0:  # The file exists and is gzipped
-            gzipped = True
-            print(f"\nUnzipping the timestamped folder {timestamp_folder}...")
-            unzip_directory(ssh, f"{pull_timestamp_folder_from_remote_server}.tar.gz")
-            remote_dir = pull_timestamp_folder_from_remote_server
+            # Read the result files straight out of the archive instead of unzipping and rezipping it
+            archive_path = f"{pull_timestamp_folder_from_remote_server}.tar.gz"
+            remote_dir = archive_path
     else:
         remote_dir = remote_temp_dir
 
     print(f"\nTransferring files back to the local machine from {remote_dir}...")
-    files_transferred = scp_transfer_back(ssh, remote_dir, list_folder)
+    journal = run_journal.open_journal(list_folder)
+    try:
+        # Files already up to date locally (e.g. harvested while the queue ran) are not downloaded again
+        files_transferred = scp_transfer_back(ssh, remote_dir, list_folder, journal=journal,
+                                              archive_path=archive_path)
+    finally:
+        journal.close()
 
     if files_transferred:
         print(f"File transfer complete. Look in {os.path.join(list_folder, 'TMoleX_output')} for your optimized files!")
+        if constants.use_results_cache:
+            store_results_in_cache(os.path.join(list_folder, 'TMoleX_output'))
 
-    if pull_from_timestamped_folder and gzipped:
-        # Rezip the timestamped folder if it was unzipped earlier
-        print(f"\nRezipping the timestamped folder {timestamp_folder}...")
-        gzip_directory(ssh, pull_timestamp_folder_from_remote_server)
-        print(f"Timestamped folder rezipped: {pull_timestamp_folder_from_remote_server}.tar.gz")
-
-    ssh.close()
 
 if __name__ == "__main__":
     main()
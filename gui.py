@@ -15,7 +15,9 @@ import datetime
 from screeninfo import get_monitors
 import configparser
 import threading
+import multiprocessing
 import queue
+from ssh_connection import get_ssh_client, close_broker
 
 from dictionary import (
     vconf_variables,
@@ -296,8 +298,7 @@ class GUI(tk.Tk):
         self.maxsize(window_width, window_height)
 
         # Initialize other attributes
-        self.ssh_client = paramiko.SSHClient()
-        self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.ssh_client = None  # Shared client from the SSH connection broker, set on connect
         self.is_task_running = False
         self.is_task_complete = False
         self.is_queue_active = False
@@ -648,6 +649,12 @@ class GUI(tk.Tk):
              "Builds a temporary directory to store transient data in at the path described by remote_directory (see below). Can be renamed."),
             ("server", const.server, "Your server address eg. buffalo.edu"),
             ("port", const.port, "default SSH port is 22"),
+            ("transfer_backend", const.transfer_backend,
+             "How files are moved to and from the cluster: sftp (one session, pipelined) or scp (one process per file). Falls back to scp if the server has no SFTP."),
+            ("transfer_connections", const.transfer_connections,
+             "Number of separate SSH connections file transfers are spread over. More helps on slow, high-latency links. Each one is a separate login to the server."),
+            ("max_transfer_concurrency", const.max_transfer_concurrency,
+             "Upper limit on transfers in flight at once. The number actually used adapts to the link: it grows while throughput keeps up and shrinks when the server refuses new channels (sshd MaxSessions) or latency spikes."),
             ("username", const.username, "Whatever your username is"),
             ("password", const.password, "Whatever your password is")
         ])
@@ -2357,33 +2364,9 @@ class GUI(tk.Tk):
         import socket
         import paramiko
 
-        # For legacy SSH servers that choke unless you allow ssh-rsa (SHA1).
-        # This mirrors: -o HostKeyAlgorithms=+ssh-rsa -o PubkeyAcceptedAlgorithms=+ssh-rsa
-        disabled_algorithms = {
-            # Server host-key signature algos (HostKeyAlgorithms equivalent)
-            "keys": ["rsa-sha2-256", "rsa-sha2-512"],
-            # Client public-key auth signature algos (PubkeyAcceptedAlgorithms equivalent)
-            # (Doesn't hurt even if you're using password auth; remove if you want.)
-            "pubkeys": ["rsa-sha2-256", "rsa-sha2-512"],
-        }
-
         try:
-            self.ssh_client = paramiko.SSHClient()
-            self.ssh_client.load_system_host_keys()  # optional; keeps behavior closer to OpenSSH
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-            self.ssh_client.connect(
-                hostname=self.ssh_server,
-                port=getattr(self, "ssh_port", 22),
-                username=self.ssh_username,
-                password=self.ssh_password,
-                look_for_keys=False,
-                allow_agent=False,
-                banner_timeout=200,
-                auth_timeout=200,
-                timeout=20,  # TCP connect timeout
-                disabled_algorithms=disabled_algorithms,
-            )
+            # Reuse the shared connection of the pipeline stages (same port source, so the broker is not replaced)
+            self.ssh_client = get_ssh_client(self.ssh_server, const.port, self.ssh_username, self.ssh_password)
 
             # Open a pseudo-terminal with appropriate dimensions
             self.ssh_channel = self.ssh_client.invoke_shell(term="xterm", width=80, height=24)
@@ -3056,7 +3039,9 @@ class GUI(tk.Tk):
                         continue  # Skip sensitive variables
 
                     # Explicitly check if the key is one of the integer-storing fields
-                    if key in ["geometry_optimize_lowest_energy_structures", "max_conformers"]:
+                    if key in ["geometry_optimize_lowest_energy_structures", "max_conformers",
+                               "array_job_max_concurrent_tasks", "embedding_processes", "embedding_timeout",
+                               "vconf_processes", "selection_energy_window"]:
                         file.write(f"{key}={self.format_value(int(entry.get()))}\n")  # Convert to int and format
                     elif isinstance(entry, tk.BooleanVar):
                         file.write(f"{key}={self.format_value(entry.get())}\n")  # Pass boolean to format_value
@@ -3101,7 +3086,9 @@ class GUI(tk.Tk):
                         value = getattr(const, attr, None)
                         if value is not None:
                             # Special handling for max_conformers and geometry_optimize_lowest_energy_structures
-                            if attr in ["max_conformers", "geometry_optimize_lowest_energy_structures"]:
+                            if attr in ["max_conformers", "geometry_optimize_lowest_energy_structures",
+                                        "array_job_max_concurrent_tasks", "embedding_processes", "embedding_timeout",
+                                        "vconf_processes", "selection_energy_window"]:
                                 formatted_value = self.format_value(str(value))  # Convert these to strings
                             elif isinstance(value, str) and '\\' in value:
                                 # Add 'r' prefix for strings with backslashes (for paths)
@@ -3243,6 +3230,7 @@ class GUI(tk.Tk):
                 self.append_to_console("Forcefully killed the script process.")
             except Exception as e:
                 self.append_to_console(f"Failed to terminate the script process: {e}")
+        close_broker()
         self.destroy()
 
     @staticmethod
@@ -3271,7 +3259,7 @@ class GUI(tk.Tk):
             return
 
         try:
-            self.ssh_client.connect(server, username=username, password=password)
+            self.ssh_client = get_ssh_client(server, const.port, username, password)
             self.ssh_connected = True
             self.append_to_console("Connected to the server successfully.")
         except Exception as e:
@@ -3395,6 +3383,8 @@ def run_main_gui():
 
 
 if __name__ == "__main__":
+    # Worker processes (e.g. parallel embedding) start the bundled executable again and must stop here
+    multiprocessing.freeze_support()
     root = tk.Tk()
     root.withdraw()  # Hide the root window
 
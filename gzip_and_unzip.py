@@ -1,4 +1,5 @@
-import paramiko
+from ssh_connection import get_ssh_client
+import remote_shell
 from constants import (
     server, port, username, password, remote_temp_dir, remote_directory,
     gzip_temp_directory, unzip_temp_directory, unzip_directory_by_name, gzip_directory_by_name,
@@ -10,7 +11,9 @@ def gzip_directory(ssh, directory):
     """
     Gzip the contents of a directory and replace the original directory with the gzipped archive.
     """
-    ssh.exec_command(f"tar -czf {directory}.tar.gz -C {directory} . && rm -rf {directory}")
+    result = remote_shell.run(ssh, f"tar -czf {directory}.tar.gz -C {directory} . && rm -rf {directory}")
+    if result.exit_status != 0:
+        print(f"Error gzipping {directory}: {result.stderr.strip()}")
 
 
 def unzip_directory(ssh, tar_file):
@@ -18,23 +21,26 @@ def unzip_directory(ssh, tar_file):
     Unzip a tar.gz file and restore its contents to the original directory.
     """
     directory = tar_file.replace(".tar.gz", "")
-    ssh.exec_command(f"mkdir -p {directory} && tar -xzf {tar_file} -C {directory} && rm -f {tar_file}")
+    result = remote_shell.run(ssh, f"mkdir -p {directory} && tar -xzf {tar_file} -C {directory} && rm -f {tar_file}")
+    if result.exit_status != 0:
+        print(f"Error unzipping {tar_file}: {result.stderr.strip()}")
 
 
 def delete_file_or_directory(ssh, path):
     """
     Delete a file or directory at the given path.
+    The type check and the removal run as one command on the persistent remote shell.
     """
     if path:
-        # Check if the path is a directory
-        stdin, stdout, stderr = ssh.exec_command(f"if [ -d {path} ]; then echo 'directory'; else echo 'file'; fi")
-        result = stdout.read().decode().strip()
+        result = remote_shell.run(ssh, f"if [ -d {path} ]; then rm -r {path} && echo 'directory'; "
+                                       f"elif [ -e {path} ]; then rm {path} && echo 'file'; fi")
+        kind = result.stdout.strip()
 
-        if result == 'directory':
-            ssh.exec_command(f"rm -r {path}")
+        if result.exit_status != 0:
+            print(f"Could not delete {path}: {result.stderr.strip()}")
+        elif kind == 'directory':
             print(f"Deleted directory: {path}")
-        elif result == 'file':
-            ssh.exec_command(f"rm {path}")
+        elif kind == 'file':
             print(f"Deleted file: {path}")
         else:
             print(f"Path does not exist or is not accessible: {path}")
@@ -45,9 +51,7 @@ def main():
         print("manage_directories.py is disabled")
         return
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(server, port=port, username=username, password=password)
+    ssh = get_ssh_client(server, port, username, password)
 
     if gzip_temp_directory:
         print("Gzipping the temporary directory...")
@@ -73,8 +77,6 @@ def main():
         delete_file_or_directory(ssh, f"{remote_directory}/{delete_file_path}")
         print(f"Deleted the file/folder at {remote_directory}/{delete_file_path}!")
 
-    ssh.close()
-
 
 if __name__ == "__main__":
     main()
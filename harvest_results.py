@@ -0,0 +1,66 @@
+import os
+import shlex
+import file_transfer
+import run_journal
+import transfer_concurrency
+import transfer_manifest
+
+# Written by the last line of every subscript, so a finished job is visible before it leaves the queue
+COMPLETION_MARKER = ".queuety_done"
+
+# Files fetched for each finished conformer as soon as its job is done
+HARVESTED_FILES = ("{mol_name}.cosmo", "energy")
+
+
+def add_completion_marker(subscript_content):
+    """Append the line that leaves the completion marker in the molecule folder once the job is done."""
+    return subscript_content.rstrip("\n") + f"\ntouch {COMPLETION_MARKER}\n"
+
+
+def marked_complete(ssh, remote_dir):
+    """
+    Return the molecule folders of remote_dir that hold the completion marker, found with one find call.
+    """
+    stdin, stdout, stderr = ssh.exec_command(
+        f"cd {shlex.quote(remote_dir)} && find . -mindepth 2 -maxdepth 2 -name {COMPLETION_MARKER}")
+    output = stdout.read().decode()
+    stdout.channel.recv_exit_status()
+    return {line.split("/")[1] for line in output.splitlines() if line.count("/") == 2}
+
+
+def harvest_conformers(ssh, remote_dir, local_target_dir, mol_names, journal=None, backend_name="sftp",
+                       connections=1, max_concurrency=16):
+    """
+    Download the .cosmo and energy files of finished conformers into local_target_dir/<conformer>.
+    The remote files are listed and hashed with one md5sum call, and every download is checked against it.
+    Conformers whose .cosmo file arrived intact are marked as fetched in the run journal.
+    Returns (harvested conformers, conformers without a .cosmo file on the cluster).
+    """
+    if not mol_names:
+        return [], []
+
+    relative_paths = [f"{mol_name}/{file_name.format(mol_name=mol_name)}"
+                      for mol_name in mol_names for file_name in HARVESTED_FILES]
+    expected = transfer_manifest.remote_checksums(ssh, remote_dir, relative_paths)
+
+    downloads = []
+    for relative_path in expected:
+        local_folder_path = os.path.join(local_target_dir, os.path.dirname(relative_path))
+        os.makedirs(local_folder_path, exist_ok=True)
+        downloads.append((f"{remote_dir}/{relative_path}", local_folder_path))
+    with file_transfer.open_transfer_backend(ssh, backend_name, connections=connections) as backend:
+        backend.get_many(downloads, transfer_concurrency.get_controller("harvest downloads", maximum=max_concurrency))
+
+    harvested, missing = [], []
+    for mol_name in mol_names:
+        cosmo_path = f"{mol_name}/{mol_name}.cosmo"
+        if cosmo_path not in expected:
+            missing.append(mol_name)
+            continue
+        local_path = os.path.join(local_target_dir, mol_name, f"{mol_name}.cosmo")
+        if os.path.isfile(local_path) and transfer_manifest.file_md5(local_path) == expected[cosmo_path]:
+            harvested.append(mol_name)
+
+    if journal is not None and harvested:
+        journal.mark(harvested, run_journal.COSMO_FETCHED)
+    return harvested, missing
@@ -0,0 +1,142 @@
+import base64
+import hashlib
+import json
+import os
+import shlex
+import sys
+import threading
+import remote_shell
+
+# Where the agent is kept on the head node, one file per version of its source
+AGENT_DIR = "~/.queuety"
+
+# Requests up to this size travel as a command line argument over the persistent shell, larger ones on stdin
+MAX_ARGUMENT_PAYLOAD = 64 * 1024
+
+# Locate queuety_agent.py next to the other scripts
+if getattr(sys, 'frozen', False):  # Running as an executable
+    _internal_dir = os.path.join(os.path.dirname(os.path.abspath(sys.executable)), '_internal')
+else:  # Running as a script
+    _internal_dir = os.path.dirname(os.path.abspath(__file__))
+
+AGENT_SOURCE_PATH = os.path.join(_internal_dir, 'queuety_agent.py')
+
+# {id(ssh client): remote command that runs the agent}, or None where the head node cannot run it
+_deployed = {}
+_deployed_lock = threading.Lock()
+
+
+class AgentUnavailable(Exception):
+    """The head node has no usable python3 or the agent could not be deployed."""
+
+
+def agent_source():
+    with open(AGENT_SOURCE_PATH, "rb") as f:
+        return f.read()
+
+
+def deploy(ssh):
+    """
+    Make sure the current agent is on the head node and return the command that runs it.
+    The agent file is named after the hash of its source, so an updated agent is uploaded once and an
+    unchanged one costs a single check per connection.
+    """
+    with _deployed_lock:
+        if id(ssh) in _deployed:
+            if _deployed[id(ssh)] is None:
+                raise AgentUnavailable("The head node cannot run the QueueTY agent.")
+            return _deployed[id(ssh)]
+
+        source = agent_source()
+        agent_path = f"{AGENT_DIR}/queuety_agent_{hashlib.md5(source).hexdigest()[:12]}.py"
+        check = remote_shell.run(
+            ssh, "python3 -c 'import sys; sys.exit(sys.version_info < (3, 6))' && "
+                 f"if [ -f {agent_path} ]; then echo deployed; else echo missing; fi")
+        if check.exit_status != 0:
+            _deployed[id(ssh)] = None
+            raise AgentUnavailable(f"No python3 (3.6 or newer) on the head node. {check.stderr.strip()}")
+
+        if check.stdout.strip() != "deployed":
+            stdin, stdout, stderr = ssh.exec_command(
+                f"mkdir -p {AGENT_DIR} && cat > {agent_path}.tmp && mv {agent_path}.tmp {agent_path}")
+            stdin.write(source)
+            stdin.channel.shutdown_write()
+            if stdout.channel.recv_exit_status() != 0:
+                _deployed[id(ssh)] = None
+                raise AgentUnavailable(f"Could not deploy the QueueTY agent: {stderr.read().decode().strip()}")
+            print(f"Deployed the QueueTY helper agent to {agent_path} on the head node.")
+
+        _deployed[id(ssh)] = f"python3 {agent_path}"
+        return _deployed[id(ssh)]
+
+
+def call(ssh, requests):
+    """
+    Send requests ({"op": ..., parameters}) to the agent in one call and return its answers in order.
+    Answers of failed requests hold an "error" message.
+    """
+    command = deploy(ssh)
+    payload = json.dumps(requests).encode('utf-8')
+    if len(payload) <= MAX_ARGUMENT_PAYLOAD:
+        result = remote_shell.run(ssh, f"{command} {base64.b64encode(payload).decode()}")
+        exit_status, output, error = result.exit_status, result.stdout, result.stderr
+    else:
+        stdin, stdout, stderr = ssh.exec_command(command)
+        stdin.write(payload)
+        stdin.channel.shutdown_write()
+        output, error = stdout.read().decode(), stderr.read().decode()
+        exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+        raise AgentUnavailable(f"The QueueTY agent failed: {error.strip()}")
+    return json.loads(output)
+
+
+def request(ssh, op, **parameters):
+    """Send a single request and return its answer, raising RuntimeError if the agent reports an error."""
+    answer = call(ssh, [dict(parameters, op=op)])[0]
+    if "error" in answer:
+        raise RuntimeError(f"{op} failed on the head node: {answer['error']}")
+    return answer
+
+
+def entry_names(ssh, remote_dir, folders_only=False):
+    """
+    Return the sorted names in remote_dir, hidden ones left out, optionally only the folders.
+    A missing directory gives an empty list. Without the agent this falls back to find.
+    """
+    try:
+        answer = call(ssh, [{"op": "listing", "path": remote_dir}])[0]
+        if "error" in answer:
+            return []
+        return [entry["name"] for entry in answer["entries"] if not folders_only or entry["type"] == "dir"]
+    except AgentUnavailable as e:
+        print(f"{e} Listing {remote_dir} with find instead.")
+        type_test = "-type d " if folders_only else ""
+        result = remote_shell.run(ssh, f"find {shlex.quote(remote_dir)} -mindepth 1 -maxdepth 1 {type_test}"
+                                       f"-not -name '.*' -printf '%f\\n'")
+        return sorted(result.stdout.splitlines())
+
+
+def tree_size(ssh, remote_dir):
+    """Return {"files", "bytes", "folders"} for everything below remote_dir."""
+    return request(ssh, "tree_size", path=remote_dir)
+
+
+def hash_manifest(ssh, remote_dir, name_patterns, depth=2):
+    """Return {relative path: (size, mtime, md5)} for matching files `depth` levels below remote_dir."""
+    answer = request(ssh, "hash_manifest", path=remote_dir, patterns=list(name_patterns), depth=depth)
+    return {relative_path: tuple(entry) for relative_path, entry in answer["files"].items()}
+
+
+def pack(ssh, remote_dir, output_path, members=None, compress=True, remove_source=False):
+    """
+    Archive remote_dir (or only the given relative members) into output_path on the head node.
+    Returns {"archive", "files", "bytes", "md5"}.
+    """
+    return request(ssh, "pack", path=remote_dir, output=output_path, members=members, compress=compress,
+                   remove_source=remove_source)
+
+
+def job_status(ssh):
+    """Return {job key: state} for the queued jobs, array tasks keyed as <job id>.<task id>."""
+    return request(ssh, "job_status")["states"]
@@ -0,0 +1,170 @@
+import multiprocessing
+import os
+import time
+from multiprocessing.connection import wait
+from rdkit import Chem, RDLogger
+from rdkit.Chem import AllChem
+
+
+def embed_smiles(smiles, random_seed=42):
+    """
+    Build a 3D structure with hydrogens from a SMILES string and UFF-optimize it.
+    Returns (mol block, formal charge), or (None, error message) if the SMILES or the embedding failed.
+    """
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return None, "invalid SMILES"
+    mol = Chem.AddHs(mol)  # Add hydrogens
+    if AllChem.EmbedMolecule(mol, randomSeed=random_seed) != 0:
+        # Large or strained ring systems often only embed from random starting coordinates
+        if AllChem.EmbedMolecule(mol, randomSeed=random_seed, useRandomCoords=True) != 0:
+            return None, "embedding failed"
+    AllChem.UFFOptimizeMolecule(mol)  # Optimize the geometry to ensure it's properly 3D
+    return Chem.MolToMolBlock(mol), Chem.GetFormalCharge(mol)
+
+
+# First message of every embedding process, sent once it has started and imported RDKit
+READY = "ready"
+
+
+def _worker(connection, random_seed):
+    """Embed the (index, SMILES) tasks sent over connection until it receives None."""
+    RDLogger.DisableLog('rdApp.*')
+    connection.send(READY)
+    while True:
+        task = connection.recv()
+        if task is None:
+            return
+        index, smiles = task
+        try:
+            connection.send((index,) + embed_smiles(smiles, random_seed))
+        except Exception as e:
+            connection.send((index, None, f"{type(e).__name__}: {e}"))
+
+
+class _EmbeddingProcess:
+    def __init__(self, context, random_seed):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_worker, args=(child_connection, random_seed), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.ready = False
+        self.task = None
+        self.timeout = None
+        self.deadline = None
+
+    def send(self, task, timeout):
+        # The clock starts once the process is ready, so spawning it and importing RDKit (seconds on
+        # Windows) do not count against the molecule
+        self.task = task
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if self.ready else None
+        self.connection.send(task)
+
+    def mark_ready(self):
+        self.ready = True
+        if self.task is not None:
+            self.deadline = time.monotonic() + self.timeout
+
+    def stop(self, kill=False):
+        if kill:
+            self.process.kill()
+        else:
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+        self.process.join(5)
+        self.connection.close()
+
+
+def embed_in_parallel(smiles_list, processes=0, timeout=120, random_seed=42):
+    """
+    Embed many SMILES strings on separate processes and yield (index, mol block, charge or error) in the
+    order of smiles_list, each as soon as it and everything before it are done, so the caller can write
+    them out while the rest are still embedding.
+    A molecule taking longer than timeout seconds has its process killed and replaced (if molecules are
+    left), and is reported with mol block None, so one pathological structure cannot stall the batch.
+    processes=0 uses one process per core.
+    """
+    if not smiles_list:
+        return
+    processes = int(processes) or os.cpu_count() or 1
+    processes = max(1, min(processes, len(smiles_list)))
+    tasks = list(enumerate(smiles_list))
+    tasks.reverse()  # Popped from the end, so the list is worked through from the front
+    context = multiprocessing.get_context("spawn")  # The same start method on Windows, macOS and Linux
+    workers = [_EmbeddingProcess(context, random_seed) for _ in range(processes)]
+    results = {}
+    next_index = 0
+
+    try:
+        for worker in workers:
+            worker.send(tasks.pop(), timeout)
+
+        while next_index < len(smiles_list):
+            busy = [worker for worker in workers if worker.task is not None]
+            deadlines = [worker.deadline for worker in busy if worker.deadline is not None]
+            wait_time = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            ready = wait([worker.connection for worker in busy], timeout=wait_time)
+
+            for worker in busy:
+                if worker.connection in ready:
+                    try:
+                        message = worker.connection.recv()
+                    except (EOFError, OSError):  # The process crashed inside RDKit
+                        if not worker.ready:
+                            raise RuntimeError("An embedding process exited before it was ready.")
+                        results[worker.task[0]] = (None, "embedding process crashed")
+                    else:
+                        if message == READY:
+                            worker.mark_ready()
+                            continue
+                        index, mol_block, detail = message
+                        results[index] = (mol_block, detail)
+                        worker.task = None
+                        if tasks:
+                            worker.send(tasks.pop(), timeout)
+                        continue
+                elif worker.deadline is not None and time.monotonic() >= worker.deadline:
+                    results[worker.task[0]] = (None, f"timed out after {timeout} s")
+                else:
+                    continue
+
+                # Kill the stuck or crashed process and start a new one only if molecules are left for it
+                worker.stop(kill=True)
+                workers.remove(worker)
+                if tasks:
+                    replacement = _EmbeddingProcess(context, random_seed)
+                    workers.append(replacement)
+                    replacement.send(tasks.pop(), timeout)
+
+            while next_index in results:
+                yield (next_index,) + results.pop(next_index)
+                next_index += 1
+    finally:
+        for worker in workers:
+            worker.stop(kill=worker.task is not None)
+
+
+class StreamingSDFWriter:
+    """Append mol blocks to an SDF file one record at a time, so finished molecules are on disk right away."""
+
+    def __init__(self, sdf_path):
+        self.file = open(sdf_path, "w")
+
+    def write(self, mol_block, name=None):
+        if name is not None:
+            mol_block = name + "\n" + mol_block.split("\n", 1)[1]
+        self.file.write(mol_block)
+        self.file.write("$$$$\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,152 @@
+import importlib
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Stage:
+    """
+    One importable pipeline stage.
+
+    `requires` and `produces` name the artifacts (files, remote directories, queued jobs) the stage
+    reads and writes. A stage starts as soon as every artifact it requires is available.
+    """
+
+    def __init__(self, name, module_name, enabled, requires=(), produces=(), entry_point="main"):
+        self.name = name
+        self.module_name = module_name
+        self.enabled = enabled
+        self.requires = set(requires)
+        self.produces = set(produces)
+        self.entry_point = entry_point
+
+    def run(self):
+        """Import the stage module and call its entry point."""
+        module = importlib.import_module(self.module_name)
+        return getattr(module, self.entry_point)()
+
+
+class StageGraph:
+    """
+    Run stages as a DAG, overlapping every stage whose inputs are ready.
+
+    Artifacts produced by disabled stages are assumed to exist from an earlier run, which matches how
+    the scripts behaved when they were executed one after another.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    PASSED = "passed"
+    FAILED = "failed"
+    DISABLED = "disabled"
+    SKIPPED = "skipped"
+
+    def __init__(self, stages, should_stop=lambda: False, poll_interval=0.5):
+        self.stages = {stage.name: stage for stage in stages}
+        self.should_stop = should_stop
+        self.poll_interval = poll_interval
+        self.status = {name: self.PENDING for name in self.stages}
+        self.durations = {}
+        self._lock = threading.Lock()
+        self._check_graph()
+
+    def _check_graph(self):
+        """Make sure every required artifact has a producer and that the graph has no cycles."""
+        producers = {}
+        for stage in self.stages.values():
+            for artifact in stage.produces:
+                producers.setdefault(artifact, []).append(stage.name)
+
+        for stage in self.stages.values():
+            missing = [artifact for artifact in stage.requires if artifact not in producers]
+            if missing:
+                raise ValueError(f"Stage {stage.name} requires artifacts nobody produces: {missing}")
+
+        self.producers = producers
+        visiting, visited = set(), set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage graph has a cycle through {name}")
+            visiting.add(name)
+            for upstream in self.upstream_stages(name):
+                visit(upstream)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def upstream_stages(self, name):
+        """Return the names of the stages that produce something this stage requires."""
+        return {producer for artifact in self.stages[name].requires for producer in self.producers[artifact]}
+
+    def _ready(self, name):
+        upstream = [self.status[producer] for producer in self.upstream_stages(name)]
+        return all(state in (self.PASSED, self.DISABLED) for state in upstream)
+
+    def _blocked(self, name):
+        upstream = [self.status[producer] for producer in self.upstream_stages(name)]
+        return any(state in (self.FAILED, self.SKIPPED) for state in upstream)
+
+    def _run_stage(self, stage):
+        start_time = time.time()
+        print(f"Running stage: {stage.name}")
+        sys.stdout.flush()
+        try:
+            result = stage.run()
+        finally:
+            self.durations[stage.name] = time.time() - start_time
+        return result is not False
+
+    def run(self):
+        """
+        Run every stage, returning True if no enabled stage failed or was skipped.
+        """
+        futures = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(self.stages))) as executor:
+            while True:
+                with self._lock:
+                    for name, stage in self.stages.items():
+                        if self.status[name] != self.PENDING:
+                            continue
+                        if self._blocked(name):
+                            self.status[name] = self.SKIPPED
+                            print(f"\nSkipping {name}: an upstream stage did not pass.\n")
+                        elif not stage.enabled and self._ready(name):
+                            self.status[name] = self.DISABLED
+                            print(f"\n{name} is disabled\n")
+                        elif self._ready(name):
+                            if self.should_stop():
+                                self.status[name] = self.SKIPPED
+                                print(f"\nExecution of {name} was terminated.\n")
+                                continue
+                            self.status[name] = self.RUNNING
+                            futures[executor.submit(self._run_stage, stage)] = name
+                    sys.stdout.flush()
+
+                if not futures:
+                    if any(state == self.PENDING for state in self.status.values()):
+                        continue  # Statuses changed this pass, so re-evaluate the remaining stages
+                    break
+
+                done, _ = wait(futures, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = futures.pop(future)
+                    try:
+                        passed = future.result()
+                    except Exception as e:
+                        print(f"\nError occurred while running {name}: {e}\n")
+                        passed = False
+                    with self._lock:
+                        self.status[name] = self.PASSED if passed else self.FAILED
+                    if passed:
+                        print(r"////////////////////////////////////")
+                        print(f"{name} passed! ({self.durations.get(name, 0):.1f} s)")
+                        print(r"\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\"f"\n\n\n")
+                    sys.stdout.flush()
+
+        return all(state in (self.PASSED, self.DISABLED) for state in self.status.values())
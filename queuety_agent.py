@@ -0,0 +1,153 @@
+"""
+Helper deployed to the cluster head node by head_node_agent.py.
+
+It reads a JSON list of requests (base64 encoded as the first argument, or on stdin) and prints a JSON list
+with one answer per request, so a stage can ask for listings, sizes, hashes, archives and job states in a
+single call instead of parsing ls, find and qstat output. Only the standard library is used, and the script
+has to keep running on the head node's own python3 (3.6 or newer).
+"""
+import base64
+import fnmatch
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import xml.etree.ElementTree as ET
+
+
+def file_md5(path):
+    hash_md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+def visible_walk(path):
+    """os.walk that leaves out hidden folders such as .templates and .array."""
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        yield root, dirs, sorted(files)
+
+
+def listing(path, hidden=False):
+    entries = []
+    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        if entry.name.startswith(".") and not hidden:
+            continue
+        entry_stat = entry.stat(follow_symlinks=False)
+        entries.append({"name": entry.name, "type": "dir" if entry.is_dir() else "file",
+                        "size": entry_stat.st_size, "mtime": int(entry_stat.st_mtime)})
+    return {"entries": entries}
+
+
+def tree_size(path):
+    files, total_bytes, folders = 0, 0, 0
+    for root, dirs, names in os.walk(path):
+        folders += len(dirs)
+        for name in names:
+            files += 1
+            total_bytes += os.lstat(os.path.join(root, name)).st_size
+    return {"files": files, "bytes": total_bytes, "folders": folders}
+
+
+def hash_manifest(path, patterns=("*",), depth=2):
+    """{relative path: [size, mtime, md5]} for the files `depth` levels down whose name matches a pattern."""
+    files = {}
+    for root, dirs, names in visible_walk(path):
+        relative_root = os.path.relpath(root, path)
+        level = 0 if relative_root == "." else relative_root.count(os.sep) + 1
+        if level >= depth - 1:
+            dirs[:] = []
+        if level != depth - 1:
+            continue
+        for name in names:
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                file_path = os.path.join(root, name)
+                file_stat = os.stat(file_path)
+                relative_path = os.path.relpath(file_path, path).replace(os.sep, "/")
+                files[relative_path] = [file_stat.st_size, int(file_stat.st_mtime), file_md5(file_path)]
+    return {"files": files}
+
+
+def pack(path, output, members=None, compress=True, remove_source=False):
+    """
+    Archive the folder (or only the given relative members) into output, laid out like tar -C path . so
+    existing readers of the archives keep working.
+    """
+    file_count = 0
+    with tarfile.open(output, "w:gz" if compress else "w") as archive:
+        if members is None:
+            archive.add(path, arcname=".")
+            file_count = tree_size(path)["files"]
+        else:
+            for member in members:
+                archive.add(os.path.join(path, member), arcname="./" + member)
+                file_count += 1
+    if remove_source:
+        subprocess.check_call(["rm", "-rf", path])
+    return {"archive": output, "files": file_count, "bytes": os.path.getsize(output), "md5": file_md5(output)}
+
+
+def expand_task_range(task_text):
+    task_ids = []
+    for part in task_text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        span, _, step = part.partition(":")
+        first, _, last = span.partition("-")
+        task_ids.extend(str(task_id) for task_id in range(int(first), int(last or first) + 1, int(step or 1)))
+    return task_ids
+
+
+def job_status():
+    """{job key: state} for the user's jobs, array tasks keyed as <job id>.<task id>."""
+    process = subprocess.Popen(["qstat", "-xml"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error = process.communicate()
+    if process.returncode == 0:
+        states = {}
+        for job in ET.fromstring(output).iter("job_list"):
+            job_id = (job.findtext("JB_job_number") or "").strip()
+            if not job_id:
+                continue
+            state = (job.findtext("state") or "").strip() or job.get("state", "")
+            tasks = job.findtext("tasks")
+            for task_id in expand_task_range(tasks) if tasks else [None]:
+                states[job_id if task_id is None else job_id + "." + task_id] = state
+        return {"states": states, "source": "qstat -xml"}
+
+    output = subprocess.check_output(["qstat"]).decode()
+    states = {line.split()[0]: line.split()[4] for line in output.splitlines()[2:] if len(line.split()) > 4}
+    return {"states": states, "source": "qstat"}
+
+
+OPERATIONS = {
+    "listing": listing,
+    "tree_size": tree_size,
+    "hash_manifest": hash_manifest,
+    "pack": pack,
+    "job_status": job_status,
+}
+
+
+def answer(request):
+    request = dict(request)
+    operation = OPERATIONS.get(request.pop("op", None))
+    if operation is None:
+        return {"error": "unknown operation"}
+    try:
+        return operation(**request)
+    except Exception as e:
+        return {"error": "{}: {}".format(type(e).__name__, e)}
+
+
+def main():
+    payload = base64.b64decode(sys.argv[1]) if len(sys.argv) > 1 else sys.stdin.buffer.read()
+    json.dump([answer(request) for request in json.loads(payload.decode())], sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import os
+import time
+from rdkit import Chem, RDLogger, rdBase
+from rdkit.Chem import AllChem, rdMolAlign, rdMolDescriptors
+
+# Maximum minimization iterations per conformer
+MAX_MINIMIZATION_ITERATIONS = 2000
+
+
+def conformers_to_embed(mol):
+    """
+    Number of ETKDG conformers to embed for a molecule, growing with its flexibility
+    (50 up to 7 rotatable bonds, 200 up to 12, 300 beyond).
+    """
+    rotatable_bonds = rdMolDescriptors.CalcNumRotatableBonds(mol)
+    if rotatable_bonds <= 7:
+        return 50
+    if rotatable_bonds <= 12:
+        return 200
+    return 300
+
+
+def minimize_conformers(mol, num_threads=0):
+    """
+    Minimize every conformer of mol in place with MMFF94, or UFF where MMFF has no parameters for the
+    molecule. Returns (force field name, energies in kcal/mol by conformer id).
+    """
+    if AllChem.MMFFHasAllMoleculeParams(mol):
+        results = AllChem.MMFFOptimizeMoleculeConfs(mol, numThreads=num_threads, maxIters=MAX_MINIMIZATION_ITERATIONS)
+        forcefield = "MMFF94"
+    else:
+        results = AllChem.UFFOptimizeMoleculeConfs(mol, numThreads=num_threads, maxIters=MAX_MINIMIZATION_ITERATIONS)
+        forcefield = "UFF"
+    conformer_ids = [conformer.GetId() for conformer in mol.GetConformers()]
+    return forcefield, {conformer_id: energy for conformer_id, (_, energy) in zip(conformer_ids, results)}
+
+
+def prune_conformers(mol, energies, energy_cutoff, distance_tolerance, energy_tolerance):
+    """
+    Filter minimized conformers the way VConf does and return the kept conformer ids, lowest energy first:
+    conformers more than energy_cutoff kcal/mol above the minimum are dropped, and of two conformers within
+    energy_tolerance kcal/mol whose symmetry-corrected heavy atom RMSD is below distance_tolerance Å, the
+    higher energy one is dropped.
+    """
+    heavy_atoms = Chem.RemoveHs(mol)
+    lowest_energy = min(energies.values())
+    kept = []
+    for conformer_id in sorted(energies, key=energies.get):
+        if energies[conformer_id] - lowest_energy > energy_cutoff:
+            break
+        duplicate = False
+        for kept_id in kept:
+            if energies[conformer_id] - energies[kept_id] >= energy_tolerance:
+                continue
+            if rdMolAlign.GetBestRMS(heavy_atoms, heavy_atoms, prbId=conformer_id, refId=kept_id) < distance_tolerance:
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append(conformer_id)
+    return kept
+
+
+def search_conformers(mol, energy_cutoff, distance_tolerance, energy_tolerance, random_seed=42, num_threads=0):
+    """
+    Run an ETKDG conformer search on mol (with explicit hydrogens) using num_threads threads (0 = all).
+    Returns (force field name, [(conformer id, energy)] lowest energy first); mol keeps every embedded conformer.
+    """
+    params = AllChem.ETKDGv3()
+    params.randomSeed = random_seed
+    params.numThreads = num_threads
+    params.pruneRmsThresh = distance_tolerance  # Skips near duplicates before they are minimized
+    conformer_ids = list(AllChem.EmbedMultipleConfs(mol, numConfs=conformers_to_embed(mol), params=params))
+    if not conformer_ids:
+        params.useRandomCoords = True
+        conformer_ids = list(AllChem.EmbedMultipleConfs(mol, numConfs=conformers_to_embed(mol), params=params))
+    if not conformer_ids:
+        return None, []
+
+    forcefield, energies = minimize_conformers(mol, num_threads)
+    kept = prune_conformers(mol, energies, energy_cutoff, distance_tolerance, energy_tolerance)
+    return forcefield, [(conformer_id, energies[conformer_id]) for conformer_id in kept]
+
+
+def write_confs_file(mol, conformers, path):
+    """
+    Write the conformers as <name>_confs.sdf like VConf does, lowest energy first with an Energy property.
+    The file is written under a temporary name and renamed, so readers never see half of it.
+    """
+    temporary_path = path + ".tmp"
+    writer = Chem.SDWriter(temporary_path)
+    for conformer_id, energy in conformers:
+        mol.SetProp('Energy', f"{energy:.4f}")
+        writer.write(mol, confId=conformer_id)
+    writer.close()
+    os.replace(temporary_path, path)
+
+
+def run_conformer_search(settings, num_molecules, output_dir, random_seed=42):
+    """
+    Conformer search for molecules FIRST_MOLECULE to LAST_MOLECULE of the input SDF with RDKit instead of
+    VConf, using the ENERGY_CUTOFF, ENERGY_TOLERANCE and DISTANCE_TOLERANCE of the VConf settings.
+    Each molecule gets a <name>_confs.sdf in output_dir and a line in OUTPUT_LOG.
+    """
+    RDLogger.DisableLog('rdApp.warning')
+    first_molecule = int(settings['FIRST_MOLECULE'])
+    last_molecule = num_molecules if settings['LAST_MOLECULE'] in ("None", None) else int(settings['LAST_MOLECULE'])
+    energy_cutoff = float(settings['ENERGY_CUTOFF'])
+    distance_tolerance = float(settings['DISTANCE_TOLERANCE'])
+    energy_tolerance = float(settings['ENERGY_TOLERANCE'])
+
+    supplier = Chem.SDMolSupplier(settings['SDF_FILENAME'], removeHs=False)
+    start_time = time.time()
+    with open(settings['OUTPUT_LOG'], "w") as log:
+        log.write(f"RDKit {rdBase.rdkitVersion} ETKDG conformer search, molecules {first_molecule}-{last_molecule}, "
+                  f"energy cutoff {energy_cutoff} kcal/mol, distance tolerance {distance_tolerance} A\n")
+        for index in range(first_molecule - 1, last_molecule):
+            mol = supplier[index]
+            if mol is None:
+                print(f"Molecule {index + 1} could not be read from {settings['SDF_FILENAME']}, skipping it.")
+                continue
+            name = mol.GetProp('_Name')
+            molecule_start = time.time()
+            forcefield, conformers = search_conformers(mol, energy_cutoff, distance_tolerance, energy_tolerance,
+                                                       random_seed)
+            if not conformers:
+                message = f"{name}: embedding failed"
+            else:
+                write_confs_file(mol, conformers, os.path.join(output_dir, f"{name}_confs.sdf"))
+                message = (f"{name}: {len(conformers)} conformers kept of {mol.GetNumConformers()} embedded "
+                           f"({forcefield}), lowest energy {conformers[0][1]:.4f} kcal/mol, "
+                           f"{time.time() - molecule_start:.1f} s")
+            print(message)
+            log.write(message + "\n")
+            log.flush()
+    print(f"RDKit conformer search completed in {time.time() - start_time:.1f} s.")
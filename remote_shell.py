@@ -0,0 +1,153 @@
+import shlex
+import socket
+import threading
+import uuid
+from async_remote import RemoteResult
+
+# How long a read waits for stdout before checking stderr again
+READ_POLL_INTERVAL = 0.05
+
+# Bytes of framed commands written before their answers are read. Keeps a batch well inside the channel
+# window, so the shell never blocks on output nobody reads while the rest of the batch is still being sent.
+MAX_BATCH_BYTES = 64 * 1024
+
+_shells = {}
+_shells_lock = threading.Lock()
+
+
+class RemoteShellClosed(Exception):
+    """The persistent shell went away (e.g. the connection dropped) before answering."""
+
+
+class RemoteShell:
+    """
+    One long-lived /bin/sh on an exec channel, reused for many short commands.
+
+    Each command runs in a subshell with stdin from /dev/null, so cd, exit or a read cannot disturb the
+    shell itself. After it, the shell prints a sentinel line with the exit status on stdout and one on
+    stderr, which frame the command's output on both streams. run_many writes up to MAX_BATCH_BYTES of
+    commands before reading their answers, so a batch costs a round trip per chunk instead of a channel per
+    command.
+    """
+
+    def __init__(self, ssh):
+        self.ssh = ssh
+        self.transport = ssh.get_transport()
+        self.channel = self.transport.open_session()
+        self.channel.exec_command("/bin/sh")
+        self.channel.settimeout(READ_POLL_INTERVAL)
+        self._sentinel = f"__queuety_{uuid.uuid4().hex}"
+        self._count = 0
+        self._stdout = b""
+        self._stderr = b""
+        self._lock = threading.Lock()
+
+    def is_alive(self):
+        return not self.channel.closed and not self.channel.exit_status_ready() and self.transport.is_active()
+
+    def _frame(self, command, marker):
+        return (f"(\n{command}\n) </dev/null; __queuety_status=$?; "
+                f"printf '\\n{marker} %d\\n' \"$__queuety_status\"; printf '\\n{marker}\\n' >&2\n")
+
+    def _receive(self):
+        received = False
+        if self.channel.recv_stderr_ready():
+            self._stderr += self.channel.recv_stderr(65536)
+            received = True
+        try:
+            chunk = self.channel.recv(65536)
+            if not chunk:
+                raise RemoteShellClosed("The remote shell closed its output.")
+            self._stdout += chunk
+            received = True
+        except socket.timeout:
+            pass
+        if not received and self.channel.exit_status_ready():
+            raise RemoteShellClosed("The remote shell exited.")
+
+    def _read_answer(self, command, marker):
+        stdout_end = f"\n{marker} ".encode()
+        stderr_end = f"\n{marker}\n".encode()
+        while True:
+            stdout_index = self._stdout.find(stdout_end)
+            line_end = self._stdout.find(b"\n", stdout_index + len(stdout_end)) if stdout_index >= 0 else -1
+            stderr_index = self._stderr.find(stderr_end)
+            if line_end >= 0 and stderr_index >= 0:
+                break
+            self._receive()
+
+        exit_status = int(self._stdout[stdout_index + len(stdout_end):line_end])
+        stdout = self._stdout[:stdout_index].decode(errors="replace")
+        stderr = self._stderr[:stderr_index].decode(errors="replace")
+        self._stdout = self._stdout[line_end + 1:]
+        self._stderr = self._stderr[stderr_index + len(stderr_end):]
+        return RemoteResult(command, exit_status, stdout, stderr)
+
+    def _send_and_read(self, pending):
+        self.channel.sendall(b"".join(request for _, _, request in pending))
+        return [self._read_answer(command, marker) for command, marker, _ in pending]
+
+    def run_many(self, commands):
+        """
+        Send the commands in chunks of up to MAX_BATCH_BYTES, reading each chunk's answers before sending the
+        next, and return their RemoteResults in order.
+        """
+        with self._lock:
+            results = []
+            pending = []
+            pending_bytes = 0
+            for command in commands:
+                self._count += 1
+                marker = f"{self._sentinel}_{self._count}"
+                request = self._frame(command, marker).encode('utf-8')
+                if pending and pending_bytes + len(request) > MAX_BATCH_BYTES:
+                    results.extend(self._send_and_read(pending))
+                    pending, pending_bytes = [], 0
+                pending.append((command, marker, request))
+                pending_bytes += len(request)
+            if pending:
+                results.extend(self._send_and_read(pending))
+            return results
+
+    def run(self, command):
+        """Run one command and return its RemoteResult."""
+        return self.run_many([command])[0]
+
+    def close(self):
+        self.channel.close()
+
+
+def get_shell(ssh):
+    """
+    Return the persistent shell of this SSH client, opening it on first use and again after the channel or
+    the connection behind it went away.
+    """
+    with _shells_lock:
+        shell = _shells.get(id(ssh))
+        if shell is None or shell.ssh is not ssh or not shell.is_alive():
+            shell = RemoteShell(ssh)
+            _shells[id(ssh)] = shell
+        return shell
+
+
+def run_many(ssh, commands):
+    """Run commands through the persistent shell of ssh, reopening it once if it died mid batch."""
+    try:
+        return get_shell(ssh).run_many(commands)
+    except RemoteShellClosed:
+        return get_shell(ssh).run_many(commands)
+
+
+def run(ssh, command):
+    """Run one command through the persistent shell of ssh."""
+    return run_many(ssh, [command])[0]
+
+
+def make_directories(ssh, remote_dirs):
+    """
+    Create remote directories with one batch of mkdir -p calls. Returns the directories that could not be
+    created.
+    """
+    results = run_many(ssh, [f"mkdir -p {shlex.quote(remote_dir)} && test -d {shlex.quote(remote_dir)}"
+                             for remote_dir in remote_dirs])
+    return [remote_dir for remote_dir, result in zip(remote_dirs, results) if result.exit_status != 0]
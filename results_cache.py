@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from datetime import datetime
+
+# Name of the cache folder inside compound_list_directory, shared by every compound list
+CACHE_FOLDER_NAME = "results_cache"
+
+# Per-list file mapping each conformer name of the current run to its cache key
+RUN_KEYS_FILE_NAME = "results_cache_keys.json"
+
+# Output files kept per conformer
+CACHED_FILE_KINDS = (".cosmo", "energy", "control")
+
+# VConf settings that only name files or pick a slice of the list, and so do not change the conformers
+_VCONF_PATH_SETTINGS = {"SDF_FILENAME", "OUTPUT_LOG", "OUTPUT_SDF", "vconf_batch_sdf_path",
+                        "FIRST_MOLECULE", "LAST_MOLECULE"}
+
+
+def sha256_text(text):
+    """Return the SHA-256 hex digest of a string."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def sha256_file(file_path):
+    """Return the SHA-256 hex digest of a local file."""
+    hash_sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            hash_sha256.update(chunk)
+    return hash_sha256.hexdigest()
+
+
+def vconf_settings_hash(settings):
+    """
+    Hash the VConf settings that affect which conformers are generated.
+    """
+    relevant = {key: str(value) for key, value in settings.items() if key not in _VCONF_PATH_SETTINGS}
+    return sha256_text(json.dumps(relevant, sort_keys=True))
+
+
+def templates_hash(template_paths, extra_settings=None):
+    """
+    Hash the define/go_define/cosmoprep/subscript templates plus any settings that change how they are used.
+    """
+    parts = []
+    for template_path in template_paths:
+        with open(template_path, 'r') as template_file:
+            parts.append(template_file.read())
+    parts.append(json.dumps(extra_settings or {}, sort_keys=True))
+    return sha256_text("\0".join(parts))
+
+
+def conformer_key(canonical_smiles, charge, conformer_index, settings_hash, template_hash, geometry_optimized):
+    """
+    Build the cache key of one conformer's results.
+    """
+    return sha256_text("|".join([
+        canonical_smiles,
+        str(charge),
+        str(conformer_index),
+        settings_hash,
+        template_hash,
+        "go" if geometry_optimized else "sp"
+    ]))
+
+
+def run_keys_path(list_folder):
+    return os.path.join(list_folder, RUN_KEYS_FILE_NAME)
+
+
+def save_run_keys(list_folder, keys, merge=False):
+    """
+    Write the conformer name -> cache key mapping of the current run, optionally merging into the existing one.
+    """
+    if merge:
+        existing = load_run_keys(list_folder)
+        existing.update(keys)
+        keys = existing
+    with open(run_keys_path(list_folder), 'w') as keys_file:
+        json.dump(keys, keys_file, indent=1, sort_keys=True)
+
+
+def load_run_keys(list_folder):
+    """Return the conformer name -> cache key mapping of the current run, or an empty dict."""
+    path = run_keys_path(list_folder)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as keys_file:
+        return json.load(keys_file)
+
+
+class ResultsCache:
+    """
+    Content-addressed store of finished conformer results.
+
+    An SQLite index maps each conformer key to the blobs of its .cosmo, energy and control files.
+    Blobs are stored once under blobs/<first two hex digits>/<sha256>.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, "results_cache.sqlite"), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT NOT NULL,"
+            " file_kind TEXT NOT NULL,"
+            " blob_sha256 TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " stored_at TEXT NOT NULL,"
+            " PRIMARY KEY (key, file_kind))"
+        )
+        self._db.commit()
+
+    def _blob_path(self, blob_sha256):
+        return os.path.join(self.blob_dir, blob_sha256[:2], blob_sha256)
+
+    def lookup(self, key):
+        """
+        Return {file_kind: blob path} for a key, or None unless a .cosmo file is cached for it.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT file_kind, blob_sha256 FROM results WHERE key = ?", (key,)).fetchall()
+        files = {file_kind: self._blob_path(blob_sha256) for file_kind, blob_sha256 in rows
+                 if os.path.exists(self._blob_path(blob_sha256))}
+        return files if ".cosmo" in files else None
+
+    def contains(self, key):
+        return self.lookup(key) is not None
+
+    def store(self, key, files):
+        """
+        Store a conformer's result files, given as {file_kind: local path}.
+        """
+        records = []
+        for file_kind, local_path in files.items():
+            blob_sha256 = sha256_file(local_path)
+            blob_path = self._blob_path(blob_sha256)
+            if not os.path.exists(blob_path):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                temp_path = f"{blob_path}.part"
+                shutil.copyfile(local_path, temp_path)
+                os.replace(temp_path, blob_path)  # Never leave a half-written blob behind
+            records.append((key, file_kind, blob_sha256, os.path.getsize(blob_path),
+                            datetime.now().isoformat(timespec="seconds")))
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", records)
+            self._db.commit()
+
+    def materialize(self, key, file_kind, target_path):
+        """
+        Copy one cached file to target_path. Returns False if it is not cached.
+        """
+        files = self.lookup(key)
+        if not files or file_kind not in files:
+            return False
+        shutil.copyfile(files[file_kind], target_path)
+        return True
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def open_cache(compound_list_directory):
+    """Open the results cache shared by every list in compound_list_directory."""
+    return ResultsCache(os.path.join(compound_list_directory, CACHE_FOLDER_NAME))
+
+
+def collect_result_files(conformer_dir, mol_name):
+    """
+    Return {file_kind: path} for the cacheable output files present in one conformer's local folder.
+    """
+    files = {}
+    for file_kind in CACHED_FILE_KINDS:
+        file_name = f"{mol_name}.cosmo" if file_kind == ".cosmo" else file_kind
+        path = os.path.join(conformer_dir, file_name)
+        if os.path.isfile(path):
+            files[file_kind] = path
+    return files
@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+# Per-list journal of how far each conformer got, kept next to the compound list
+JOURNAL_FILE_NAME = "run_journal.sqlite"
+
+# Steps recorded for every conformer, in the order the stages reach them
+COORD_UPLOADED = "coord_uploaded"
+SCRIPTS_UPLOADED = "scripts_uploaded"
+TX_PASS = "tx_pass"
+DEFINE_PASS = "define_pass"
+COSMOPREP_PASS = "cosmoprep_pass"
+FINISHED = "finished"
+COSMO_FETCHED = "cosmo_fetched"
+STEPS = (COORD_UPLOADED, SCRIPTS_UPLOADED, TX_PASS, DEFINE_PASS, COSMOPREP_PASS, FINISHED, COSMO_FETCHED)
+
+# Steps that only hold as long as the conformer's folder still exists in the remote temp directory
+REMOTE_STEPS = (COORD_UPLOADED, SCRIPTS_UPLOADED, TX_PASS, DEFINE_PASS, COSMOPREP_PASS)
+
+
+class RunJournal:
+    """
+    Persistent record of each conformer's progress through the remote pipeline.
+
+    A run is identified by a fingerprint of its inputs. A later run with the same fingerprint resumes from
+    the journal and only redoes the steps that are not recorded yet.
+    """
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(journal_path, check_same_thread=False)
+        step_columns = ", ".join(f"{step} INTEGER NOT NULL DEFAULT 0" for step in STEPS)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute(
+            f"CREATE TABLE IF NOT EXISTS conformers (name TEXT PRIMARY KEY, {step_columns},"
+            f" job_id TEXT, updated_at TEXT)"
+        )
+        self._db.commit()
+
+    def _now(self):
+        return datetime.now().isoformat(timespec="seconds")
+
+    def fingerprint(self):
+        """Return the fingerprint of the run recorded in the journal, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        return row[0] if row else None
+
+    def matches(self, fingerprint):
+        """Check whether the journal belongs to a run with this fingerprint and has anything to resume."""
+        return self.fingerprint() == fingerprint and bool(self.names())
+
+    def start_run(self, fingerprint):
+        """Forget the previous run and start a new one."""
+        with self._lock:
+            self._db.execute("DELETE FROM conformers")
+            self._db.execute("DELETE FROM meta WHERE key = 'array_job_ids'")
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('started_at', ?)", (self._now(),))
+            self._db.commit()
+
+    def add_conformers(self, names):
+        """Add conformers to the run, keeping the progress of the ones already recorded."""
+        with self._lock:
+            self._db.executemany("INSERT OR IGNORE INTO conformers (name, updated_at) VALUES (?, ?)",
+                                 [(name, self._now()) for name in names])
+            self._db.commit()
+
+    def names(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT name FROM conformers ORDER BY name")]
+
+    def mark(self, names, step, value=True):
+        """Record (or clear) one step for the given conformers."""
+        if step not in STEPS:
+            raise ValueError(f"Unknown journal step: {step}")
+        if isinstance(names, str):
+            names = [names]
+        with self._lock:
+            self._db.executemany(f"UPDATE conformers SET {step} = ?, updated_at = ? WHERE name = ?",
+                                 [(int(value), self._now(), name) for name in names])
+            self._db.commit()
+
+    def has(self, name, step):
+        with self._lock:
+            row = self._db.execute(f"SELECT {step} FROM conformers WHERE name = ?", (name,)).fetchone()
+        return bool(row and row[0])
+
+    def done(self, step, names=None):
+        """Return the set of conformers with this step recorded, optionally limited to names."""
+        with self._lock:
+            done = {row[0] for row in self._db.execute(f"SELECT name FROM conformers WHERE {step} = 1")}
+        return done if names is None else done & set(names)
+
+    def pending(self, step, names):
+        """Return the conformers from names that still need this step, in the given order."""
+        done = self.done(step, names)
+        return [name for name in names if name not in done]
+
+    def set_job_id(self, name, job_id):
+        with self._lock:
+            self._db.execute("UPDATE conformers SET job_id = ?, updated_at = ? WHERE name = ?",
+                             (str(job_id), self._now(), name))
+            self._db.commit()
+
+    def job_ids(self):
+        """Return {conformer name: qsub job id} for the submitted conformers."""
+        with self._lock:
+            rows = self._db.execute("SELECT name, job_id FROM conformers WHERE job_id IS NOT NULL").fetchall()
+        return dict(rows)
+
+    def add_array_job_id(self, job_id):
+        """Remember an array job submitted for this run."""
+        job_ids = self.array_job_ids()
+        if str(job_id) not in job_ids:
+            job_ids.append(str(job_id))
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('array_job_ids', ?)", (",".join(job_ids),))
+            self._db.commit()
+
+    def array_job_ids(self):
+        """Return the ids of the array jobs submitted for this run."""
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'array_job_ids'").fetchone()
+        return row[0].split(",") if row and row[0] else []
+
+    def forget_remote_progress(self, names):
+        """Clear the remote steps and job id of conformers whose remote folder has disappeared."""
+        assignments = ", ".join(f"{step} = 0" for step in REMOTE_STEPS)
+        with self._lock:
+            self._db.executemany(f"UPDATE conformers SET {assignments}, job_id = NULL, updated_at = ? WHERE name = ?",
+                                 [(self._now(), name) for name in names])
+            self._db.commit()
+
+    def summary(self):
+        """Return a one-line count of the conformers that reached each step."""
+        with self._lock:
+            total = self._db.execute("SELECT COUNT(*) FROM conformers").fetchone()[0]
+            counts = [f"{step}: {self._db.execute(f'SELECT COUNT(*) FROM conformers WHERE {step} = 1').fetchone()[0]}"
+                      for step in STEPS]
+            submitted = self._db.execute("SELECT COUNT(*) FROM conformers WHERE job_id IS NOT NULL").fetchone()[0]
+        return f"{total} conformers | " + " | ".join(counts) + f" | submitted: {submitted}"
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def open_journal(list_folder):
+    """Open the run journal of a compound list."""
+    return RunJournal(os.path.join(list_folder, JOURNAL_FILE_NAME))
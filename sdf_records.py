@@ -0,0 +1,72 @@
+import re
+from array import array
+
+# Bytes read at a time while scanning an SDF file for record ends
+SCAN_CHUNK_SIZE = 1024 * 1024
+
+RECORD_END = b"\n$$$$"
+ENERGY_PATTERN = re.compile(rb">\s*<Energy>[^\n]*\n\s*([-+0-9.eE]+)")
+
+
+def record_ends(path):
+    """
+    Scan an SDF file for its $$$$ lines in large binary chunks and return the byte offset just after each,
+    as an array('q'), so record i spans ends[i - 1] (0 for the first) to ends[i].
+    A last record without a $$$$ line (a file still being written) is not counted.
+    """
+    ends = array('q')
+    with open(path, 'rb') as f:
+        buffer = b"\n"  # Lets a $$$$ on the very first line match too
+        buffer_start = -1  # File offset of buffer[0]
+        while True:
+            chunk = f.read(SCAN_CHUNK_SIZE)
+            buffer += chunk
+            search_from = 0
+            while True:
+                marker = buffer.find(RECORD_END, search_from)
+                if marker < 0:
+                    keep_from = max(search_from, len(buffer) - len(RECORD_END))
+                    break
+                line_end = buffer.find(b"\n", marker + len(RECORD_END))
+                if line_end < 0:
+                    if not chunk:  # $$$$ on the last line without a newline
+                        ends.append(buffer_start + len(buffer))
+                    keep_from = marker
+                    break
+                ends.append(buffer_start + line_end + 1)
+                search_from = line_end
+            if not chunk:
+                return ends
+            buffer_start += keep_from
+            buffer = buffer[keep_from:]
+
+
+def iter_records(path, ends, indices=None):
+    """Yield (index, record bytes) for the given record indices (default all, in file order) of an SDF file."""
+    with open(path, 'rb') as f:
+        for index in range(len(ends)) if indices is None else indices:
+            start = ends[index - 1] if index else 0
+            f.seek(start)
+            yield index, f.read(ends[index] - start)
+
+
+def record_energy(record):
+    """The Energy data item of an SDF record, or None if it has none."""
+    match = ENERGY_PATTERN.search(record)
+    return float(match.group(1)) if match else None
+
+
+def heavy_atom_coordinates(record):
+    """
+    Heavy atom coordinates of a V2000 SDF record, read straight from its atom block as a list of (x, y, z).
+    Returns None for records in another format.
+    """
+    header = record.split(b"\n", 4)
+    if len(header) < 5 or b"V2000" not in header[3]:
+        return None
+    atom_count = int(header[3][0:3])
+    coordinates = []
+    for line in header[4].split(b"\n", atom_count)[:atom_count]:
+        if line[31:34].strip() != b"H":
+            coordinates.append((float(line[0:10]), float(line[10:20]), float(line[20:30])))
+    return coordinates
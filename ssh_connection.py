@@ -0,0 +1,205 @@
+import threading
+import time
+import paramiko
+
+# Seconds between keepalive packets on an otherwise idle transport
+KEEPALIVE_INTERVAL = 30
+
+# Options for every connection to the head node. The connection is shared, so they are fixed here rather
+# than chosen by whichever caller happens to open it first. Password authentication only; generous banner
+# and auth timeouts for a busy head node, 20 s for the TCP connect.
+CONNECT_OPTIONS = {
+    "look_for_keys": False,
+    "allow_agent": False,
+    "banner_timeout": 200,
+    "auth_timeout": 200,
+    "timeout": 20,
+}
+
+# Shared broker for the current process, created on first use
+_broker = None
+_broker_lock = threading.Lock()
+
+# Extra brokers with their own connections, opened on demand for striped transfers
+_pool_brokers = []
+
+
+class BrokeredSSHClient(paramiko.SSHClient):
+    """
+    SSHClient that makes sure the broker's transport is alive before every use.
+
+    Reconnects happen in place, so stages holding on to this client keep working after a drop.
+    """
+
+    def __init__(self, broker):
+        super().__init__()
+        self._broker = broker
+
+    def raw_transport(self):
+        """Return the current transport without triggering a reconnect."""
+        return super().get_transport()
+
+    def get_transport(self):
+        self._broker.ensure_connected()
+        return super().get_transport()
+
+    def exec_command(self, command, *args, **kwargs):
+        self._broker.ensure_connected()
+        return super().exec_command(command, *args, **kwargs)
+
+    def invoke_shell(self, *args, **kwargs):
+        self._broker.ensure_connected()
+        return super().invoke_shell(*args, **kwargs)
+
+    def open_sftp(self):
+        self._broker.ensure_connected()
+        return super().open_sftp()
+
+
+class SSHConnectionBroker:
+    """
+    Keep one authenticated SSH connection to the head node alive and share it.
+
+    Every stage, the GUI terminal and the remote browser open their channels on this connection
+    instead of doing their own handshake and password authentication.
+    """
+
+    def __init__(self, server, port, username, password, keepalive_interval=KEEPALIVE_INTERVAL,
+                 retries=3, delay=5, connect_kwargs=None):
+        self.server = server
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.keepalive_interval = keepalive_interval
+        self.retries = retries
+        self.delay = delay
+        self.connect_kwargs = dict(CONNECT_OPTIONS if connect_kwargs is None else connect_kwargs)
+        self.connection_count = 0
+        self._lock = threading.RLock()
+        self._client = BrokeredSSHClient(self)
+        self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+    def matches(self, server, port, username, password):
+        """Check whether this broker was created for the given credentials."""
+        return (self.server, self.port, self.username, self.password) == (server, int(port), username, password)
+
+    def is_connected(self):
+        """Return True if the shared transport is up and authenticated."""
+        transport = self._client.raw_transport()
+        return transport is not None and transport.is_active() and transport.is_authenticated()
+
+    def ensure_connected(self):
+        """
+        Connect, or reconnect after a drop, retrying with a growing delay.
+        """
+        if self.is_connected():
+            return
+        with self._lock:
+            if self.is_connected():  # Another thread reconnected while we waited for the lock
+                return
+
+            stale_transport = self._client.raw_transport()
+            if stale_transport is not None:
+                stale_transport.close()
+
+            for attempt in range(self.retries):
+                try:
+                    self._client.connect(
+                        self.server,
+                        port=self.port,
+                        username=self.username,
+                        password=self.password,
+                        **self.connect_kwargs
+                    )
+                    self._client.raw_transport().set_keepalive(self.keepalive_interval)
+                    self.connection_count += 1
+                    if self.connection_count == 1:
+                        print(f"SSH connection established to {self.server}.")
+                    else:
+                        print(f"SSH connection to {self.server} re-established (reconnect #{self.connection_count - 1}).")
+                    return
+                except paramiko.AuthenticationException:
+                    raise  # Retrying a bad password only burns through the head node's login limit
+                except Exception as e:
+                    print(f"Attempt {attempt + 1}: Could not connect to {self.server}. Exception: {e}")
+                    if attempt == self.retries - 1:
+                        raise
+                    time.sleep(self.delay * (attempt + 1))
+
+    def get_client(self):
+        """Return the shared SSH client, connecting first if needed."""
+        self.ensure_connected()
+        return self._client
+
+    def open_channel(self):
+        """Open a new session channel on the shared transport."""
+        return self.get_client().get_transport().open_session()
+
+    def close(self):
+        """Close the shared connection."""
+        with self._lock:
+            self._client.close()
+
+
+def get_broker(server, port, username, password):
+    """
+    Return the process-wide broker, replacing it if the credentials (including the port) changed.
+    """
+    global _broker
+    with _broker_lock:
+        if _broker is not None and not _broker.matches(server, port, username, password):
+            _broker.close()
+            _broker = None
+        if _broker is None:
+            _broker = SSHConnectionBroker(server, port, username, password)
+        return _broker
+
+
+def get_ssh_client(server, port, username, password):
+    """
+    Return the shared, connected SSH client for these credentials.
+    """
+    return get_broker(server, port, username, password).get_client()
+
+
+def get_client_pool(ssh, size):
+    """
+    Return up to `size` connected SSH clients for striping transfers: the given client first, then clients
+    on independent connections, each with its own TCP connection and encryption context.
+    The extra connections are kept open and reused by later transfers with the same credentials.
+    """
+    global _pool_brokers
+    broker = getattr(ssh, "_broker", None)
+    if broker is None or int(size) <= 1:
+        return [ssh]
+
+    with _broker_lock:
+        if _pool_brokers and not _pool_brokers[0].matches(broker.server, broker.port, broker.username, broker.password):
+            for pool_broker in _pool_brokers:
+                pool_broker.close()
+            _pool_brokers = []
+        while len(_pool_brokers) < int(size) - 1:
+            _pool_brokers.append(SSHConnectionBroker(broker.server, broker.port, broker.username, broker.password,
+                                                     connect_kwargs=broker.connect_kwargs))
+        pool_brokers = _pool_brokers[:int(size) - 1]
+
+    clients = [ssh]
+    for pool_broker in pool_brokers:
+        try:
+            clients.append(pool_broker.get_client())
+        except Exception as e:
+            print(f"Could not open another transfer connection ({e}). Continuing with {len(clients)}.")
+            break
+    return clients
+
+
+def close_broker():
+    """Close and forget the process-wide broker and any extra transfer connections."""
+    global _broker, _pool_brokers
+    with _broker_lock:
+        if _broker is not None:
+            _broker.close()
+            _broker = None
+        for pool_broker in _pool_brokers:
+            pool_broker.close()
+        _pool_brokers = []
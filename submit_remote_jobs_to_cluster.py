@@ -1,5 +1,13 @@
-import time
-import paramiko
+import re
+import shlex
+from datetime import datetime
+from ssh_connection import get_ssh_client
+import async_remote
+import file_transfer
+import harvest_results
+import head_node_agent
+import run_journal
+import transfer_manifest
 import importlib.util
 import os
 import sys
@@ -51,18 +59,146 @@ constants.remote_file_path = remote_file_path  # Update remote_file_path
 constants.remote_temp_dir = os.path.join(constants.remote_directory, constants.temp_dir).replace("\\", "/")
 remote_temp_dir = constants.remote_temp_dir  # Use updated value
 
-def submit_jobs(ssh, molecule_names, remote_dir):
+# Hidden folder in the remote temp directory holding the shared define/cosmoprep/subscript templates
+TEMPLATES_DIR_NAME = ".templates"
+
+# Hidden folder in the remote temp directory holding array job scripts, index files and task output
+ARRAY_DIR_NAME = ".array"
+
+# qsub calls in flight at once. Each one is a request to the SGE qmaster, which is shared with every other
+# user of the cluster, so this stays small and independent of the transfer concurrency.
+MAX_CONCURRENT_QSUBS = 4
+
+
+def create_shared_subscript(subscript_template_content):
+    """
+    Turn the subscript template into one shared script. The job name is passed with qsub -N and the
+    molecule name reaches the script body as $MOL_NAME through qsub -v.
+    """
+    lines = [line for line in subscript_template_content.splitlines()
+             if not (line.startswith("#$") and "{mol_name}" in line)]
+    return harvest_results.add_completion_marker("\n".join(lines).replace("{mol_name}", "${MOL_NAME}"))
+
+
+def parse_job_id(qsub_output):
+    """Return the job id from qsub's "Your job 123 (...) has been submitted" message, or None."""
+    match = re.search(r"Your job(?:-array)? (\d+)", qsub_output)
+    return match.group(1) if match else None
+
+
+def submit_jobs(ssh, molecule_names, remote_dir, journal=None):
     """
     Submit jobs using qsub, avoiding submission of run_tx.sh.
+    The qsub calls run concurrently through async_remote, up to MAX_CONCURRENT_QSUBS at once.
+    Job ids are recorded in the run journal if one is given.
+    """
+    molecule_names = [mol_name for mol_name in molecule_names if mol_name != "run_tx.sh"]
+    # Molecules prepared with shared templates have no subscript of their own
+    commands = [f"cd {remote_dir}/{mol_name} && if [ -f subscript ]; then qsub subscript; "
+                f"else qsub -N {mol_name} -v MOL_NAME={mol_name} {remote_dir}/{TEMPLATES_DIR_NAME}/subscript; fi"
+                for mol_name in molecule_names]
+    results = async_remote.run_commands(ssh, commands, limit=MAX_CONCURRENT_QSUBS)
+
+    failed = []
+    for mol_name, result in zip(molecule_names, results):
+        if isinstance(result, Exception):
+            failed.append(mol_name)
+            print(f"Failed to submit job for {mol_name}: {result}")
+            continue
+        print(f"Submitted job for {mol_name}")
+        print(f"stdout: {result.stdout}")
+        print(f"stderr: {result.stderr}")
+        job_id = parse_job_id(result.stdout)
+        if journal is not None and job_id:
+            journal.set_job_id(mol_name, job_id)
+    if failed:
+        print(f"{len(failed)} of {len(molecule_names)} jobs could not be submitted: {', '.join(failed)}")
+
+
+def create_array_job_script(subscript_template_content, remote_dir, index_file_name):
+    """
+    Turn the subscript template into an array job script. Task $SGE_TASK_ID runs the molecule on line
+    $SGE_TASK_ID of the index file, inside that molecule's folder.
+    """
+    lines = create_shared_subscript(subscript_template_content).splitlines()
+
+    # Keep the shebang and #$ directives first, since SGE only reads directives before the first command
+    header_length = max([i + 1 for i, line in enumerate(lines) if line.startswith("#$")] + [1])
+    task_prelude = [
+        f"MOL_NAME=$(sed -n \"${{SGE_TASK_ID}}p\" {shlex.quote(f'{remote_dir}/{ARRAY_DIR_NAME}/{index_file_name}')})",
+        "export MOL_NAME",
+        f"cd {shlex.quote(remote_dir)}/\"$MOL_NAME\" || exit 1"
+    ]
+    return "\n".join(lines[:header_length] + task_prelude + lines[header_length:]) + "\n"
+
+
+def array_job_name():
+    """Return a scheduler friendly job name for this list's array job."""
+    return re.sub(r"\W", "_", f"{constants.list_folder_name}_array")
+
+
+def submit_array_job(ssh, molecule_names, remote_dir, max_concurrent=0, journal=None):
+    """
+    Submit every molecule as one task of a single qsub -t 1-N array job, optionally capped at
+    max_concurrent running tasks with -tc. Returns the array job id, or None if submission failed.
+    """
+    molecule_names = [mol_name for mol_name in molecule_names if mol_name != "run_tx.sh"]
+    if not molecule_names:
+        return None
+
+    run_stamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S_%f")  # Unique per submission, even when streaming
+    index_file_name = f"array_index_{run_stamp}.txt"
+    script_file_name = f"array_job_{run_stamp}.sh"
+    array_dir = f"{remote_dir}/{ARRAY_DIR_NAME}"
+
+    with open(constants.subscript_template_path, 'r') as template_file:
+        subscript_template_content = template_file.read()
+    files = {
+        index_file_name: "".join(f"{mol_name}\n" for mol_name in molecule_names),
+        script_file_name: create_array_job_script(subscript_template_content, remote_dir, index_file_name)
+    }
+
+    # Upload the index file and job script, then check both in one round trip
+    stdin, stdout, stderr = ssh.exec_command(f"mkdir -p {shlex.quote(array_dir)}")
+    stdout.channel.recv_exit_status()
+    with file_transfer.open_transfer_backend(ssh, constants.transfer_backend) as backend:
+        for file_name, content in files.items():
+            backend.putfo(content, f"{array_dir}/{file_name}")
+    mismatched = transfer_manifest.verify_remote_files(
+        ssh, array_dir, {file_name: transfer_manifest.content_md5(content) for file_name, content in files.items()})
+    if mismatched:
+        print(f"Error: Verification failed for {', '.join(sorted(mismatched))}. Array job not submitted.")
+        return None
+
+    concurrency = f" -tc {int(max_concurrent)}" if max_concurrent and int(max_concurrent) > 0 else ""
+    command = (f"cd {shlex.quote(array_dir)} && qsub -t 1-{len(molecule_names)}{concurrency} "
+               f"-N {array_job_name()} {script_file_name}")
+    stdin, stdout, stderr = ssh.exec_command(command)
+    qsub_output = stdout.read().decode()
+    print(f"Submitted array job for {len(molecule_names)} molecules")
+    print(f"stdout: {qsub_output}")
+    print(f"stderr: {stderr.read().decode()}")
+
+    job_id = parse_job_id(qsub_output)
+    if job_id is None:
+        print("Error: Could not read the array job id from qsub.")
+        return None
+    if journal is not None:
+        # Each molecule is recorded as <array job id>.<task id>
+        for task_id, mol_name in enumerate(molecule_names, start=1):
+            journal.set_job_id(mol_name, f"{job_id}.{task_id}")
+        journal.add_array_job_id(job_id)
+    return job_id
+
+
+def submit_molecules(ssh, molecule_names, remote_dir, journal=None):
     """
-    for mol_name in molecule_names:
-        if mol_name != "run_tx.sh":
-            command = f"cd {remote_dir}/{mol_name} && qsub subscript"
-            stdin, stdout, stderr = ssh.exec_command(command)
-            print(f"Submitted job for {mol_name}")
-            print(f"stdout: {stdout.read().decode()}")
-            print(f"stderr: {stderr.read().decode()}")
-            time.sleep(0.5)
+    Submit the molecules as one array job or as one job each, depending on submit_as_array_job.
+    """
+    if constants.submit_as_array_job:
+        submit_array_job(ssh, molecule_names, remote_dir, constants.array_job_max_concurrent_tasks, journal=journal)
+    else:
+        submit_jobs(ssh, molecule_names, remote_dir, journal=journal)
 
 
 def main():
@@ -70,24 +206,34 @@ def main():
         print("submit_remote_jobs_to_cluster.py is disabled")
         return
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(server, port=port, username=username, password=password)
+    # Jobs were already submitted one molecule at a time while VConf was running
+    if (constants.stream_conformers_to_cluster and constants.generate_conformers_using_vconf_script
+            and constants.prepare_TMoleX_files_script):
+        print("Jobs were submitted as VConf finished each molecule (stream_conformers_to_cluster).")
+        return
+
+    ssh = get_ssh_client(server, port, username, password)
 
     # Gather molecule names from the remote directory
     print(f"Checking remote directory: {remote_temp_dir}")
-    stdin, stdout, stderr = ssh.exec_command(f"ls -l {remote_temp_dir}")
-    directory_contents = stdout.read().decode()
-    print(f"Directory contents: \n{directory_contents}")
-    molecule_names = [line.split()[-1] for line in directory_contents.splitlines() if line.startswith('d')]
+    molecule_names = head_node_agent.entry_names(ssh, remote_temp_dir, folders_only=True)
     print(f"Molecule names: {molecule_names}")
 
-    if not molecule_names:
-        print("No molecules found in the remote directory.")
-    else:
-        submit_jobs(ssh, molecule_names, remote_temp_dir)
-
-    ssh.close()
+    journal = run_journal.open_journal(constants.list_folder)
+    try:
+        # Do not submit a second job for molecules the journal already has a job id for
+        if constants.resume_from_journal:
+            submitted = journal.job_ids()
+            if any(mol_name in submitted for mol_name in molecule_names):
+                molecule_names = [mol_name for mol_name in molecule_names if mol_name not in submitted]
+                print(f"Run journal: {len(submitted)} jobs already submitted, {len(molecule_names)} left to submit.")
+
+        if not molecule_names:
+            print("No molecules found in the remote directory.")
+        else:
+            submit_molecules(ssh, molecule_names, remote_temp_dir, journal=journal)
+    finally:
+        journal.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,189 @@
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import paramiko
+
+# Finished transfers the controller waits for before it judges the current limit (at least twice the limit,
+# so every window spans a few rounds of transfers)
+DECISION_WINDOW = 8
+
+# A window whose median latency is this many times the best median seen so far counts as congestion
+LATENCY_SPIKE_FACTOR = 2.0
+
+# A window keeps growing the limit while its throughput stays within this share of the best window
+THROUGHPUT_KEEP_UP = 0.95
+
+# The best throughput slowly decays while the limit holds, so a changed link gets probed again
+THROUGHPUT_DECAY = 0.9
+
+# Backoff before retrying a transfer whose channel was refused
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def is_channel_open_failure(exc):
+    """Check whether an exception means sshd refused a new channel, usually because MaxSessions is reached."""
+    if isinstance(exc, paramiko.ChannelException):
+        return True
+    message = str(exc).lower()
+    return any(text in message for text in ("open failed", "unable to open channel", "administratively prohibited"))
+
+
+def retry_delay(attempt):
+    """Exponential backoff for the given retry attempt (0 based)."""
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+
+
+class ConcurrencyController:
+    """
+    AIMD limit on the number of transfers in flight.
+
+    Every transfer reports its latency, the bytes it moved and whether sshd refused its channel. A refused
+    channel halves the limit straight away, and the number of channels that were open at that moment becomes
+    the ceiling the limit grows back to (raised by one after each window spent holding at it). Otherwise,
+    after every window of transfers, the limit grows by one while the throughput keeps up with the best
+    window so far, and is halved when the median latency spikes without any gain in throughput.
+    Each change is printed.
+    """
+
+    def __init__(self, name, initial=4, minimum=1, maximum=16):
+        self.name = name
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.limit = min(self.maximum, max(self.minimum, int(initial)))
+        self._condition = threading.Condition()
+        self._active = 0
+        self._ceiling = self.maximum
+        self._generation = 0
+        self._window = []
+        self._window_started = None
+        self._best_rate = 0.0
+        self._best_latency = None
+
+    def acquire(self, blocking=True):
+        """
+        Wait for a free slot. Returns a token to hand back to release, or None right away if blocking is
+        False and no slot is free.
+        """
+        with self._condition:
+            while self._active >= self.limit:
+                if not blocking:
+                    return None
+                self._condition.wait()
+            self._active += 1
+            if self._window_started is None:
+                self._window_started = time.monotonic()
+            return self._generation
+
+    def release(self, token, latency, size=0, refused=False):
+        """Free a slot and record how the transfer went."""
+        with self._condition:
+            self._active -= 1
+            # Transfers started before the last decision say nothing about the current limit
+            if token == self._generation:
+                if refused:
+                    # The channels still open are as many as sshd allowed next to this one
+                    self._ceiling = max(self.minimum, min(self._ceiling, self._active))
+                    self._change(self.limit // 2, f"channel open refused by sshd with {self._active} open, "
+                                                  f"MaxSessions reached? Growing back to at most {self._ceiling}")
+                else:
+                    self._window.append((latency, size))
+                    if len(self._window) >= max(DECISION_WINDOW, 2 * self.limit):
+                        self._decide()
+            self._condition.notify_all()
+
+    def run(self, transfer, *args):
+        """Run transfer(*args) in a slot. transfer returns the number of bytes it moved (or None)."""
+        token = self.acquire()
+        started = time.monotonic()
+        try:
+            size = transfer(*args)
+        except Exception as e:
+            self.release(token, time.monotonic() - started, refused=is_channel_open_failure(e))
+            raise
+        self.release(token, time.monotonic() - started, size or 0)
+        return size
+
+    def end_batch(self):
+        """Drop a partly filled window, so the idle time until the next batch does not count against it."""
+        with self._condition:
+            self._reset_window()
+
+    def _decide(self):
+        elapsed = max(time.monotonic() - self._window_started, 1e-6)
+        median_latency = statistics.median(latency for latency, _ in self._window)
+        total_bytes = sum(size for _, size in self._window)
+        # Throughput in bytes per second, or in files per second when the transfers report no sizes
+        rate = (total_bytes or len(self._window)) / elapsed
+        unit = "B/s" if total_bytes else "files/s"
+        measured = f"{rate:.1f} {unit}, median latency {median_latency:.2f}s"
+
+        if self._best_latency is not None and median_latency > LATENCY_SPIKE_FACTOR * self._best_latency \
+                and rate < self._best_rate:
+            self._change(self.limit // 2, f"latency spike without more throughput ({measured})")
+        elif rate >= THROUGHPUT_KEEP_UP * self._best_rate and self.limit < self._ceiling:
+            self._change(self.limit + 1, f"throughput keeps up ({measured})")
+        else:
+            self._best_rate *= THROUGHPUT_DECAY
+            if self.limit == self._ceiling < self.maximum:
+                # Sessions may have been freed elsewhere, so the next window may probe one more
+                self._ceiling += 1
+            self._reset_window()
+
+        self._best_rate = max(self._best_rate, rate)
+        self._best_latency = median_latency if self._best_latency is None \
+            else min(self._best_latency, median_latency)
+
+    def _change(self, new_limit, reason):
+        new_limit = min(self.maximum, max(self.minimum, new_limit))
+        if new_limit != self.limit:
+            print(f"{self.name}: concurrency {self.limit} -> {new_limit} ({reason})")
+            self.limit = new_limit
+        self._generation += 1
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window = []
+        self._window_started = None
+
+
+def get_controller(name, initial=4, minimum=1, maximum=16):
+    """
+    Return the controller for a kind of transfer, creating it on first use. The controller lives as long as
+    the process, so later batches start from the limit the earlier ones settled on.
+    """
+    with _controllers_lock:
+        if name not in _controllers:
+            _controllers[name] = ConcurrencyController(name, initial, minimum, maximum)
+        return _controllers[name]
+
+
+def run_adaptive(controller, transfer, items, retries=3, end_batch=True):
+    """
+    Call transfer(item) for every item, with as many in flight as the controller allows. Transfers whose
+    channel was refused are retried with backoff. Returns {item: exception} for the items that failed.
+    Callers running several batches on one controller at the same time pass end_batch=False and end the
+    batch themselves once all of them are done.
+    """
+    def run(item):
+        for attempt in range(retries):
+            try:
+                controller.run(transfer, item)
+                return None
+            except Exception as e:
+                if not is_channel_open_failure(e) or attempt == retries - 1:
+                    return e
+                time.sleep(retry_delay(attempt))
+
+    if not items:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(len(items), controller.maximum)) as executor:
+        errors = dict(zip(items, executor.map(run, items)))
+    if end_batch:
+        controller.end_batch()
+        print(f"{controller.name}: {len(items)} transfers done at concurrency {controller.limit}")
+    return {item: error for item, error in errors.items() if error is not None}
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import shlex
+import head_node_agent
+
+
+def content_md5(content):
+    """Return the MD5 hex digest of in-memory text or bytes."""
+    return hashlib.md5(content if isinstance(content, bytes) else content.encode('utf-8')).hexdigest()
+
+
+def file_md5(file_path):
+    """Calculate the MD5 checksum of a local file."""
+    hash_md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+def build_manifest(checksums):
+    """Return an md5sum style manifest for {relative path: md5}."""
+    return "".join(f"{md5}  {relative_path}\n" for relative_path, md5 in checksums.items())
+
+
+def verify_remote_files(ssh, remote_dir, checksums):
+    """
+    Check uploaded files against {relative path: expected md5} with one md5sum -c call.
+    The manifest is piped in over the same channel, so this is one round trip for any number of files.
+    Returns the relative paths that are missing or do not match.
+    """
+    if not checksums:
+        return set()
+    stdin, stdout, stderr = ssh.exec_command(f"cd {shlex.quote(remote_dir)} && md5sum -c --quiet - 2>/dev/null")
+    stdin.write(build_manifest(checksums).encode('utf-8'))
+    stdin.channel.shutdown_write()
+    output = stdout.read().decode()
+    stdout.channel.recv_exit_status()
+
+    mismatched = set()
+    for line in output.splitlines():
+        if ": FAILED" in line:
+            mismatched.add(line.split(": FAILED")[0].strip())
+    return mismatched & set(checksums)
+
+
+def remote_checksums(ssh, remote_dir, relative_paths):
+    """
+    Return {relative path: md5} for remote files, hashed by a single md5sum fed the paths through xargs.
+    Files that do not exist are left out.
+    """
+    if not relative_paths:
+        return {}
+    stdin, stdout, stderr = ssh.exec_command(f"cd {shlex.quote(remote_dir)} && xargs -0 md5sum -- 2>/dev/null")
+    stdin.write("\0".join(relative_paths).encode('utf-8'))
+    stdin.channel.shutdown_write()
+    output = stdout.read().decode()
+    stdout.channel.recv_exit_status()
+
+    checksums = {}
+    for line in output.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2:
+            checksums[parts[1].strip().lstrip("*")] = parts[0]
+    return checksums
+
+
+def verify_local_files(ssh, remote_dir, local_files):
+    """
+    Check downloaded files given as {relative remote path: local path} against one remote md5 listing.
+    Returns the relative paths that are missing locally or do not match.
+    """
+    expected = remote_checksums(ssh, remote_dir, list(local_files))
+    return {relative_path for relative_path, local_path in local_files.items()
+            if not os.path.isfile(local_path) or file_md5(local_path) != expected.get(relative_path)}
+
+
+def remote_file_manifest(ssh, remote_dir, name_patterns):
+    """
+    Return {relative path: (size, mtime, md5)} for the files one level down in remote_dir (<folder>/<file>)
+    whose names match one of name_patterns. Sizes, modification times and hashes all come from one remote
+    command, answered by the head node agent when it can run there. Hidden folders such as .templates are
+    left out.
+    """
+    try:
+        return head_node_agent.hash_manifest(ssh, remote_dir, name_patterns)
+    except (head_node_agent.AgentUnavailable, RuntimeError) as e:
+        print(f"Building the manifest with find and md5sum instead of the head node agent ({e}).")
+
+    name_test = " -o ".join(f"-name {shlex.quote(pattern)}" for pattern in name_patterns)
+    find_command = f"find . -mindepth 2 -maxdepth 2 -type f -not -path './.*' \\( {name_test} \\)"
+    stdin, stdout, stderr = ssh.exec_command(
+        f"cd {shlex.quote(remote_dir)} && {find_command} -printf '%s\\t%T@\\t%P\\n' && echo && "
+        f"{find_command} -print0 | xargs -0 -r md5sum --")
+    output = stdout.read().decode()
+    stdout.channel.recv_exit_status()
+
+    stats_section, _, hash_section = output.partition("\n\n")
+    checksums = {}
+    for line in hash_section.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2:
+            relative_path = parts[1].strip().lstrip("*")
+            checksums[relative_path[2:] if relative_path.startswith("./") else relative_path] = parts[0]
+
+    manifest = {}
+    for line in stats_section.splitlines():
+        parts = line.split("\t", 2)
+        if len(parts) == 3 and parts[2] in checksums:
+            manifest[parts[2]] = (int(parts[0]), int(float(parts[1])), checksums[parts[2]])
+    return manifest
+
+
+def local_copy_matches(local_path, size, mtime, md5, trust_mtime=True):
+    """
+    Check a local file against a remote (size, mtime, md5) entry, rsync style: equal size and mtime count
+    as a match without reading the file (unless trust_mtime is False), otherwise the hashes decide.
+    A file whose hash matches gets the remote mtime, so the next check is free.
+    """
+    if not os.path.isfile(local_path):
+        return False
+    local_stat = os.stat(local_path)
+    if local_stat.st_size != size:
+        return False
+    if trust_mtime and int(local_stat.st_mtime) == mtime:
+        return True
+    if file_md5(local_path) != md5:
+        return False
+    os.utime(local_path, (mtime, mtime))
+    return True
+
+
+def outdated_local_files(manifest, local_root, relative_paths=None, trust_mtime=True):
+    """
+    Return the relative paths from manifest (or only from relative_paths) whose copy under local_root is
+    missing or differs from the remote file. Pass trust_mtime=False to hash every file, e.g. right after
+    downloading it.
+    """
+    relative_paths = manifest if relative_paths is None else relative_paths
+    return sorted(relative_path for relative_path in relative_paths
+                  if not local_copy_matches(os.path.join(local_root, *relative_path.split("/")),
+                                            *manifest[relative_path], trust_mtime=trust_mtime))
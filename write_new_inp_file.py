@@ -4,6 +4,7 @@ from collections import defaultdict
 import pyperclip
 import sys
 import importlib
+import results_cache
 
 # Determine the correct path to constants.py
 if getattr(sys, 'frozen', False):  # Running as an executable
@@ -30,55 +31,106 @@ settings = default_vconf_settings if constants.use_default_vconf_settings else c
 list_folder = os.path.dirname(os.path.dirname(settings['SDF_FILENAME']))
 
 
-def find_and_copy_cosmo_files(source_directory, target_directory):
-    """Find all .cosmo files in the source directory and its subdirectories and copy them to the target directory."""
-    if not os.path.exists(target_directory):
-        os.makedirs(target_directory)
-    else:
-        # Clear the target directory
-        for file in os.listdir(target_directory):
-            file_path = os.path.join(target_directory, file)
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-
-    cosmo_files = defaultdict(list)
+def find_cosmo_files(source_directory):
+    """Return {file name: path} of every .cosmo file in the source directory and its subdirectories."""
+    sources = {}
     for root, _, files in os.walk(source_directory):
         for file in files:
             if file.endswith('.cosmo'):
-                source_file = os.path.join(root, file)
-                target_file = os.path.join(target_directory, file)
-                try:
-                    shutil.copy2(source_file, target_file)
-                    # Group files by molecule base name
-                    base_name = file.rsplit('_', 1)[0]
-                    cosmo_files[base_name].append(file)
-                except PermissionError:
-                    print(f"PermissionError: Unable to copy {file}. It might be in use by another process.")
-                    raise
+                sources[file] = os.path.join(root, file)
+    return sources
+
+
+def conformer_number(cosmo_file):
+    """Return the conformer number of a file like Water_3.cosmo."""
+    suffix = os.path.splitext(cosmo_file)[0].rsplit('_', 1)[-1]
+    return int(suffix) if suffix.isdigit() else 0
+
+
+def find_cached_cosmo_files(sources):
+    """
+    Return {file name: cached path} for this run's conformers that were not computed on the cluster this
+    time but have a .cosmo file in the results cache.
+    """
+    run_keys = results_cache.load_run_keys(list_folder)
+    if not run_keys:
+        return {}
+
+    cache = results_cache.open_cache(constants.compound_list_directory)
+    cached = {}
+    try:
+        for mol_name, key in run_keys.items():
+            file = f"{mol_name}.cosmo"
+            if file in sources:
+                continue
+            files = cache.lookup(key)
+            if files:
+                cached[file] = files[".cosmo"]
+    finally:
+        cache.close()
+    print(f"Found {len(cached)} .cosmo files in the results cache.")
+    return cached
+
+
+def group_cosmo_files(sources):
+    """Group .cosmo file names by molecule base name, with conformers in numeric order."""
+    cosmo_files = defaultdict(list)
+    for file in sources:
+        base_name = file.rsplit('_', 1)[0]
+        cosmo_files[base_name].append(file)
+    for files in cosmo_files.values():
+        files.sort(key=conformer_number)
     return cosmo_files
 
 
-def rename_cosmo_files(cosmo_files, target_directory):
-    """Rename .cosmo files according to the specified rules."""
+def rename_cosmo_files(cosmo_files):
+    """
+    Return ({old name: new name}, renamed files grouped by base name) according to the naming rules:
+    conformer sets drop the underscore, single conformers drop the _1 suffix.
+    """
+    new_names = {}
     renamed_files = defaultdict(list)
     for base_name, files in cosmo_files.items():
-        if len(files) > 1:
-            for file in files:
-                new_name = file.replace('_', '')
-                old_path = os.path.join(target_directory, file)
-                new_path = os.path.join(target_directory, new_name)
-                os.rename(old_path, new_path)
-                renamed_files[base_name].append(new_name)
-        else:
-            file = files[0]
-            new_name = file.replace('_1', '')
-            old_path = os.path.join(target_directory, file)
-            new_path = os.path.join(target_directory, new_name)
-            os.rename(old_path, new_path)
+        for file in files:
+            new_name = file.replace('_', '') if len(files) > 1 else file.replace('_1', '')
+            new_names[file] = new_name
             renamed_files[base_name].append(new_name)
-    return renamed_files
+    return new_names, renamed_files
+
+
+def sync_cosmo_files(sources, new_names, target_directory):
+    """
+    Make target_directory hold exactly the renamed .cosmo files. A file is only copied when it is missing
+    or its size or modification time differs from the source, and anything else in the folder is removed.
+    """
+    os.makedirs(target_directory, exist_ok=True)
+    copied = 0
+    for file, source_file in sources.items():
+        target_file = os.path.join(target_directory, new_names[file])
+        source_stat = os.stat(source_file)
+        if os.path.isfile(target_file):
+            target_stat = os.stat(target_file)
+            if target_stat.st_size == source_stat.st_size and int(target_stat.st_mtime) == int(source_stat.st_mtime):
+                continue
+        try:
+            shutil.copy2(source_file, target_file)
+            copied += 1
+        except PermissionError:
+            print(f"PermissionError: Unable to copy {file}. It might be in use by another process.")
+            raise
+
+    wanted = set(new_names.values())
+    removed = 0
+    for entry in os.listdir(target_directory):
+        if entry in wanted:
+            continue
+        entry_path = os.path.join(target_directory, entry)
+        if os.path.isfile(entry_path) or os.path.islink(entry_path):
+            os.unlink(entry_path)
+        elif os.path.isdir(entry_path):
+            shutil.rmtree(entry_path)
+        removed += 1
+    print(f"COSMO_files: copied {copied} new or changed files, kept {len(sources) - copied} unchanged, removed {removed}.")
 
 
 def generate_inp_file(cosmo_files, target_directory):
@@ -125,14 +177,17 @@ def main():
 
     # Extract .cosmo files if the variable is set to True
     if constants.extract_cosmo_files_to_cosmo_folder:
-        cosmo_files = find_and_copy_cosmo_files(source_directory, target_directory)
-        print("Successfully copied .cosmo files to COSMO_files folder")
-        if not cosmo_files:
+        sources = find_cosmo_files(source_directory)
+        if constants.use_results_cache:
+            sources.update(find_cached_cosmo_files(sources))
+        if not sources:
             print("No .cosmo files found in the directory.")
             return
 
-        # Rename the .cosmo files
-        renamed_cosmo_files = rename_cosmo_files(cosmo_files, target_directory)
+        # Work out the final names first, so only new or changed files are copied into COSMO_files
+        new_names, renamed_cosmo_files = rename_cosmo_files(group_cosmo_files(sources))
+        sync_cosmo_files(sources, new_names, target_directory)
+        print("Successfully synced .cosmo files to COSMO_files folder")
     else:
         renamed_cosmo_files = defaultdict(list)
         for root, _, files in os.walk(target_directory):